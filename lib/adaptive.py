@@ -0,0 +1,163 @@
+import time
+import threading
+from . import pyclamd
+
+# seconds between two STATS polls
+DEFAULT_POLL_INTERVAL = 2.0
+# share of the limit kept when clamd queues jobs
+DECREASE_FACTOR = 0.75
+
+
+class AdaptiveLimiter:
+    """
+    Limit the scans in flight to what clamd keeps up with, from its STATS.
+
+    The limit grows by one while it is reached, clamd has idle threads and
+    its queue is empty. It shrinks by a quarter when jobs wait in the queue,
+    STATS fails or a scan loses its connection, so the queue stays short and
+    clamd never reaches MaxQueue.
+
+    Example:
+        >>> limiter = AdaptiveLimiter(lambda: parse_stats(cd.stats()), maximum=32)
+        >>> with limiter:
+        ...     cd.scan_stream(data)
+        >>> limiter.stats()
+        {'limit': 12, 'lowest': 2, 'highest': 12, 'in_flight': 0, 'polls': 40, 'failed_polls': 0}
+    """
+
+    def __init__(
+        self,
+        poll,
+        maximum,
+        minimum=1,
+        initial=None,
+        interval=DEFAULT_POLL_INTERVAL,
+    ):
+        """
+        Initialize the AdaptiveLimiter class.
+
+        Args:
+            poll (callable): Returns the `clamdstats.ClamdStats` of the daemons.
+            maximum (int): The highest limit.
+            minimum (int): The lowest limit.
+            initial (int): The starting limit, `minimum` by default.
+            interval (float): Seconds between two polls.
+        """
+        self.poll = poll
+        self.maximum = maximum
+        self.minimum = minimum
+        self.interval = interval
+        self.limit = max(minimum, min(initial or minimum, maximum))
+        self.lowest = self.highest = self.limit
+        self.in_flight = 0
+        self.polls = 0
+        self.failed_polls = 0
+        self._next_poll = time.monotonic() + interval
+        self._polling = False
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        if exc_type is not None and issubclass(exc_type, pyclamd.ConnectionError):
+            self.backoff()
+
+    def acquire(self):
+        """
+        Wait until a scan can be sent, polling clamd when it is time to.
+        """
+        while True:
+            self._maybe_adjust()
+            with self._cond:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                # wake up for the next poll even if no scan ends meanwhile
+                self._cond.wait(self.interval)
+
+    def release(self):
+        """
+        Record the end of a scan.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def backoff(self):
+        """
+        Shrink the limit right away, e.g. when clamd drops a connection.
+        """
+        with self._cond:
+            self._set_limit(int(self.limit * DECREASE_FACTOR), self.maximum)
+
+    def adjust(self):
+        """
+        Poll clamd and update the limit.
+
+        Returns:
+            int: The new limit.
+        """
+        try:
+            stats = self.poll()
+        except pyclamd.ConnectionError:
+            stats = None
+
+        with self._cond:
+            self.polls += 1
+            if stats is None:
+                self.failed_polls += 1
+                limit = int(self.limit * DECREASE_FACTOR)
+            elif stats.queue_length > 0:
+                limit = int(self.limit * DECREASE_FACTOR)
+            elif self.in_flight >= self.limit and (
+                stats.threads_idle > 0 or stats.threads_busy < stats.threads_max
+            ):
+                limit = self.limit + 1
+            else:
+                limit = self.limit
+
+            maximum = self.maximum
+            if stats is not None and stats.threads_max:
+                # more scans in flight than threads would only queue up
+                maximum = min(maximum, stats.threads_max)
+            self._set_limit(limit, maximum)
+            return self.limit
+
+    def stats(self):
+        """
+        Get the limiter counters.
+
+        Returns:
+            dict: The current, lowest and highest limits, the scans in
+                flight and the number of polls.
+        """
+        with self._cond:
+            return {
+                "limit": self.limit,
+                "lowest": self.lowest,
+                "highest": self.highest,
+                "in_flight": self.in_flight,
+                "polls": self.polls,
+                "failed_polls": self.failed_polls,
+            }
+
+    def _maybe_adjust(self):
+        with self._cond:
+            if self._polling or time.monotonic() < self._next_poll:
+                return
+            self._polling = True
+        try:
+            self.adjust()
+        finally:
+            with self._cond:
+                self._polling = False
+                self._next_poll = time.monotonic() + self.interval
+
+    def _set_limit(self, limit, maximum):
+        self.limit = max(self.minimum, min(limit, maximum))
+        self.lowest = min(self.lowest, self.limit)
+        self.highest = max(self.highest, self.limit)
+        self._cond.notify_all()
@@ -0,0 +1,264 @@
+import abc
+import asyncio
+import struct
+from . import pyclamd
+
+DEFAULT_CHUNK_SIZE = pyclamd.DEFAULT_CHUNK_SIZE
+
+
+class AsyncClamd(abc.ABC):
+    """
+    Base class of the asyncio clamd clients, which implement
+    `_open_connection`.
+
+    Every command opens its own connection, like the `pyclamd` clients, and
+    replies are parsed with `pyclamd.parse_response` so results are
+    identical to the blocking clients.
+    """
+
+    def __init__(self, timeout=None):
+        """
+        Initialize the AsyncClamd class.
+
+        Args:
+            timeout (float): Timeout in seconds of each command, None for no timeout.
+        """
+        self.timeout = timeout
+
+    async def ping(self):
+        """
+        Send a PING to clamd.
+
+        Returns:
+            bool: True if clamd replies PONG.
+
+        Raises:
+            pyclamd.ConnectionError: If clamd does not reply PONG.
+        """
+        result = await self._command("PING")
+        if result == ["PONG"]:
+            return True
+        raise pyclamd.ConnectionError(f"Could not ping clamd server {result}")
+
+    async def version(self):
+        """
+        Get the clamd version.
+
+        Returns:
+            str: The clamd version and signature database version.
+        """
+        return "\n".join(await self._command("VERSION"))
+
+    async def stats(self):
+        """
+        Get the clamd statistics.
+
+        Returns:
+            str: The multiline STATS reply.
+        """
+        return "".join(f"{line}\n" for line in await self._command("STATS"))
+
+    async def scan_file(self, file):
+        """
+        Scan a file or directory with SCAN, stopping at the first virus or error.
+
+        Args:
+            file (str): The absolute path, as seen by clamd.
+
+        Returns:
+            dict: {filename: (status, reason)} or None if no virus is found.
+        """
+        lines = await self._command(f"SCAN {file}")
+        return self._results(lines, stop_on_error=True)
+
+    async def contscan_file(self, file):
+        """
+        Scan a file or directory with CONTSCAN.
+
+        Args:
+            file (str): The absolute path, as seen by clamd.
+
+        Returns:
+            dict: {filename: (status, reason)} or None if no virus is found.
+        """
+        return self._results(await self._command(f"CONTSCAN {file}"))
+
+    async def multiscan_file(self, file):
+        """
+        Scan a file or directory with MULTISCAN, using several clamd threads.
+
+        Args:
+            file (str): The absolute path, as seen by clamd.
+
+        Returns:
+            dict: {filename: (status, reason)} or None if no virus is found.
+        """
+        return self._results(await self._command(f"MULTISCAN {file}"))
+
+    async def allmatchscan(self, file):
+        """
+        Scan a file with ALLMATCHSCAN, reporting every signature matching it.
+
+        Args:
+            file (str): The absolute path, as seen by clamd.
+
+        Returns:
+            dict: {filename: [(status, reason), ...]} or None if no virus is found.
+        """
+        results = {}
+        for line in await self._command(f"ALLMATCHSCAN {file}"):
+            filename, reason, status = pyclamd.parse_response(line)
+            if status in ("ERROR", "FOUND"):
+                results.setdefault(filename, []).append((status, reason))
+        return results or None
+
+    async def scan_stream(self, stream, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Scan a buffer or a file-like object with INSTREAM.
+
+        File-like objects are read in a thread so the event loop never
+        blocks on disk.
+
+        Args:
+            stream (bytes | bytearray | file-like): The data to scan.
+            chunk_size (int): Size of the INSTREAM chunks.
+
+        Returns:
+            dict: {"stream": (status, reason)} or None if no virus is found.
+
+        Raises:
+            pyclamd.BufferTooLongError: If the stream exceeds clamd StreamMaxLength.
+            pyclamd.ConnectionError: In case of communication problem.
+        """
+
+        async def send(writer):
+            if hasattr(stream, "read"):
+                while chunk := await asyncio.to_thread(stream.read, chunk_size):
+                    writer.write(struct.pack("!I", len(chunk)))
+                    writer.write(chunk)
+                    await writer.drain()
+            else:
+                view = memoryview(stream)
+                for n in range(0, len(view), chunk_size):
+                    chunk = view[n : n + chunk_size]
+                    writer.write(struct.pack("!I", len(chunk)))
+                    writer.write(chunk)
+                    await writer.drain()
+            writer.write(struct.pack("!I", 0))
+
+        lines = await self._command("INSTREAM", send)
+        if "INSTREAM size limit exceeded. ERROR" in lines:
+            raise pyclamd.BufferTooLongError("INSTREAM size limit exceeded. ERROR")
+        return self._results(lines)
+
+    async def _command(self, cmd, send=None):
+        """
+        Send a command on a new connection and read its reply lines.
+        """
+        try:
+            return await asyncio.wait_for(self._exchange(cmd, send), self.timeout)
+        except pyclamd.ConnectionError:
+            raise
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            raise pyclamd.ConnectionError(f"Unable to run {cmd.split()[0]}: {e}")
+
+    async def _exchange(self, cmd, send):
+        reader, writer = await self._open_connection()
+        try:
+            writer.write(f"n{cmd}\n".encode())
+            if send is not None:
+                await send(writer)
+            await writer.drain()
+
+            lines = []
+            async for line in reader:
+                try:
+                    line = line.decode().strip()
+                except UnicodeDecodeError:
+                    line = line.strip()
+                if line:
+                    lines.append(line)
+            return lines
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    @abc.abstractmethod
+    async def _open_connection(self):
+        """
+        Open a connection to clamd.
+
+        Returns:
+            tuple: The (asyncio.StreamReader, asyncio.StreamWriter) pair.
+
+        Raises:
+            pyclamd.ConnectionError: If clamd cannot be reached.
+        """
+
+    def _results(self, lines, stop_on_error=False):
+        results = {}
+        for line in lines:
+            filename, reason, status = pyclamd.parse_response(line)
+            if status in ("ERROR", "FOUND"):
+                results[filename] = (status, reason)
+                if stop_on_error and status == "ERROR":
+                    break
+        return results or None
+
+
+class AsyncClamdUnixSocket(AsyncClamd):
+    """
+    asyncio clamd client using a unix socket.
+    """
+
+    def __init__(self, filename=None, timeout=None):
+        """
+        Initialize the AsyncClamdUnixSocket class.
+
+        Args:
+            filename (str): The unix socket, None to read it from clamd.conf.
+            timeout (float): Timeout in seconds of each command.
+
+        Raises:
+            pyclamd.ConnectionError: If no socket is given or found in clamd.conf.
+        """
+        super().__init__(timeout)
+        self.unix_socket = filename or pyclamd.find_unix_socket()
+
+    async def _open_connection(self):
+        try:
+            return await asyncio.open_unix_connection(self.unix_socket)
+        except OSError:
+            raise pyclamd.ConnectionError(
+                f"Could not reach clamd using unix socket ({self.unix_socket})"
+            )
+
+
+class AsyncClamdNetworkSocket(AsyncClamd):
+    """
+    asyncio clamd client using a TCP socket.
+    """
+
+    def __init__(self, host="127.0.0.1", port=3310, timeout=None):
+        """
+        Initialize the AsyncClamdNetworkSocket class.
+
+        Args:
+            host (str): The clamd hostname or ip address.
+            port (int): The clamd TCP port.
+            timeout (float): Timeout in seconds of each command.
+        """
+        super().__init__(timeout)
+        self.host = host
+        self.port = port
+
+    async def _open_connection(self):
+        try:
+            return await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            raise pyclamd.ConnectionError(
+                f"Could not reach clamd using network ({self.host}, {self.port})"
+            )
@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+from . import pyclamd
+from .aioclamd import AsyncClamdNetworkSocket, AsyncClamdUnixSocket
+from .scan import Scan
+
+DEFAULT_CONCURRENCY = 100
+# files walked by a thread at a time, so the event loop never blocks on disk
+WALK_BATCH = 256
+
+
+class AsyncScan(Scan):
+    """
+    A class to scan files using ClamAV from an asyncio event loop.
+
+    Example:
+        >>> scanner = await AsyncScan.connect(modified_since=None, logger=logger)
+        >>> await scanner.scan_folder("/var/www")
+        [PosixPath('/var/www/shell.php')]
+    """
+
+    def __init__(
+        self, modified_since, logger, cd, concurrency=DEFAULT_CONCURRENCY, rules=None
+    ):
+        """
+        Initialize the AsyncScan class.
+
+        Args:
+            modified_since (datetime): The file to scan that have been modified since.
+            logger (logging.Logger): The logger to use for logging scan results.
+            cd (aioclamd.AsyncClamd): The asyncio clamd client.
+            concurrency (int): Maximum number of scans in flight.
+            rules (rules.WalkRules): Rules pruning the folders and files
+                walked, None to scan everything.
+        """
+        super().__init__(
+            modified_since,
+            logger,
+            session=False,
+            workers=concurrency,
+            fildes=False,
+            rules=rules,
+            walk_queue_depth=0,
+            cd=cd,
+        )
+        self.concurrency = concurrency
+
+    @classmethod
+    async def connect(cls, modified_since, logger, concurrency=DEFAULT_CONCURRENCY):
+        """
+        Create an AsyncScan connected to the local clamd, by unix socket or
+        else by network socket.
+
+        Raises:
+            ValueError: If unable to connect to the ClamAV daemon.
+        """
+        try:
+            cd = AsyncClamdUnixSocket()
+            await cd.ping()
+        except pyclamd.ConnectionError:
+            try:
+                cd = AsyncClamdNetworkSocket()
+                await cd.ping()
+            except pyclamd.ConnectionError:
+                raise ValueError(
+                    "could not connect to clamd server either by unix or network socket"
+                )
+        return cls(modified_since, logger, cd, concurrency)
+
+    async def scan_file(self, file):
+        """
+        Scan a file.
+
+        Args:
+            file (pathlib.PosixPath): The file.
+
+        Returns:
+            bool: True if the file is infected, False otherwise.
+        """
+        if not await asyncio.to_thread(self.should_scan, file):
+            return False
+        return await self._scan_candidate(file)
+
+    async def scan_folder(self, folder):
+        """
+        Scan all files in a directory recursively, with at most
+        `concurrency` scans in flight.
+
+        Args:
+            folder (str): The path to the directory.
+
+        Returns:
+            list: A list of scan results.
+        """
+        results = []
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def scan(file):
+            try:
+                if await self._scan_candidate(file):
+                    results.append(file)
+            finally:
+                slots.release()
+
+        walk = self._uncached(folder, results)
+        async with asyncio.TaskGroup() as tasks:
+            while batch := await asyncio.to_thread(
+                list, itertools.islice(walk, WALK_BATCH)
+            ):
+                for filepath in batch:
+                    # wait for a free slot before walking further
+                    await slots.acquire()
+                    tasks.create_task(scan(filepath))
+        return results
+
+    async def _scan_candidate(self, file):
+        try:
+            f = await asyncio.to_thread(open, str(file), "rb")
+        except OSError as e:
+            return self.handle_result(file, self._open_error(file, e))
+        try:
+            result = await self.cd.scan_stream(f)
+        except pyclamd.BufferTooLongError as e:
+            result = self._too_long_error(e)
+        finally:
+            f.close()
+        return self.handle_result(file, result)
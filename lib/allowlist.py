@@ -0,0 +1,185 @@
+import os
+import glob
+import struct
+import hashlib
+import threading
+import subprocess
+
+DPKG_MANIFESTS = "/var/lib/dpkg/info/*.md5sums"
+# path size mtime digest mode owner group isconfig isdoc rdev symlink
+RPM_DUMP = ["rpm", "-qa", "--dump"]
+RPM_DUMP_FIELDS = 11
+# digest size -> hashlib algorithm, the manifests telling it by their length
+ALGORITHMS = {16: "md5", 20: "sha1", 32: "sha256", 64: "sha512"}
+# size of the index entries whose manifest has no file size, as dpkg's
+UNKNOWN_SIZE = -1
+READ_SIZE = 1024 * 1024
+
+_SIZE = struct.Struct("!q")
+
+
+def file_digest(path, algorithm):
+    """
+    Hash the content of a file.
+
+    Args:
+        path (str): The file.
+        algorithm (str): The hashlib algorithm.
+
+    Returns:
+        bytes: The digest, or None if the file cannot be read.
+    """
+    h = hashlib.new(algorithm)
+    buf = bytearray(READ_SIZE)
+    try:
+        with open(path, "rb") as f, memoryview(buf) as view:
+            while size := f.readinto(buf):
+                h.update(view[:size])
+    except OSError:
+        return None
+    return h.digest()
+
+
+class PackageAllowlist:
+    """
+    Index of the files installed by the package managers, so that the
+    files unchanged since their package was installed are not scanned.
+
+    The index maps each path to the digest of the manifest and, for rpm,
+    the file size, packed in one bytes object so millions of entries stay
+    compact. A file is only trusted once its size and its digest match.
+
+    Example:
+        >>> allowlist = PackageAllowlist(["/var/lib/dpkg/info/*.md5sums"])
+        >>> allowlist.allows("/usr/bin/ls", os.stat("/usr/bin/ls"))
+        True
+        >>> allowlist.stats()
+        {'entries': 61120, 'files': 1, 'bytes': 142312, 'mismatches': 0}
+    """
+
+    def __init__(self, manifests=(), rpm=False):
+        """
+        Initialize the PackageAllowlist class and load the manifests.
+
+        Args:
+            manifests (list): Globs of dpkg md5sums manifests, e.g.
+                `DPKG_MANIFESTS`.
+            rpm (bool): Load the files of the rpm database too.
+        """
+        # path -> digest followed by the packed size
+        self._index = {}
+        self._files = 0
+        self._bytes = 0
+        self._mismatches = 0
+        self._lock = threading.Lock()
+        for pattern in manifests:
+            for path in sorted(glob.glob(pattern)):
+                self.load_md5sums(path)
+        if rpm:
+            self.load_rpm()
+
+    def __len__(self):
+        return len(self._index)
+
+    def load_md5sums(self, path):
+        """
+        Load a dpkg md5sums manifest, one "<md5>  <path relative to />"
+        line per file. Unreadable manifests are ignored.
+
+        Args:
+            path (str): The manifest.
+
+        Returns:
+            int: Number of files loaded.
+        """
+        loaded = 0
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    digest, _, name = line.rstrip(b"\n").partition(b"  ")
+                    if name and self._add(name, UNKNOWN_SIZE, digest):
+                        loaded += 1
+        except OSError:
+            pass
+        return loaded
+
+    def load_rpm(self):
+        """
+        Load the files of the rpm database, read with `rpm -qa --dump`.
+        Nothing is loaded when rpm is not installed.
+
+        Returns:
+            int: Number of files loaded.
+        """
+        loaded = 0
+        try:
+            with subprocess.Popen(
+                RPM_DUMP, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+            ) as process:
+                for line in process.stdout:
+                    # paths may hold spaces, the other fields do not
+                    fields = line.rstrip(b"\n").rsplit(b" ", RPM_DUMP_FIELDS - 1)
+                    if len(fields) != RPM_DUMP_FIELDS or not fields[1].isdigit():
+                        continue
+                    if self._add(fields[0], int(fields[1]), fields[3]):
+                        loaded += 1
+        except OSError:
+            pass
+        return loaded
+
+    def allows(self, file, st):
+        """
+        Check whether a file is the one installed by its package, counting
+        it when it is.
+
+        Args:
+            file (pathlib.PosixPath): The file.
+            st (os.stat_result): Its stat data.
+
+        Returns:
+            bool: True if the file size and content match its manifest.
+        """
+        entry = self._index.get(str(file))
+        if entry is None:
+            return False
+
+        digest = entry[: -_SIZE.size]
+        (size,) = _SIZE.unpack(entry[-_SIZE.size :])
+        matches = (size == UNKNOWN_SIZE or size == st.st_size) and file_digest(
+            str(file), ALGORITHMS[len(digest)]
+        ) == digest
+        with self._lock:
+            if not matches:
+                self._mismatches += 1
+                return False
+            self._files += 1
+            self._bytes += st.st_size
+        return True
+
+    def stats(self):
+        """
+        Get the allowlist counters.
+
+        Returns:
+            dict: The files indexed, the files skipped and their bytes, and
+                the indexed files whose size or content changed.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._index),
+                "files": self._files,
+                "bytes": self._bytes,
+                "mismatches": self._mismatches,
+            }
+
+    def _add(self, name, size, digest):
+        try:
+            digest = bytes.fromhex(digest.decode())
+        except ValueError:
+            return False
+        # directories and special files have no digest
+        if len(digest) not in ALGORITHMS or not any(digest):
+            return False
+        path = "/" + os.fsdecode(name).lstrip("/")
+        self._index[path] = digest + _SIZE.pack(size)
+        return True
@@ -0,0 +1,418 @@
+import os
+import copy
+import functools
+import time
+import socket
+import threading
+from . import pyclamd
+from .clamdstats import merge_stats, parse_stats
+
+# seconds an endpoint failing PING stays out of rotation before a new PING
+DEFAULT_RETRY_INTERVAL = 30.0
+
+
+def parse_endpoint(endpoint):
+    """
+    Parse a clamd endpoint.
+
+    Args:
+        endpoint (str): A unix socket path ("/run/clamav/clamd.ctl" or
+            "unix:/run/clamav/clamd.ctl") or a TCP address ("127.0.0.1:3310").
+
+    Returns:
+        tuple: (socket.AF_UNIX, path) or (socket.AF_INET, host, port).
+
+    Raises:
+        ValueError: If the endpoint is not a path nor a host:port address.
+    """
+    endpoint = endpoint.removeprefix("unix:")
+    if endpoint.startswith("/"):
+        return socket.AF_UNIX, endpoint
+
+    host, sep, port = endpoint.rpartition(":")
+    if not sep or not host or not port.isdigit():
+        raise ValueError(f"invalid clamd endpoint '{endpoint}', expected host:port")
+    return socket.AF_INET, host.strip("[]"), int(port)
+
+
+def connect_endpoint(endpoint, timeout=None):
+    """
+    Create the clamd client of an endpoint.
+
+    Args:
+        endpoint (str): The endpoint, see `parse_endpoint`.
+        timeout (float): Socket timeout in seconds, None for no timeout.
+
+    Returns:
+        pyclamd._ClamdGeneric: The client.
+
+    Raises:
+        pyclamd.ConnectionError: If clamd cannot be reached.
+    """
+    family, *address = parse_endpoint(endpoint)
+    if family == socket.AF_UNIX:
+        return pyclamd.ClamdUnixSocket(*address, timeout=timeout)
+    return pyclamd.ClamdNetworkSocket(*address, timeout=timeout)
+
+
+def _unchanged():
+    pass
+
+
+class _Endpoint:
+    def __init__(self, address):
+        self.address = address
+        self.client = None
+        self.outstanding = 0
+        self.scans = 0
+        self.failures = 0
+        # monotonic time before which the endpoint is out of rotation
+        self.down_until = 0.0
+
+
+class ClamdBalancer:
+    """
+    A thread-safe clamd client spreading the scans over several clamd
+    daemons, each scan going to the daemon with the least outstanding
+    requests.
+
+    An endpoint whose connection fails is taken out of rotation and
+    PINGed again after `retry_interval` seconds. A scan interrupted by a
+    failing endpoint is retried on another one.
+
+    Example:
+        >>> cd = ClamdBalancer(["/run/clamav/clamd1.ctl", "/run/clamav/clamd2.ctl"])
+        >>> cd.scan_stream(b"data")
+        >>> cd.stats()
+        [{'endpoint': '/run/clamav/clamd1.ctl', 'up': True, 'outstanding': 0, 'scans': 1, 'failures': 0}, ...]
+    """
+
+    def __init__(self, endpoints, timeout=None, retry_interval=DEFAULT_RETRY_INTERVAL):
+        """
+        Initialize the ClamdBalancer class. Endpoints are connected when
+        first used.
+
+        Args:
+            endpoints (list): The clamd endpoints, see `connect_endpoint`.
+            timeout (float): Socket timeout in seconds, None for no timeout.
+            retry_interval (float): Seconds a failing endpoint stays out of rotation.
+
+        Raises:
+            ValueError: If no endpoint is given or an endpoint is invalid.
+        """
+        if not endpoints:
+            raise ValueError("at least one clamd endpoint is required")
+
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        families = {parse_endpoint(address)[0] for address in endpoints}
+        self._endpoints = [_Endpoint(address) for address in endpoints]
+        self._on_sent = None
+        self._lock = threading.Lock()
+        # file descriptors can only be passed when every daemon is local
+        self.family = families.pop() if len(families) == 1 else socket.AF_INET
+
+    @property
+    def on_sent(self):
+        """
+        callable: The hook passed on to the endpoint clients, see
+            `pyclamd._ClamdGeneric.on_sent`.
+        """
+        return self._on_sent
+
+    @on_sent.setter
+    def on_sent(self, hook):
+        self._on_sent = hook
+        for endpoint in self._endpoints:
+            if endpoint.client is not None:
+                endpoint.client.on_sent = hook
+
+    def __copy__(self):
+        # shared by the scanning threads, which copy their clamd client
+        return self
+
+    def ping(self):
+        """
+        PING every endpoint, taking the failing ones out of rotation and
+        bringing the others back.
+
+        Returns:
+            bool: True if at least one endpoint replies.
+
+        Raises:
+            pyclamd.ConnectionError: If no endpoint replies.
+        """
+        alive = [self._ping(endpoint) for endpoint in self._endpoints]
+        if not any(alive):
+            raise pyclamd.ConnectionError(
+                "Could not ping any clamd endpoint: "
+                + ", ".join(endpoint.address for endpoint in self._endpoints)
+            )
+        return True
+
+    def version(self):
+        """
+        Get the version of an available endpoint.
+
+        Returns:
+            str: The clamd version and signature database version.
+        """
+        return self._call(lambda client: client.version(), lambda: None)
+
+    def scan_stream(
+        self, stream, chunk_size=pyclamd.DEFAULT_CHUNK_SIZE, use_mmap=False
+    ):
+        """
+        Scan a buffer or file-like object with INSTREAM on the least busy endpoint.
+
+        Returns:
+            dict: {"stream": (status, reason)} or None if no virus is found.
+
+        Raises:
+            pyclamd.BufferTooLongError: If the stream exceeds clamd StreamMaxLength.
+            pyclamd.ConnectionError: If no endpoint could scan the stream.
+        """
+        rewind = None
+        if hasattr(stream, "seek"):
+            # the retry sends the stream from where the first attempt started
+            rewind = functools.partial(stream.seek, stream.tell())
+        elif not hasattr(stream, "read"):
+            # buffers are sent again as they are
+            rewind = _unchanged
+        return self._call(
+            lambda client: client.scan_stream(stream, chunk_size, use_mmap), rewind
+        )
+
+    def scan_fd(self, fd):
+        """
+        Scan an open file descriptor with FILDES on the least busy endpoint.
+
+        Returns:
+            dict: {"fd[N]": (status, reason)} or None if no virus is found.
+
+        Raises:
+            pyclamd.ConnectionError: If no endpoint could scan the file.
+        """
+        return self._call(
+            lambda client: client.scan_fd(fd), lambda: os.lseek(fd, 0, os.SEEK_SET)
+        )
+
+    def iter_multiscan(self, file):
+        """
+        Scan a file or folder with MULTISCAN on the least busy endpoint.
+
+        Yields:
+            tuple: (filename, status, reason) for every file clamd reports.
+        """
+        return self._iter(lambda client: client.iter_multiscan(file))
+
+    def iter_contscan(self, file):
+        """
+        Scan a file or folder with CONTSCAN on the least busy endpoint.
+
+        Yields:
+            tuple: (filename, status, reason) for every file clamd reports.
+        """
+        return self._iter(lambda client: client.iter_contscan(file))
+
+    def iter_allmatchscan(self, file, max_pending=32):
+        """
+        Scan a file or folder with ALLMATCHSCAN on the least busy endpoint,
+        see `pyclamd._ClamdGeneric.iter_allmatchscan`.
+
+        Yields:
+            tuple: (filename, status, reason) for every match clamd reports.
+        """
+        return self._iter(lambda client: client.iter_allmatchscan(file, max_pending))
+
+    def session(self, max_pending=32):
+        """
+        Open an IDSESSION on the least busy endpoint. The session counts as
+        an outstanding request of the endpoint until it is closed.
+
+        Returns:
+            pyclamd.ClamdSession: The opened session.
+
+        Raises:
+            pyclamd.SessionRefusedError: If clamd does not accept IDSESSION.
+            pyclamd.ConnectionError: If no endpoint could be reached.
+        """
+        tried = set()
+        while True:
+            endpoint = self._acquire(tried)
+            try:
+                session = endpoint.client.session(max_pending)
+            except pyclamd.SessionRefusedError:
+                self._release(endpoint)
+                raise
+            except pyclamd.ConnectionError:
+                self._release(endpoint)
+                self._down(endpoint)
+                tried.add(endpoint)
+                continue
+            return _BalancedSession(session, functools.partial(self._release, endpoint))
+
+    def daemon_stats(self):
+        """
+        Run STATS on the endpoints in rotation.
+
+        Returns:
+            clamdstats.ClamdStats: The thread pools of all the daemons.
+
+        Raises:
+            pyclamd.ConnectionError: If no endpoint replies.
+        """
+        stats = []
+        now = time.monotonic()
+        for endpoint in self._endpoints:
+            if endpoint.client is None or endpoint.down_until > now:
+                continue
+            try:
+                stats.append(parse_stats(copy.copy(endpoint.client).stats()))
+            except pyclamd.ConnectionError:
+                self._down(endpoint)
+        if not stats:
+            raise pyclamd.ConnectionError("No clamd endpoint available")
+        return merge_stats(stats)
+
+    def stats(self):
+        """
+        Get the endpoint counters.
+
+        Returns:
+            list: The address, state, outstanding requests, scans and
+                failures of each endpoint.
+        """
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "endpoint": endpoint.address,
+                    "up": endpoint.down_until <= now,
+                    "outstanding": endpoint.outstanding,
+                    "scans": endpoint.scans,
+                    "failures": endpoint.failures,
+                }
+                for endpoint in self._endpoints
+            ]
+
+    def _call(self, scan, rewind=None):
+        """
+        Run a request on the least busy endpoint, retrying it on another
+        endpoint if the connection fails and the input can be rewound.
+        """
+        tried = set()
+        while True:
+            endpoint = self._acquire(tried)
+            try:
+                return scan(copy.copy(endpoint.client))
+            except pyclamd.ConnectionError:
+                self._down(endpoint)
+                if rewind is None:
+                    raise
+                tried.add(endpoint)
+                rewind()
+            finally:
+                self._release(endpoint)
+
+    def _iter(self, scan):
+        """
+        Run a streamed request on the least busy endpoint. It is not
+        retried, the results already yielded cannot be taken back.
+        """
+        endpoint = self._acquire(set())
+        try:
+            yield from scan(copy.copy(endpoint.client))
+        except pyclamd.ConnectionError:
+            self._down(endpoint)
+            raise
+        finally:
+            self._release(endpoint)
+
+    def _acquire(self, tried):
+        """
+        Pick the endpoint with the least outstanding requests, PINGing
+        first the endpoints due to come back in rotation.
+
+        Raises:
+            pyclamd.ConnectionError: If every endpoint is down or was tried.
+        """
+        due = []
+        with self._lock:
+            now = time.monotonic()
+            for endpoint in self._endpoints:
+                never_connected = endpoint.client is None and not endpoint.down_until
+                if endpoint not in tried and (
+                    never_connected or 0 < endpoint.down_until <= now
+                ):
+                    # keep the other threads from PINGing it at the same time
+                    endpoint.down_until = now + self.retry_interval
+                    due.append(endpoint)
+        for endpoint in due:
+            self._ping(endpoint)
+
+        with self._lock:
+            now = time.monotonic()
+            available = [
+                endpoint
+                for endpoint in self._endpoints
+                if endpoint not in tried
+                and endpoint.client is not None
+                and endpoint.down_until <= now
+            ]
+            if not available:
+                raise pyclamd.ConnectionError("No clamd endpoint available")
+
+            endpoint = min(available, key=lambda e: (e.outstanding, e.scans))
+            endpoint.outstanding += 1
+            endpoint.scans += 1
+            return endpoint
+
+    def _release(self, endpoint):
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    def _ping(self, endpoint):
+        try:
+            if endpoint.client is None:
+                endpoint.client = connect_endpoint(endpoint.address, self.timeout)
+                endpoint.client.on_sent = self.on_sent
+            copy.copy(endpoint.client).ping()
+        except pyclamd.ConnectionError:
+            self._down(endpoint)
+            return False
+        with self._lock:
+            endpoint.down_until = 0.0
+        return True
+
+    def _down(self, endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            endpoint.down_until = time.monotonic() + self.retry_interval
+
+
+class _BalancedSession:
+    """
+    A clamd session releasing its endpoint when closed.
+    """
+
+    def __init__(self, session, release):
+        self._session = session
+        self._release = release
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        try:
+            self._session.close()
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                release()
@@ -0,0 +1,201 @@
+import os
+import tarfile
+import threading
+
+# the batches stay well under the clamd defaults of StreamMaxLength (25M),
+# MaxScanSize (100M) and MaxFiles (10000): clamd stops unpacking an archive
+# over its limits and reports the rest clean
+DEFAULT_BATCH_FILE_SIZE = 64 * 1024
+DEFAULT_BATCH_MAX_FILES = 256
+DEFAULT_BATCH_MAX_BYTES = 8 * 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+def archive_size(size):
+    """
+    Get the bytes a file takes in a tar archive, header and padding included.
+
+    Args:
+        size (int): The file size.
+
+    Returns:
+        int: The size of its tar member.
+    """
+    return tarfile.BLOCKSIZE + -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+class TarStream:
+    """
+    A file-like object reading as a tar archive of files, generated as it
+    is read so that neither the archive nor its files are ever written to
+    disk or held whole in memory.
+
+    The members are named after their index, clamd only telling whether
+    the archive as a whole is infected. Files that cannot be opened or read
+    to the end are left out of `scanned` and listed in `failed`.
+
+    Example:
+        >>> archive = TarStream([Path("/srv/www/index.php"), Path("/srv/www/gone")])
+        >>> cd.scan_stream(archive)
+        >>> archive.scanned, archive.failed
+        ([PosixPath('/srv/www/index.php')], [PosixPath('/srv/www/gone')])
+    """
+
+    def __init__(self, files):
+        """
+        Initialize the TarStream class.
+
+        Args:
+            files (list): The pathlib.PosixPath of the files to archive.
+        """
+        self.files = files
+        self.scanned = []
+        self.failed = []
+        # bytes of the files read into the archive
+        self.bytes = 0
+        self._chunks = self._generate()
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        """
+        Read the next bytes of the archive.
+
+        Args:
+            size (int): Number of bytes to read, -1 for the whole archive.
+
+        Returns:
+            bytes: The bytes read, empty at the end of the archive.
+        """
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _generate(self):
+        for index, file in enumerate(self.files):
+            try:
+                f = open(str(file), "rb")
+            except OSError:
+                self.failed.append(file)
+                continue
+            with f:
+                size = os.fstat(f.fileno()).st_size
+                info = tarfile.TarInfo(str(index))
+                info.size = size
+                yield info.tobuf(tarfile.USTAR_FORMAT)
+
+                remaining = size
+                try:
+                    while remaining and (data := f.read(min(remaining, READ_SIZE))):
+                        remaining -= len(data)
+                        yield data
+                except OSError:
+                    pass
+                # the header announced size bytes, whatever could be read
+                yield bytes(remaining + -size % tarfile.BLOCKSIZE)
+                self.bytes += size - remaining
+                (self.failed if remaining else self.scanned).append(file)
+        yield bytes(2 * tarfile.BLOCKSIZE)
+
+
+class Batcher:
+    """
+    Group the small files to scan into batches, each sent to clamd as one
+    tar archive, and count the batches.
+
+    Example:
+        >>> batcher = Batcher(max_files=2)
+        >>> list(batcher.group([Path("small1"), Path("big"), Path("small2")]))
+        [[PosixPath('big')], [PosixPath('small1'), PosixPath('small2')]]
+    """
+
+    def __init__(
+        self,
+        file_size=DEFAULT_BATCH_FILE_SIZE,
+        max_files=DEFAULT_BATCH_MAX_FILES,
+        max_bytes=DEFAULT_BATCH_MAX_BYTES,
+    ):
+        """
+        Initialize the Batcher class.
+
+        Args:
+            file_size (int): Files up to this many bytes are batched.
+            max_files (int): Number of files of a batch.
+            max_bytes (int): Size of the archive of a batch.
+        """
+        self.file_size = file_size
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._batches = 0
+        self._files = 0
+        self._splits = 0
+        self._lock = threading.Lock()
+
+    def group(self, files):
+        """
+        Group files into batches, in walk order but for the small files
+        held until their batch is full.
+
+        Args:
+            files (iterable): The pathlib.PosixPath of the files to scan.
+
+        Yields:
+            list: A batch of small files, or a single file to scan on its own.
+        """
+        batch = []
+        size = 0
+        for file in files:
+            try:
+                file_size = file.stat().st_size
+            except OSError:
+                # scanned on its own, which reports the error
+                yield [file]
+                continue
+            if file_size > self.file_size:
+                yield [file]
+                continue
+
+            member_size = archive_size(file_size)
+            if batch and (
+                len(batch) >= self.max_files or size + member_size > self.max_bytes
+            ):
+                yield batch
+                batch = []
+                size = 0
+            batch.append(file)
+            size += member_size
+        if batch:
+            yield batch
+
+    def scanned(self, archive, split):
+        """
+        Count a batch sent to clamd.
+
+        Args:
+            archive (TarStream): The archive of the batch.
+            split (bool): The batch was not clean and is scanned again in halves.
+        """
+        with self._lock:
+            self._batches += 1
+            self._files += len(archive.scanned)
+            self._splits += split
+
+    def stats(self):
+        """
+        Get the batch counters.
+
+        Returns:
+            dict: The batches sent, the files they held and the batches split.
+        """
+        with self._lock:
+            return {
+                "batches": self._batches,
+                "files": self._files,
+                "splits": self._splits,
+            }
@@ -0,0 +1,249 @@
+import time
+import sqlite3
+import threading
+from . import utils
+
+DEFAULT_CACHE_MAX_ENTRIES = 1_000_000
+# pending writes committed at once
+COMMIT_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    db_version TEXT NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS results_used ON results (used);
+CREATE TABLE IF NOT EXISTS digests (
+    digest BLOB PRIMARY KEY,
+    status TEXT NOT NULL,
+    reason TEXT NOT NULL,
+    db_version TEXT NOT NULL,
+    used INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS digests_used ON digests (used);
+"""
+
+
+class ScanCache:
+    """
+    An on-disk cache of scan verdicts, keyed by the file identity and the
+    clamd signature database version.
+
+    A file is identified by (st_dev, st_ino, st_size, st_mtime_ns,
+    st_ctime_ns): any write, truncation, rename over or metadata change
+    gives it a new key. Verdicts can also be kept by content digest.
+    Entries of another database version are dropped when the cache is
+    opened.
+
+    Example:
+        >>> cache = ScanCache("/var/cache/pyclamav/results.db", cd.version())
+        >>> key = cache.key(path.stat())
+        >>> cache.get(key)
+        (True, None)
+        >>> cache.stats()
+        {'hits': 1, 'misses': 0, 'entries': 1}
+    """
+
+    def __init__(self, path, db_version, max_entries=DEFAULT_CACHE_MAX_ENTRIES):
+        """
+        Initialize the ScanCache class.
+
+        Args:
+            path (str): The SQLite database file.
+            db_version (str): The clamd VERSION reply, with the signature database version.
+            max_entries (int): Number of entries kept, least recently used are evicted.
+        """
+        utils.create_file_folder(path)
+        self.db_version = db_version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._used = int(time.time())
+        self._touched = []
+        self._touched_digests = []
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        for table in ("results", "digests"):
+            self._db.execute(
+                f"DELETE FROM {table} WHERE db_version != ?", (db_version,)
+            )
+        self._db.commit()
+
+    @staticmethod
+    def key(st):
+        """
+        Build the cache key of a file.
+
+        Args:
+            st (os.stat_result): The file stat.
+
+        Returns:
+            tuple: (dev, ino, size, mtime_ns, ctime_ns)
+        """
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def get(self, key):
+        """
+        Look up the verdict of a file.
+
+        Args:
+            key (tuple): The file key.
+
+        Returns:
+            tuple: (hit, result), result being the cached `scan_stream` value.
+        """
+        dev, ino, size, mtime_ns, ctime_ns = key
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size, mtime_ns, ctime_ns, status, reason, db_version"
+                " FROM results WHERE dev = ? AND ino = ?",
+                (dev, ino),
+            ).fetchone()
+            if (
+                row is None
+                or row[:3] != (size, mtime_ns, ctime_ns)
+                or row[5] != self.db_version
+            ):
+                self.misses += 1
+                return False, None
+
+            self.hits += 1
+            self._touched.append((self._used, dev, ino))
+            self._wrote()
+
+        return True, self._result(row[3], row[4])
+
+    def get_digest(self, digest):
+        """
+        Look up the verdict of a file content.
+
+        Args:
+            digest (bytes): The content digest.
+
+        Returns:
+            tuple: (hit, result), result being the cached `scan_stream` value.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, reason FROM digests WHERE digest = ?"
+                " AND db_version = ?",
+                (digest, self.db_version),
+            ).fetchone()
+            if row is None:
+                return False, None
+            self._touched_digests.append((self._used, digest))
+            self._wrote()
+        return True, self._result(*row)
+
+    def put(self, key, result):
+        """
+        Record the verdict of a file. Errors are not cached.
+
+        Args:
+            key (tuple): The file key, taken before the scan.
+            result (dict): The `scan_stream` value.
+        """
+        verdict = self._verdict(result)
+        if verdict is None:
+            return
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, *verdict, self.db_version, self._used),
+            )
+            self._wrote()
+
+    def put_digest(self, digest, result):
+        """
+        Record the verdict of a file content. Errors are not cached.
+
+        Args:
+            digest (bytes): The content digest.
+            result (dict): The `scan_stream` value.
+        """
+        verdict = self._verdict(result)
+        if verdict is None:
+            return
+
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+                (digest, *verdict, self.db_version, self._used),
+            )
+            self._wrote()
+
+    def close(self):
+        """
+        Write pending updates, evict the least recently used entries beyond
+        `max_entries` and close the database.
+        """
+        with self._lock:
+            self._flush()
+            self._db.execute(
+                "DELETE FROM results WHERE (dev, ino) IN ("
+                " SELECT dev, ino FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._db.execute(
+                "DELETE FROM digests WHERE digest IN ("
+                " SELECT digest FROM digests ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            self._db.commit()
+            self._db.close()
+
+    def stats(self):
+        """
+        Get the cache counters.
+
+        Returns:
+            dict: The hit, miss and entry counts.
+        """
+        with self._lock:
+            (entries,) = self._db.execute("SELECT COUNT(*) FROM results").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+    @staticmethod
+    def _verdict(result):
+        if not result:
+            return "OK", ""
+        status, reason = next(iter(result.values()))
+        if status != "FOUND":
+            return None
+        return status, reason
+
+    @staticmethod
+    def _result(status, reason):
+        if status == "OK":
+            return None
+        return {"stream": (status, reason)}
+
+    def _wrote(self):
+        self._writes += 1
+        if self._writes >= COMMIT_EVERY:
+            self._flush()
+
+    def _flush(self):
+        if self._touched:
+            self._db.executemany(
+                "UPDATE results SET used = ? WHERE dev = ? AND ino = ?", self._touched
+            )
+            self._touched = []
+        if self._touched_digests:
+            self._db.executemany(
+                "UPDATE digests SET used = ? WHERE digest = ?", self._touched_digests
+            )
+            self._touched_digests = []
+        self._db.commit()
+        self._writes = 0
@@ -0,0 +1,194 @@
+import re
+from typing import List
+from pydantic import BaseModel, Field
+
+_THREADS = re.compile(
+    r"live\s+(?P<live>\d+)\s+idle\s+(?P<idle>\d+)\s+max\s+(?P<max>\d+)"
+    r"(?:\s+idle-timeout\s+(?P<idle_timeout>\d+))?"
+)
+_QUEUE = re.compile(r"(?P<items>\d+)\s+items")
+_MEMORY = re.compile(r"(?P<name>[a-z_]+)\s+(?P<value>\S+)")
+
+
+class ThreadStats(BaseModel):
+    """
+    The THREADS line of a clamd thread pool.
+    """
+
+    live: int = Field(0, description="Threads alive")
+    idle: int = Field(0, description="Threads waiting for a job")
+    max: int = Field(0, description="MaxThreads")
+    idle_timeout: int | None = Field(None, description="IdleTimeout in seconds")
+
+    @property
+    def busy(self):
+        """
+        int: Threads running a job, never negative on an inconsistent
+            line reporting more idle than live threads.
+        """
+        return max(self.live - self.idle, 0)
+
+
+class QueueItem(BaseModel):
+    """
+    A job listed under the QUEUE line of a clamd thread pool.
+    """
+
+    command: str = Field(description="The clamd command")
+    seconds: float | None = Field(None, description="Time spent on the job")
+    detail: str = Field("", description="The rest of the line, e.g. the file")
+
+
+class PoolStats(BaseModel):
+    """
+    A clamd thread pool.
+    """
+
+    state: str = Field("", description="The STATE line, e.g. 'VALID PRIMARY'")
+    threads: ThreadStats = Field(ThreadStats(), description="The THREADS line")
+    queue_length: int = Field(0, description="Jobs waiting for a thread")
+    queue: List[QueueItem] = Field(list(), description="The jobs listed")
+
+
+class MemoryStats(BaseModel):
+    """
+    The MEMSTATS line, in megabytes, None for the figures clamd reports N/A.
+    """
+
+    heap: float | None = None
+    mmap: float | None = None
+    used: float | None = None
+    free: float | None = None
+    releasable: float | None = None
+    pools: int | None = None
+    pools_used: float | None = None
+    pools_total: float | None = None
+
+
+class ClamdStats(BaseModel):
+    """
+    The reply of the clamd STATS command.
+
+    Example:
+        >>> stats = parse_stats(cd.stats())
+        >>> stats.queue_length, stats.threads_idle, stats.threads_max
+        (0, 3, 12)
+    """
+
+    pools: List[PoolStats] = Field(list(), description="The thread pools")
+    memory: MemoryStats | None = Field(None, description="The MEMSTATS line")
+
+    @property
+    def queue_length(self):
+        """
+        int: Jobs waiting for a thread in all pools.
+        """
+        return sum(pool.queue_length for pool in self.pools)
+
+    @property
+    def threads_idle(self):
+        """
+        int: Idle threads in all pools.
+        """
+        return sum(pool.threads.idle for pool in self.pools)
+
+    @property
+    def threads_busy(self):
+        """
+        int: Threads running a job in all pools.
+        """
+        return sum(pool.threads.busy for pool in self.pools)
+
+    @property
+    def threads_max(self):
+        """
+        int: MaxThreads summed over all pools.
+        """
+        return sum(pool.threads.max for pool in self.pools)
+
+
+def parse_stats(text):
+    """
+    Parse the reply of the clamd STATS command.
+
+    Unknown lines are ignored, so replies of other clamd versions still
+    give the figures they share.
+
+    Args:
+        text (str): The multiline STATS reply.
+
+    Returns:
+        ClamdStats: The parsed statistics.
+    """
+    pools = []
+    memory = None
+    pool = None
+    in_queue = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line == "END":
+            in_queue = False
+            continue
+
+        key, _, value = line.partition(":")
+        value = value.strip()
+        if key == "STATE":
+            pool = PoolStats(state=value)
+            pools.append(pool)
+            in_queue = False
+        elif key == "THREADS" and pool is not None:
+            match = _THREADS.search(value)
+            if match:
+                pool.threads = ThreadStats(
+                    **{k: v for k, v in match.groupdict().items() if v is not None}
+                )
+        elif key == "QUEUE" and pool is not None:
+            match = _QUEUE.search(value)
+            if match:
+                pool.queue_length = int(match["items"])
+            in_queue = True
+        elif key == "MEMSTATS":
+            memory = MemoryStats(
+                **{
+                    match["name"]: _megabytes(match["value"])
+                    for match in _MEMORY.finditer(value)
+                    if match["name"] in MemoryStats.model_fields
+                }
+            )
+            in_queue = False
+        elif in_queue:
+            # the jobs are listed under QUEUE until the next section
+            pool.queue.append(_queue_item(line))
+    return ClamdStats(pools=pools, memory=memory)
+
+
+def merge_stats(stats):
+    """
+    Merge the statistics of several clamd daemons, their pools being
+    added up by the `ClamdStats` totals.
+
+    Args:
+        stats (list): The `ClamdStats` of each daemon.
+
+    Returns:
+        ClamdStats: The merged statistics, without memory figures.
+    """
+    return ClamdStats(pools=[pool for daemon in stats for pool in daemon.pools])
+
+
+def _queue_item(line):
+    command, _, rest = line.partition(" ")
+    seconds, _, detail = rest.strip().partition(" ")
+    try:
+        return QueueItem(command=command, seconds=float(seconds), detail=detail)
+    except ValueError:
+        return QueueItem(command=command, detail=rest.strip())
+
+
+def _megabytes(value):
+    if value == "N/A":
+        return None
+    try:
+        return float(value.rstrip("M"))
+    except ValueError:
+        return None
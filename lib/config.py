@@ -3,13 +3,27 @@ import json
 import datetime
 import argparse
 import dateparser
-from typing import List
+from typing import Dict, List, Literal
 from pydantic import BaseModel, Field, model_validator
 
 from pathlib import Path
 
+from .cache import DEFAULT_CACHE_MAX_ENTRIES
+from .dedup import DEFAULT_DEDUP_WORKERS
+from .batch import (
+    DEFAULT_BATCH_FILE_SIZE,
+    DEFAULT_BATCH_MAX_BYTES,
+    DEFAULT_BATCH_MAX_FILES,
+)
+from .metrics import DEFAULT_METRICS_INTERVAL
+from .timing import DEFAULT_SLOWEST
+from .pipeline import DEFAULT_WALK_QUEUE_DEPTH
+from .utils import SYMLINKS_FILES
+from .state import DEFAULT_INCREMENTAL_MARGIN, DEFAULT_STATE_FILENAME
+
 DEFAULT_CONFIG_FILE = "config.json"
 DEFAULT_MODIFIED_FILE_SINCE = "24h"
+DEFAULT_WORKERS = 1
 
 
 def parse_arg():
@@ -25,6 +39,12 @@ def parse_arg():
         'path/to/config.json'
         >>> args.modified_since
         '24h'
+        >>> args.workers
+        4
+        >>> args.incremental
+        False
+        >>> args.timings
+        False
         >>> args.verbose
         False
     """
@@ -45,6 +65,24 @@ def parse_arg():
         type=str,
         help="Scanning files modified within the last specified duration (e.g., 24h, 48h)",
     )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of files scanned in parallel",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="Scan files modified since the last successful scan of each folder",
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        default=False,
+        help="Time the phases of each file scan and report them at the end of the run",
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true", default=False, help="Verbose mode"
     )
@@ -69,6 +107,129 @@ class Config(BaseModel):
     modified_file_datetime: datetime.datetime | None = Field(
         None, description="File modified within the datetime"
     )
+    endpoints: List[str] = Field(
+        list(),
+        description="clamd unix sockets or host:port addresses to spread the scans over",
+    )
+    workers: int = Field(
+        DEFAULT_WORKERS, ge=1, description="Number of files scanned in parallel"
+    )
+    adaptive_workers: bool = Field(
+        False,
+        description="Adjust the files scanned in parallel, up to workers, to the clamd load",
+    )
+    parallel_folders: int | None = Field(
+        None,
+        ge=1,
+        description="Number of folders scanned at once, by default one per device",
+    )
+    folder_workers: Dict[str, int] = Field(
+        dict(), description="Number of files scanned in parallel in some folders"
+    )
+    multiscan: bool = Field(
+        False,
+        description="Let clamd walk the folders with MULTISCAN when scanning all files",
+    )
+    cache_file: str | None = Field(
+        None, description="SQLite file caching the scan verdicts between runs"
+    )
+    cache_max_entries: int = Field(
+        DEFAULT_CACHE_MAX_ENTRIES,
+        ge=1,
+        description="Number of verdicts kept in the cache",
+    )
+    dedup: bool = Field(
+        False, description="Send only one copy of identical files to clamd"
+    )
+    dedup_workers: int = Field(
+        DEFAULT_DEDUP_WORKERS, ge=1, description="Number of threads hashing files"
+    )
+    batch: bool = Field(
+        False, description="Send the small files to clamd as tar archives of many files"
+    )
+    batch_file_size: int = Field(
+        DEFAULT_BATCH_FILE_SIZE,
+        ge=0,
+        description="Files up to this many bytes are batched",
+    )
+    batch_max_files: int = Field(
+        DEFAULT_BATCH_MAX_FILES, ge=2, description="Number of files of a batch"
+    )
+    batch_max_bytes: int = Field(
+        DEFAULT_BATCH_MAX_BYTES, ge=1, description="Size of the archive of a batch"
+    )
+    exclude: List[str] = Field(
+        list(),
+        description="Globs, or regular expressions prefixed with 're:', of the folders and files to skip",
+    )
+    max_file_size: int | None = Field(
+        None, ge=0, description="Skip files larger than this many bytes"
+    )
+    min_file_size: int = Field(
+        0, ge=0, description="Skip files smaller than this many bytes"
+    )
+    include_extensions: List[str] = Field(
+        list(), description="Only scan files with these extensions"
+    )
+    exclude_extensions: List[str] = Field(
+        list(), description="Skip files with these extensions"
+    )
+    package_manifests: List[str] = Field(
+        list(),
+        description="Globs of dpkg md5sums manifests whose unchanged files are not scanned",
+    )
+    package_rpm: bool = Field(
+        False,
+        description="Do not scan the files unchanged since their rpm package was installed",
+    )
+    symlinks: Literal["skip", "files", "follow"] = Field(
+        SYMLINKS_FILES,
+        description="Ignore symlinks, follow symlinks to files only, or to folders too",
+    )
+    folder_symlinks: Dict[str, Literal["skip", "files", "follow"]] = Field(
+        dict(), description="Symlink policy of some folders, overriding symlinks"
+    )
+    one_file_system: bool = Field(
+        False, description="Do not walk into other filesystems than the folder's"
+    )
+    walk_queue_depth: int = Field(
+        DEFAULT_WALK_QUEUE_DEPTH,
+        ge=0,
+        description="Number of walked files queued ahead of the scan, 0 to walk and scan in one thread",
+    )
+    incremental: bool = Field(
+        False,
+        description="Scan files modified since the last successful scan of each folder",
+    )
+    incremental_margin: int = Field(
+        DEFAULT_INCREMENTAL_MARGIN,
+        ge=0,
+        description="Seconds subtracted from the incremental checkpoints",
+    )
+    state_file: str | None = Field(
+        None, description="JSON file keeping the incremental checkpoints"
+    )
+    metrics_file: str | None = Field(
+        None,
+        description="Prometheus textfile collector file the run metrics are written to",
+    )
+    metrics_interval: float = Field(
+        DEFAULT_METRICS_INTERVAL,
+        gt=0,
+        description="Seconds between two writes of the metrics file during the run",
+    )
+    timings: bool = Field(
+        False,
+        description="Time the phases of each file scan and report them at the end of the run",
+    )
+    timings_file: str | None = Field(
+        None, description="JSON file the timing report is written to"
+    )
+    timings_slowest: int = Field(
+        DEFAULT_SLOWEST,
+        ge=0,
+        description="Number of slowest files listed in the timing report",
+    )
     verbose: bool = Field(False, description="Verbose mode")
 
     @model_validator(mode="after")
@@ -81,7 +242,8 @@ class Config(BaseModel):
             >>> config.modified_file_datetime
             datetime.datetime(2023, 10, 1, 0, 0)
         """
-        self.modified_file_datetime = dateparser.parse(self.modified_file_since)
+        if self.modified_file_since:
+            self.modified_file_datetime = dateparser.parse(self.modified_file_since)
         return self
 
 
@@ -110,9 +272,28 @@ def load_config():
     if "log_folder" not in loaded_config:
         loaded_config["log_folder"] = os.path.join(Path.home(), ".pyclamav", "log")
 
+    if "state_file" not in loaded_config:
+        loaded_config["state_file"] = os.path.join(
+            Path.home(), ".pyclamav", DEFAULT_STATE_FILENAME
+        )
+
+    if "timings_file" not in loaded_config:
+        loaded_config["timings_file"] = os.path.join(
+            Path.home(), ".pyclamav", "timings.json"
+        )
+
     if args.modified_since:
         loaded_config["modified_file_since"] = args.modified_since
 
+    if args.workers:
+        loaded_config["workers"] = args.workers
+
+    if args.incremental:
+        loaded_config["incremental"] = args.incremental
+
+    if args.timings:
+        loaded_config["timings"] = args.timings
+
     if args.verbose:
         loaded_config["verbose"] = args.verbose
 
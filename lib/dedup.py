@@ -0,0 +1,177 @@
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_DEDUP_WORKERS = 4
+READ_SIZE = 1024 * 1024
+
+# outcomes of Dedup.claim
+SCAN = "scan"
+KNOWN = "known"
+WAITING = "waiting"
+
+
+def digest(path):
+    """
+    Hash the content of a file.
+
+    hashlib releases the GIL while hashing, so several files are hashed in
+    parallel by threads.
+
+    Args:
+        path (pathlib.PosixPath): The file.
+
+    Returns:
+        bytes: The 128 bits BLAKE2b digest, or None if the file cannot be read.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    buf = bytearray(READ_SIZE)
+    try:
+        with open(str(path), "rb") as f, memoryview(buf) as view:
+            while size := f.readinto(buf):
+                h.update(view[:size])
+    except OSError:
+        return None
+    return h.digest()
+
+
+class Dedup:
+    """
+    Deduplicate files by content so that only the first copy of identical
+    files is sent to clamd, the others getting its verdict.
+
+    Example:
+        >>> dedup = Dedup()
+        >>> for file, file_digest in dedup.hashed(files):
+        ...     state, result = dedup.claim(file, file_digest)
+        >>> dedup.resolve(first_copy, None)
+        ([PosixPath('copy')], [])
+    """
+
+    def __init__(self, workers=DEFAULT_DEDUP_WORKERS, cache=None):
+        """
+        Initialize the Dedup class.
+
+        Args:
+            workers (int): Number of threads hashing files.
+            cache (cache.ScanCache): Cache keeping the verdicts by digest
+                between runs, None to only deduplicate within the run.
+        """
+        self.workers = workers
+        self.cache = cache
+        self.hashed_files = 0
+        self.duplicates = 0
+        # digest -> verdict of the contents scanned during the run
+        self._verdicts = {}
+        # digest -> duplicates waiting for the verdict of the first copy
+        self._waiting = {}
+        # digest -> owner of the first copy in flight
+        self._owners = {}
+        # first copy in flight -> digest
+        self._first = {}
+        self._lock = threading.Lock()
+
+    def hashed(self, files):
+        """
+        Hash files in worker threads, keeping their order.
+
+        Args:
+            files (iterable): The files.
+
+        Yields:
+            tuple: (file, digest), digest being None for unreadable files.
+        """
+        in_flight = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for file in files:
+                in_flight.append((file, executor.submit(digest, file)))
+                if len(in_flight) > 2 * self.workers:
+                    file, future = in_flight.popleft()
+                    yield file, future.result()
+            while in_flight:
+                file, future = in_flight.popleft()
+                yield file, future.result()
+
+    def claim(self, file, file_digest, owner=None):
+        """
+        Tell what to do with a hashed file.
+
+        Only the files of the same owner wait for a copy being scanned, so
+        that folders scanned at once each log and return their own files.
+        A copy in flight for another owner is scanned again.
+
+        Args:
+            file (pathlib.PosixPath): The file.
+            file_digest (bytes): Its digest.
+            owner: The folder scan the file belongs to.
+
+        Returns:
+            tuple: (SCAN, None) for the first copy of a content, to send to clamd,
+                (KNOWN, result) for a content whose verdict is known,
+                (WAITING, None) for a duplicate of a copy being scanned,
+                handed back by `resolve`.
+        """
+        with self._lock:
+            self.hashed_files += 1
+            if file_digest is None:
+                return SCAN, None
+
+            if file_digest in self._verdicts:
+                self.duplicates += 1
+                return KNOWN, self._verdicts[file_digest]
+
+            if file_digest in self._waiting:
+                if self._owners[file_digest] is not owner:
+                    return SCAN, None
+                self.duplicates += 1
+                self._waiting[file_digest].append(file)
+                return WAITING, None
+
+            if self.cache is not None:
+                hit, result = self.cache.get_digest(file_digest)
+                if hit:
+                    self.duplicates += 1
+                    self._verdicts[file_digest] = result
+                    return KNOWN, result
+
+            self._waiting[file_digest] = []
+            self._owners[file_digest] = owner
+            self._first[file] = file_digest
+            return SCAN, None
+
+    def resolve(self, file, result):
+        """
+        Record the verdict of a scanned file.
+
+        Args:
+            file (pathlib.PosixPath): The scanned file.
+            result (dict): The `scan_stream` value.
+
+        Returns:
+            tuple: (duplicates, rescan), the duplicates sharing the verdict
+                and those to scan themselves because the first copy failed.
+        """
+        with self._lock:
+            file_digest = self._first.pop(file, None)
+            if file_digest is None:
+                return [], []
+
+            waiting = self._waiting.pop(file_digest)
+            del self._owners[file_digest]
+            if result and next(iter(result.values()))[0] == "ERROR":
+                return [], waiting
+
+            self._verdicts[file_digest] = result
+            if self.cache is not None:
+                self.cache.put_digest(file_digest, result)
+            return waiting, []
+
+    def stats(self):
+        """
+        Get the deduplication counters.
+
+        Returns:
+            dict: The hashed and duplicate file counts.
+        """
+        return {"hashed": self.hashed_files, "duplicates": self.duplicates}
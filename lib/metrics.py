@@ -0,0 +1,267 @@
+import os
+import time
+import bisect
+import threading
+from . import utils
+
+# seconds between two writes of the metrics file during a run
+DEFAULT_METRICS_INTERVAL = 60.0
+# upper bounds, in seconds, of the clamd round-trip time histogram buckets
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+# name -> (type, help) of the metrics written
+METRICS = {
+    "pyclamav_run_start_time_seconds": ("gauge", "Start time of the run"),
+    "pyclamav_last_write_time_seconds": ("gauge", "Time the metrics were written"),
+    "pyclamav_files_walked_total": ("counter", "Files found by the folder walks"),
+    "pyclamav_files_skipped_total": ("counter", "Entries skipped by a walk rule"),
+    "pyclamav_bytes_skipped_total": ("counter", "Bytes skipped by a walk rule"),
+    "pyclamav_files_scanned_total": ("counter", "Files sent to clamd"),
+    "pyclamav_bytes_scanned_total": ("counter", "Bytes of the files sent to clamd"),
+    "pyclamav_verdicts_total": (
+        "counter",
+        "Files with a verdict, from clamd, the cache or a duplicate",
+    ),
+    "pyclamav_errors_total": ("counter", "Errors by type"),
+    "pyclamav_clamd_request_seconds": (
+        "histogram",
+        "Round-trip time of the clamd scan requests",
+    ),
+    "pyclamav_cache_hits_total": ("counter", "Files found in the verdict cache"),
+    "pyclamav_cache_misses_total": ("counter", "Files missing from the verdict cache"),
+    "pyclamav_dedup_duplicates_total": (
+        "counter",
+        "Files getting the verdict of an identical file",
+    ),
+    "pyclamav_batches_total": ("counter", "Archives of small files sent to clamd"),
+    "pyclamav_batch_splits_total": (
+        "counter",
+        "Archives of small files not clean, scanned again in halves",
+    ),
+    "pyclamav_clamd_queue_length": ("gauge", "Jobs waiting in the clamd queues"),
+    "pyclamav_clamd_threads": ("gauge", "clamd threads by state"),
+    "pyclamav_clamd_memory_megabytes": ("gauge", "clamd memory from STATS"),
+}
+
+
+class ScanMetrics:
+    """
+    Counters and latency histograms of a run, written in the Prometheus
+    text format to a node_exporter textfile collector file.
+
+    The file is replaced atomically at the end of the run and every
+    `interval` seconds during it, so the collector never reads it half
+    written.
+
+    Example:
+        >>> metrics = ScanMetrics("/var/lib/node_exporter/textfile/pyclamav.prom")
+        >>> metrics.inc("pyclamav_verdicts_total", result="clean")
+        >>> metrics.observe("pyclamav_clamd_request_seconds", 0.012, command="FILDES")
+        >>> metrics.write()
+    """
+
+    def __init__(self, path, interval=DEFAULT_METRICS_INTERVAL, collect=None):
+        """
+        Initialize the ScanMetrics class.
+
+        Args:
+            path (str): The .prom file.
+            interval (float): Seconds between two writes during the run.
+            collect (callable): Returns the (name, labels, value) samples
+                read at write time, e.g. the clamd STATS gauges.
+        """
+        self.path = path
+        self.interval = interval
+        self.collect = collect
+        self.started = time.time()
+        # (name, labels) -> value
+        self._counters = {}
+        # (name, labels) -> [count per bucket..., count, sum]
+        self._histograms = {}
+        # request key -> monotonic time it was sent, for pipelined requests
+        self._sent = {}
+        self._next_write = time.monotonic() + interval
+        self._writing = False
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """
+        Add to a counter.
+
+        Args:
+            name (str): The metric name.
+            value (int): The increment.
+            **labels: The metric labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Record a duration in a histogram.
+
+        Args:
+            name (str): The metric name.
+            seconds (float): The duration.
+            **labels: The metric labels.
+        """
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            if bucket < len(LATENCY_BUCKETS):
+                histogram[bucket] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def sent(self, key):
+        """
+        Record the time a pipelined request was sent.
+
+        Args:
+            key: Identifies the request until `received`.
+        """
+        with self._lock:
+            self._sent[key] = time.monotonic()
+
+    def received(self, key, command):
+        """
+        Record the round-trip time of a pipelined request.
+
+        Args:
+            key: The key given to `sent`.
+            command (str): The clamd command.
+        """
+        with self._lock:
+            sent = self._sent.pop(key, None)
+        if sent is not None:
+            self.observe(
+                "pyclamav_clamd_request_seconds",
+                time.monotonic() - sent,
+                command=command,
+            )
+
+    def forget(self, key):
+        """
+        Drop a pipelined request without recording it, e.g. when its
+        connection was lost.
+
+        Args:
+            key: The key given to `sent`.
+        """
+        with self._lock:
+            self._sent.pop(key, None)
+
+    def maybe_write(self):
+        """
+        Write the metrics file if `interval` seconds passed since the last
+        write. Cheap enough to be called for every file.
+        """
+        with self._lock:
+            if self._writing or time.monotonic() < self._next_write:
+                return
+            self._writing = True
+        try:
+            self.write()
+        finally:
+            with self._lock:
+                self._writing = False
+                self._next_write = time.monotonic() + self.interval
+
+    def write(self):
+        """
+        Write the metrics file atomically.
+        """
+        text = self.render()
+        utils.create_file_folder(self.path)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path)
+
+    def render(self):
+        """
+        Get the metrics in the Prometheus text format.
+
+        Returns:
+            str: The exposition text.
+        """
+        samples = {}
+        for (name, labels), value in self._snapshot_counters():
+            samples.setdefault(name, []).append((name, labels, value))
+        for (name, labels), histogram in self._snapshot_histograms():
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, histogram):
+                cumulative += count
+                lines.append((f"{name}_bucket", labels + (("le", bound),), cumulative))
+            lines.append((f"{name}_bucket", labels + (("le", "+Inf"),), histogram[-2]))
+            lines.append((f"{name}_count", labels, histogram[-2]))
+            lines.append((f"{name}_sum", labels, histogram[-1]))
+        if self.collect is not None:
+            for name, labels, value in self.collect():
+                samples.setdefault(name, []).append(
+                    (name, tuple(sorted(labels.items())), value)
+                )
+        samples["pyclamav_run_start_time_seconds"] = [
+            ("pyclamav_run_start_time_seconds", (), self.started)
+        ]
+        samples["pyclamav_last_write_time_seconds"] = [
+            ("pyclamav_last_write_time_seconds", (), time.time())
+        ]
+
+        out = []
+        for name in sorted(samples):
+            kind, description = METRICS.get(name, ("untyped", name))
+            out.append(f"# HELP {name} {description}\n")
+            out.append(f"# TYPE {name} {kind}\n")
+            for sample, labels, value in samples[name]:
+                out.append(f"{sample}{_labels(labels)} {_value(value)}\n")
+        return "".join(out)
+
+    def _snapshot_counters(self):
+        with self._lock:
+            return sorted(self._counters.items())
+
+    def _snapshot_histograms(self):
+        with self._lock:
+            return sorted(
+                (key, list(histogram)) for key, histogram in self._histograms.items()
+            )
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
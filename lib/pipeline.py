@@ -0,0 +1,140 @@
+import time
+import queue
+import threading
+
+DEFAULT_WALK_QUEUE_DEPTH = 1024
+# how often blocked walkers check whether the pipeline was closed
+STOP_POLL_INTERVAL = 0.1
+
+# marks the end of one walk in the queue
+_DONE = object()
+
+
+class _Failed:
+    def __init__(self, error):
+        self.error = error
+
+
+class WalkPipeline:
+    """
+    Run folder walks in threads feeding a bounded queue, so directory
+    listing overlaps with scanning.
+
+    When the queue is full the walkers block, which keeps the memory flat
+    on huge trees. The time the scan stage waits for the walkers and the
+    time the walkers wait for a free slot tell whether a run is walk-bound
+    or clamd-bound.
+
+    Example:
+        >>> pipeline = WalkPipeline([utils.iterate_folder("/var/www")])
+        >>> for path, st in pipeline:
+        ...     scan(path)
+        >>> pipeline.stats()
+        {'files': 1200, 'walk_wait': 0.4, 'scan_wait': 12.8, 'max_depth': 1024, 'mean_depth': 1011.2}
+    """
+
+    def __init__(self, walks, depth=DEFAULT_WALK_QUEUE_DEPTH):
+        """
+        Initialize the WalkPipeline class and start one thread per walk.
+
+        Args:
+            walks (list): Iterables of files, each consumed by its own thread.
+            depth (int): Number of files queued before the walkers block.
+        """
+        self.files = 0
+        self.walk_wait = 0.0
+        self.scan_wait = 0.0
+        self.max_depth = 0
+        self._depth_total = 0
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._walk, args=(walk,), daemon=True)
+            for walk in walks
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def __iter__(self):
+        """
+        Yield the walked files as the walkers queue them.
+
+        Raises:
+            Exception: The error raised by a walker.
+        """
+        running = len(self._threads)
+        try:
+            while running:
+                depth = self._queue.qsize()
+                self.max_depth = max(self.max_depth, depth)
+                self._depth_total += depth
+
+                start = time.perf_counter()
+                item = self._queue.get()
+                self.walk_wait += time.perf_counter() - start
+
+                if item is _DONE:
+                    running -= 1
+                elif isinstance(item, _Failed):
+                    raise item.error
+                else:
+                    self.files += 1
+                    yield item
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the walkers and wait for them.
+        """
+        self._stop.set()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """
+        Get the pipeline counters.
+
+        Returns:
+            dict: The files walked, the seconds the scan stage waited for the
+                walkers and the walkers for the scan stage, the maximum and
+                mean queue depth.
+        """
+        with self._lock:
+            scan_wait = self.scan_wait
+        gets = self.files + len(self._threads)
+        return {
+            "files": self.files,
+            "walk_wait": round(self.walk_wait, 3),
+            "scan_wait": round(scan_wait, 3),
+            "max_depth": self.max_depth,
+            "mean_depth": round(self._depth_total / gets, 1) if gets else 0,
+        }
+
+    def _walk(self, walk):
+        try:
+            for item in walk:
+                if not self._put(item):
+                    return
+        except Exception as e:
+            self._put(_Failed(e))
+        finally:
+            self._put(_DONE)
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=STOP_POLL_INTERVAL)
+            except queue.Full:
+                continue
+            with self._lock:
+                self.scan_wait += time.perf_counter() - start
+            return True
+        return False
@@ -0,0 +1,222 @@
+import time
+import threading
+from contextlib import contextmanager
+from . import pyclamd
+
+DEFAULT_POOL_SIZE = 4
+# clamd closes sessions idle for more than IdleTimeout (30s by default)
+DEFAULT_IDLE_TIMEOUT = 20.0
+# sessions idle for less are reused without a PING, a scan failing on a
+# broken one is retried by the caller on a fresh session
+DEFAULT_CHECK_AFTER = 1.0
+
+
+class ClamdPool:
+    """
+    A thread-safe pool of persistent clamd sessions.
+
+    Example:
+        >>> pool = ClamdPool(pyclamd.ClamdUnixSocket(), size=4)
+        >>> with pool.connection() as session:
+        ...     session.scan_stream(b"data")
+        >>> pool.stats()
+        {'size': 4, 'created': 1, 'checked_out': 0, 'waiting': 0, 'idle': 1, 'discarded': 0}
+    """
+
+    def __init__(
+        self,
+        clamd,
+        size=DEFAULT_POOL_SIZE,
+        idle_timeout=DEFAULT_IDLE_TIMEOUT,
+        check_after=DEFAULT_CHECK_AFTER,
+    ):
+        """
+        Initialize the ClamdPool class.
+
+        Args:
+            clamd (pyclamd._ClamdGeneric): The clamd client used to open sessions.
+            size (int): The maximum number of open sessions.
+            idle_timeout (float): Seconds after which an idle session is closed
+                instead of being reused.
+            check_after (float): Seconds from which an idle session is
+                PINGed before being reused.
+
+        Raises:
+            ValueError: If size is lower than 1.
+        """
+        if size < 1:
+            raise ValueError(f"pool size must be at least 1, got {size}")
+
+        self.clamd = clamd
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self.created = 0
+        self.discarded = 0
+        self.checked_out = 0
+        self.waiting = 0
+        # (session, last release time), most recently used last
+        self._idle = []
+        self._opening = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Check out a session, waiting for one to be released if the pool is full.
+
+        Sessions idle for more than `check_after` seconds are health-checked
+        with PING before being handed out, and sessions that fail it or have
+        been idle too long are closed.
+
+        Args:
+            timeout (float): Maximum seconds to wait for a session, None to wait forever.
+
+        Returns:
+            pyclamd.ClamdSession: The checked out session.
+
+        Raises:
+            pyclamd.ConnectionError: If no session could be opened or the wait timed out.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            session = None
+            with self._cond:
+                if self._closed:
+                    raise pyclamd.ConnectionError("clamd pool is closed")
+
+                self.waiting += 1
+                try:
+                    while not self._idle and self._total() >= self.size:
+                        remaining = None
+                        if deadline is not None:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                raise pyclamd.ConnectionError(
+                                    "timed out waiting for a clamd connection"
+                                )
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+                if self._idle:
+                    session, last_used = self._idle.pop()
+                    idle = time.monotonic() - last_used
+                else:
+                    idle = 0.0
+                self._opening += 1
+
+            if session is not None:
+                if idle <= self.idle_timeout and (
+                    idle < self.check_after or self._healthy(session)
+                ):
+                    return self._checked_out(session)
+                self._discard(session)
+                continue
+
+            try:
+                session = self.clamd.session()
+            except pyclamd.ConnectionError:
+                with self._cond:
+                    self._opening -= 1
+                    self._cond.notify()
+                raise
+
+            with self._cond:
+                self.created += 1
+            return self._checked_out(session)
+
+    def release(self, session, broken=False):
+        """
+        Return a checked out session to the pool.
+
+        Args:
+            session (pyclamd.ClamdSession): The session.
+            broken (bool): Close the session instead of keeping it for reuse.
+        """
+        with self._cond:
+            self.checked_out -= 1
+            if not broken and not self._closed:
+                self._idle.append((session, time.monotonic()))
+                self._cond.notify()
+                return
+
+        self._discard(session, opening=False)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Check out a session for the duration of a with block.
+
+        The session is discarded if an exception is raised in the block.
+
+        Args:
+            timeout (float): Maximum seconds to wait for a session.
+
+        Yields:
+            pyclamd.ClamdSession: The checked out session.
+        """
+        session = self.acquire(timeout)
+        try:
+            yield session
+        except BaseException:
+            # the session may be left with unread replies, it can't be reused
+            self.release(session, broken=True)
+            raise
+        else:
+            self.release(session)
+
+    def close(self):
+        """
+        Close the idle sessions and refuse new checkouts.
+        """
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+
+        for session, _ in idle:
+            session.close()
+
+    def stats(self):
+        """
+        Get the pool counters.
+
+        Returns:
+            dict: The size, created, checked out, waiting, idle and discarded counts.
+        """
+        with self._cond:
+            return {
+                "size": self.size,
+                "created": self.created,
+                "checked_out": self.checked_out,
+                "waiting": self.waiting,
+                "idle": len(self._idle),
+                "discarded": self.discarded,
+            }
+
+    def _total(self):
+        return self.checked_out + self._opening + len(self._idle)
+
+    def _checked_out(self, session):
+        with self._cond:
+            self._opening -= 1
+            self.checked_out += 1
+        return session
+
+    def _healthy(self, session):
+        try:
+            return session.ping()
+        except pyclamd.ConnectionError:
+            return False
+
+    def _discard(self, session, opening=True):
+        try:
+            session.close()
+        except OSError:
+            pass
+        with self._cond:
+            if opening:
+                self._opening -= 1
+            self.discarded += 1
+            self._cond.notify()
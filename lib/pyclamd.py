@@ -60,8 +60,6 @@
 # TODO:
 # - improve tests for Win32 platform (avoid to write EICAR file to disk, or
 #   protect it somehow from on-access AV, inside a ZIP/GZip archive isn't enough)
-# - use SESSION/END commands to launch several scans in one session
-#   (for example provide session mode in a Clamd class)
 # - add support for RAWSCAN commands ?
 # ? Maybe use os.abspath to ensure scan_file uses absolute paths for files
 # ------------------------------------------------------------------------------
@@ -142,9 +140,16 @@ __version__ = "0.4.0"
 import os
 import sys
 import socket
+import mmap
+import stat
 import struct
 import base64
-import time
+import select
+
+# INSTREAM chunk size, large chunks keep the per-chunk overhead low
+DEFAULT_CHUNK_SIZE = 256 * 1024
+# bytes read at once from the clamd socket
+RECV_SIZE = 64 * 1024
 
 ############################################################################
 
@@ -157,6 +162,10 @@ class ConnectionError(socket.error):
     """Class for errors communication with clamd"""
 
 
+class SessionRefusedError(ConnectionError):
+    """Class for errors when clamd does not accept the IDSESSION command"""
+
+
 def isstr(s):
     return isinstance(s, str)
 
@@ -169,6 +178,10 @@ class _ClamdGeneric(object):
     Abstract class for clamd
     """
 
+    # called once a stream or file descriptor is sent, before waiting for
+    # its verdict, to time the two apart
+    on_sent = None
+
     def EICAR(self):
         """
         returns Eicar test string
@@ -312,25 +325,22 @@ class _ClamdGeneric(object):
         except socket.error:
             raise ConnectionError("Unable to scan {0}".format(file))
 
-        result = "..."
         dr = {}
-        while result:
-            try:
-                result = self._recv_response()
-            except socket.error:
-                raise ConnectionError("Unable to scan {0}".format(file))
-
-            if len(result) > 0:
+        try:
+            for result in self._iter_lines():
                 filename, reason, status = self._parse_response(result)
 
                 if status == "ERROR":
                     dr[filename] = ("ERROR", "{0}".format(reason))
-                    return dr
+                    break
 
                 elif status == "FOUND":
                     dr[filename] = ("FOUND", "{0}".format(reason))
+        except socket.error:
+            raise ConnectionError("Unable to scan {0}".format(file))
+        finally:
+            self._close_socket()
 
-        self._close_socket()
         if not dr:
             return None
         return dr
@@ -354,92 +364,105 @@ class _ClamdGeneric(object):
             "Wrong type for [file], should be a string [was {0}]".format(type(file))
         )
 
-        try:
-            self._init_socket()
-            self._send_command("MULTISCAN {0}".format(file))
-        except socket.error:
-            raise ConnectionError("Unable to scan {0}".format(file))
-
-        result = "..."
         dr = {}
-        while result:
-            try:
-                result = self._recv_response()
-            except socket.error:
-                raise ConnectionError("Unable to scan {0}".format(file))
-
-            if len(result) > 0:
-                for resline in result.splitlines():
-                    filename, reason, status = self._parse_response(resline)
-
-                    if status == "ERROR":
-                        dr[filename] = ("ERROR", "{0}".format(reason))
-
-                    elif status == "FOUND":
-                        dr[filename] = ("FOUND", "{0}".format(reason))
+        for filename, status, reason in self.iter_multiscan(file):
+            if status in ("ERROR", "FOUND"):
+                dr[filename] = (status, "{0}".format(reason))
 
-        self._close_socket()
         if not dr:
             return None
         return dr
 
-    def allmatchscan(self, file):
+    def iter_multiscan(self, file):
         """
-        Scan a file or directory given by filename and after finding a virus within a file, continues scanning for additional viruses.
+        Scan a file or directory given by filename using multiple threads and
+        yield the results as clamd sends them, so huge trees are reported
+        without keeping every result in memory.
+        Do not stop on error or virus found.
         Scan with archive support enabled.
 
-        file (string) : filename or directoy (MUST BE ABSOLUTE PATH !)
+        file (string): filename or directory (MUST BE ABSOLUTE PATH !)
 
-        return either :
-          - (dict): {filename1: [(FOUND', 'virusname1'), (FOUND', 'virusname2')], filename2:  [(FOUND', 'virusname1'), (FOUND', 'virusname3')]}
-          - None: if no virus found
+        yield: (filename, status, reason) for each line of the reply,
+               status being 'OK', 'FOUND' or 'ERROR'
 
-        May raise :
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return self._iter_scan("MULTISCAN", file)
+
+    def iter_contscan(self, file):
+        """
+        Scan a file or directory given by filename and yield the results as
+        clamd sends them.
+        Do not stop on error or virus found.
+        Scan with archive support enabled.
+
+        file (string): filename or directory (MUST BE ABSOLUTE PATH !)
+
+        yield: (filename, status, reason) for each line of the reply,
+               status being 'OK', 'FOUND' or 'ERROR'
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        return self._iter_scan("CONTSCAN", file)
+
+    def iter_allmatchscan(self, file, max_pending=32):
+        """
+        Scan a file or directory given by filename, looking for every virus
+        of each file, and yield the results as clamd sends them.
+        Scan with archive support enabled.
+
+        clamd stops an ALLMATCHSCAN of a directory at the first infected
+        file, so directories are walked here and their files sent one
+        command each through a single IDSESSION, or one connection per file
+        if clamd refuses the session.
+
+        file (string): filename or directory (MUST BE ABSOLUTE PATH !)
+        max_pending (int): files scanned at the same time in the session
+
+        yield: (filename, status, reason) for each line of the replies,
+               status being 'OK', 'FOUND' or 'ERROR'
+
+        May raise:
           - ConnectionError: in case of communication problem
-          - socket.timeout: if timeout has expired
         """
         assert isstr(file), (
             "Wrong type for [file], should be a string [was {0}]".format(type(file))
         )
 
-        dr = {}
-
-        if os.path.isdir(file):
-            for path, subdirs, files in os.walk(file):
-                for name in files:
-                    single_file_result = self.allmatchscan(os.path.join(path, name))
-                    if single_file_result:
-                        dr.update(single_file_result)
-
-        else:
-            try:
-                self._init_socket()
-                self._send_command("ALLMATCHSCAN {0}".format(file))
-            except socket.error:
-                raise ConnectionError("Unable to scan {0}".format(file))
+        if not os.path.isdir(file):
+            yield from self._iter_scan("ALLMATCHSCAN", file)
+            return
 
-            result = "..."
+        try:
+            session = self.session(max_pending)
+        except SessionRefusedError:
+            for path in _walk_files(file):
+                yield from self._iter_scan("ALLMATCHSCAN", path)
+            return
+        yield from session.iter_scan("ALLMATCHSCAN", _walk_files(file))
 
-            while result:
-                try:
-                    result = self._recv_response()
-                except socket.error:
-                    raise ConnectionError("Unable to scan {0}".format(file))
+    def allmatchscan(self, file):
+        """
+        Scan a file or directory given by filename and after finding a virus within a file, continues scanning for additional viruses.
+        Scan with archive support enabled.
 
-                if len(result) > 0:
-                    for resline in result.splitlines():
-                        filename, reason, status = self._parse_response(resline)
+        file (string) : filename or directoy (MUST BE ABSOLUTE PATH !)
 
-                        if status == "ERROR":
-                            if filename not in dr:
-                                dr[filename] = []
-                            dr[filename].append(("ERROR", "{0}".format(reason)))
+        return either :
+          - (dict): {filename1: [(FOUND', 'virusname1'), (FOUND', 'virusname2')], filename2:  [(FOUND', 'virusname1'), (FOUND', 'virusname3')]}
+          - None: if no virus found
 
-                        elif status == "FOUND":
-                            if filename not in dr:
-                                dr[filename] = []
-                            dr[filename].append(("FOUND", "{0}".format(reason)))
-            self._close_socket()
+        May raise :
+          - ConnectionError: in case of communication problem
+          - socket.timeout: if timeout has expired
+        """
+        dr = {}
+        for filename, status, reason in self.iter_allmatchscan(file):
+            if status in ("ERROR", "FOUND"):
+                dr.setdefault(filename, []).append((status, "{0}".format(reason)))
 
         if not dr:
             return None
@@ -460,47 +483,25 @@ class _ClamdGeneric(object):
         May raise:
           - ConnectionError: in case of communication problem
         """
-        assert isstr(file), (
-            "Wrong type for [file], should be a string [was {0}]".format(type(file))
-        )
-
-        try:
-            self._init_socket()
-            self._send_command("CONTSCAN {0}".format(file))
-        except socket.error:
-            raise ConnectionError("Unable to scan  {0}".format(file))
-
-        result = "..."
         dr = {}
-        while result:
-            try:
-                result = self._recv_response()
-            except socket.error:
-                raise ConnectionError("Unable to scan  {0}".format(file))
+        for filename, status, reason in self.iter_contscan(file):
+            if status in ("ERROR", "FOUND"):
+                dr[filename] = (status, "{0}".format(reason))
 
-            if len(result) > 0:
-                for resline in result.splitlines():
-                    filename, reason, status = self._parse_response(resline)
-
-                    if status == "ERROR":
-                        dr[filename] = ("ERROR", "{0}".format(reason))
-
-                    elif status == "FOUND":
-                        dr[filename] = ("FOUND", "{0}".format(reason))
-
-        self._close_socket()
         if not dr:
             return None
         return dr
 
-    def scan_stream(self, stream, chunk_size=4096):
+    def scan_stream(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=False):
         """
         Scan a buffer
 
         on Python2.X :
           - input (string): buffer to scan
         on Python3.X :
-          - input (bytes or bytearray): buffer to scan
+          - input (bytes, bytearray or memoryview): buffer to scan
+        chunk_size (int) : size of the INSTREAM chunks
+        use_mmap (bool) : map regular files in memory instead of reading them
 
         return either:
           - (dict): {filename1: "virusname"}
@@ -519,14 +520,14 @@ class _ClamdGeneric(object):
             )
         else:
             # Python3
-            assert hasattr(stream, "read") or isinstance(stream, (bytes, bytearray)), (
-                "Wrong type for [stream], should be bytes/bytearray/file-like [was {0}]".format(
+            assert hasattr(stream, "read") or isinstance(
+                stream, (bytes, bytearray, memoryview)
+            ), (
+                "Wrong type for [stream], should be bytes/bytearray/memoryview/file-like [was {0}]".format(
                     type(stream)
                 )
             )
 
-        is_file_like = hasattr(stream, "read")
-
         try:
             self._init_socket()
             self._send_command("INSTREAM")
@@ -534,55 +535,44 @@ class _ClamdGeneric(object):
         except socket.error:
             raise ConnectionError("Unable to scan stream")
 
-        if is_file_like:
-            while True:
-                chunk = stream.read(chunk_size)
-                if not chunk:
-                    break
-                size = struct.pack("!I", len(chunk))
-                try:
-                    self.clamd_socket.send(size)
-                    self.clamd_socket.send(chunk)
-                except socket.error:
-                    raise
-
-            # Terminating stream
-            self.clamd_socket.send(struct.pack("!I", 0))
-        else:
-            # bytearray
-            for n in range(1 + int(len(stream) / chunk_size)):
-                chunk = stream[n * chunk_size : (n + 1) * chunk_size]
-                size = struct.pack("!I", len(chunk))
-                try:
-                    self.clamd_socket.send(size)
-                    self.clamd_socket.send(chunk)
-                except socket.error:
-                    raise
-            else:
-                # Terminating stream
-                self.clamd_socket.send(struct.pack("!L", 0))
-
-        result = "..."
-        dr = {}
-        while result:
+        try:
+            _send_instream(self.clamd_socket, stream, chunk_size, use_mmap)
+            if self.on_sent is not None:
+                self.on_sent()
+        except socket.error:
+            # clamd closes the connection when StreamMaxLength is reached
             try:
                 result = self._recv_response()
             except socket.error:
-                raise ConnectionError("Unable to scan stream")
+                result = ""
+            self._close_socket()
+            if result == "INSTREAM size limit exceeded. ERROR":
+                raise BufferTooLongError(result)
+            raise ConnectionError("Unable to scan stream")
+
+        return self._recv_verdict("Unable to scan stream")
 
-            if len(result) > 0:
+    def _recv_verdict(self, error):
+        """
+        receive the reply to INSTREAM or FILDES and close the connection
+
+        return: (dict) {"stream": (status, reason)} or None if no virus is found
+        """
+        dr = {}
+        try:
+            for result in self._iter_lines():
                 if result == "INSTREAM size limit exceeded. ERROR":
                     raise BufferTooLongError(result)
 
                 filename, reason, status = self._parse_response(result)
 
-                if status == "ERROR":
-                    dr[filename] = ("ERROR", "{0}".format(reason))
-
-                elif status == "FOUND":
-                    dr[filename] = ("FOUND", "{0}".format(reason))
+                if status in ("ERROR", "FOUND"):
+                    dr[filename] = (status, "{0}".format(reason))
+        except socket.error:
+            raise ConnectionError(error)
+        finally:
+            self._close_socket()
 
-        self._close_socket()
         if not dr:
             return None
         return dr
@@ -593,7 +583,7 @@ class _ClamdGeneric(object):
         terminated strings, as python<->clamd has some problems with \0x00
         """
         try:
-            cmd = str.encode("n{0}\n".format(cmd))
+            cmd = "n{0}\n".format(cmd).encode(errors="surrogateescape")
         except UnicodeDecodeError:
             cmd = "n{0}\n".format(cmd)
         self.clamd_socket.send(cmd)
@@ -601,40 +591,70 @@ class _ClamdGeneric(object):
 
     def _recv_response(self):
         """
-        receive response from clamd and strip all whitespace characters
+        receive the next reply line of clamd, stripped of all whitespace
+        characters, "" once clamd closed the connection
         """
-        # If we connect too quickly
-        # sometimes we get a connection error
-        # so we retry
-        failed_count = 5
-        while True:
-            try:
-                data = self.clamd_socket.recv(4096)
-            except socket.error:
-                time.sleep(0.01)
-                failed_count -= 1
-                if failed_count == 0:
-                    raise
-            else:
-                break
+        return self._reader.readline()
+
+    def _iter_lines(self):
+        """
+        yield the reply lines of clamd until it closes the connection,
+        whatever the way they are split across recv calls
+        """
+        return iter(self._reader)
+
+    def _iter_scan(self, command, file):
+        """
+        send a path command and yield its reply lines as
+        (filename, status, reason) until clamd closes the connection
+        """
+        assert isstr(file), (
+            "Wrong type for [file], should be a string [was {0}]".format(type(file))
+        )
 
         try:
-            response = bytes.decode(data).strip()
-        except UnicodeDecodeError:
-            response = data.strip()
+            self._init_socket()
+            self._send_command("{0} {1}".format(command, file))
+        except socket.error:
+            raise ConnectionError("Unable to scan {0}".format(file))
 
-        return response
+        try:
+            for line in self._iter_lines():
+                filename, reason, status = self._parse_response(line)
+                yield filename, status, reason
+        except socket.error:
+            raise ConnectionError("Unable to scan {0}".format(file))
+        finally:
+            self._close_socket()
 
     def _recv_response_multiline(self):
         """
-        receive multiple line response from clamd and strip all whitespace characters
+        receive everything clamd sends until it closes the connection
         """
-        response = ""
-        c = "..."
-        while c != "":
-            c = self._recv_response()
-            response += "{0}\n".format(c)
-        return response
+        return self._reader.read_all()
+
+    def session(self, max_pending=32):
+        """
+        Open a persistent connection to clamd in IDSESSION mode
+
+        max_pending (int) : number of commands allowed in flight before
+                            waiting for replies
+
+        return: (ClamdSession) the opened session
+
+        May raise:
+          - SessionRefusedError: if clamd does not accept IDSESSION
+          - ConnectionError: in case of communication problem
+        """
+        return ClamdSession(self, max_pending=max_pending)
+
+    def _init_socket(self):
+        """
+        internal use only
+        """
+        self.clamd_socket = self._connect()
+        self._reader = _ReplyReader(self.clamd_socket)
+        return
 
     def _close_socket(self):
         """
@@ -647,32 +667,700 @@ class _ClamdGeneric(object):
         """
         parses responses for SCAN, CONTSCAN, MULTISCAN and STREAM commands.
         """
-        msg = msg.strip()
-        filename = msg.split(": ")[0]
-        left = msg.split(": ")[1:]
-        if isstr(left):
-            result = left
+        return parse_response(msg)
+
+
+def _decode(data):
+    """
+    decode and strip a reply line, the bytes of the filenames that are not
+    utf-8 being escaped so that they round-trip to the same path
+    """
+    return data.decode(errors="surrogateescape").strip()
+
+
+class _ReplyReader(object):
+    """
+    Buffered reader of the replies of clamd on one connection
+
+    Replies are split on the delimiter ending the commands, whatever the way
+    they are cut across recv calls. Every byte is searched once and the
+    buffer only keeps the incomplete reply between two reads, so reading
+    stays linear whatever the size of the output.
+    """
+
+    def __init__(self, sock, delimiter=b"\n"):
+        """
+        sock (socket) : connection to clamd
+        delimiter (bytes) : end of the replies, b"\n" for the n-prefixed
+                            commands and b"\0" for the z-prefixed ones
+        """
+        self.sock = sock
+        self.delimiter = delimiter
+        self.eof = False
+        self._buffer = bytearray()
+        # start of the replies not handed out yet
+        self._start = 0
+        # end of the data already searched for the delimiter
+        self._searched = 0
+
+    def __iter__(self):
+        while True:
+            reply = self.readline()
+            if not reply:
+                return
+            yield reply
+
+    def fill(self):
+        """
+        read once from the socket
+
+        return: False once clamd closed the connection
+
+        May raise:
+          - socket.error: in case of communication problem
+        """
+        if self._start:
+            # drop the replies handed out, only the incomplete one is moved
+            del self._buffer[: self._start]
+            self._searched -= self._start
+            self._start = 0
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self._buffer += data
+        return True
+
+    def next_reply(self):
+        """
+        return: the next complete reply already read, stripped of all
+                whitespace characters, or None if there is none
+        """
+        while True:
+            end = self._buffer.find(self.delimiter, self._searched)
+            if end < 0:
+                self._searched = len(self._buffer)
+                return None
+            reply = _decode(self._buffer[self._start : end])
+            self._start = self._searched = end + len(self.delimiter)
+            if reply:
+                return reply
+
+    def readline(self):
+        """
+        return: the next reply, "" once clamd closed the connection and
+                every reply was handed out
+
+        May raise:
+          - socket.error: in case of communication problem
+        """
+        while True:
+            reply = self.next_reply()
+            if reply is not None:
+                return reply
+            if self.eof or not self.fill():
+                return self._rest()
+
+    def read_all(self):
+        """
+        return: everything left until clamd closes the connection, e.g. the
+                multiline STATS reply
+
+        May raise:
+          - socket.error: in case of communication problem
+        """
+        while not self.eof and self.fill():
+            pass
+        return self._rest()
+
+    def _rest(self):
+        """
+        hand out what is left after the last delimiter
+        """
+        rest = _decode(self._buffer[self._start :])
+        self._start = self._searched = len(self._buffer)
+        return rest
+
+
+def _walk_files(folder):
+    """
+    yield the path of every file under folder, without following links
+    """
+    for path, subdirs, files in os.walk(folder):
+        for name in files:
+            yield os.path.join(path, name)
+
+
+def parse_response(msg):
+    """
+    parses responses for SCAN, CONTSCAN, MULTISCAN and STREAM commands.
+
+    return: (filename, reason, status)
+    """
+    filename, _, result = msg.strip().partition(": ")
+    if result == "OK":
+        return filename, "", "OK"
+
+    reason, _, status = result.rpartition(" ")
+    return filename, reason.strip(), status
+
+
+def _send_instream(sock, stream, chunk_size, use_mmap=False, pump=None):
+    """
+    sends a buffer or file-like object with the INSTREAM framing: each chunk
+    prefixed by its length, followed by the zero length terminator
+
+    Chunks are memoryview slices of the buffer, of the mapped file or of a
+    single buffer reused for every read, so nothing is copied per chunk.
+    pump is called after each chunk.
+    """
+    if hasattr(stream, "read") and use_mmap and _is_mappable(stream):
+        offset = stream.tell()
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                _send_buffer(sock, view, offset, chunk_size, pump)
+    elif hasattr(stream, "readinto"):
+        buf = bytearray(chunk_size)
+        with memoryview(buf) as view:
+            while True:
+                size = stream.readinto(buf)
+                if not size:
+                    break
+                with view[:size] as chunk:
+                    _send_chunk(sock, chunk)
+                if pump is not None:
+                    pump()
+    elif hasattr(stream, "read"):
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            _send_chunk(sock, chunk)
+            if pump is not None:
+                pump()
+    else:
+        with memoryview(stream) as view:
+            _send_buffer(sock, view, 0, chunk_size, pump)
+
+    # Terminating stream
+    sock.sendall(struct.pack("!I", 0))
+
+
+def _send_buffer(sock, view, offset, chunk_size, pump):
+    """
+    sends the INSTREAM chunks of a memoryview from offset
+    """
+    for n in range(offset, len(view), chunk_size):
+        with view[n : n + chunk_size] as chunk:
+            _send_chunk(sock, chunk)
+        if pump is not None:
+            pump()
+
+
+def _send_chunk(sock, chunk):
+    """
+    sends one INSTREAM chunk, its length header and payload in a single
+    system call when the platform has sendmsg
+    """
+    header = struct.pack("!I", len(chunk))
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(header)
+        sock.sendall(chunk)
+        return
+
+    sent = sock.sendmsg([header, chunk])
+    if sent < len(header):
+        sock.sendall(header[sent:])
+        sent = len(header)
+    if sent < len(header) + len(chunk):
+        sock.sendall(chunk[sent - len(header) :])
+
+
+def _send_fd(sock, fd):
+    """
+    sends a file descriptor as SCM_RIGHTS ancillary data of a one byte
+    message, as expected by the FILDES command
+    """
+    sock.sendmsg(
+        [b"\0"], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, struct.pack("i", fd))]
+    )
+
+
+def _is_mappable(stream):
+    """
+    tells whether a file-like object is a non-empty regular file
+    """
+    try:
+        st = os.fstat(stream.fileno())
+    except (AttributeError, OSError, ValueError):
+        return False
+    return stat.S_ISREG(st.st_mode) and st.st_size > stream.tell()
+
+
+############################################################################
+
+
+class ClamdSession(object):
+    """
+    Persistent connection to clamd in IDSESSION mode
+
+    Commands are sent back-to-back on the same socket without waiting for
+    each reply. clamd numbers its replies with the order in which the
+    commands were received, which is used to match every reply back to the
+    tag given when the command was sent.
+    """
+
+    def __init__(self, clamd, max_pending=32):
+        """
+        Session initialisation
+
+        clamd (_ClamdGeneric) : clamd object used to open the connection
+        max_pending (int) : number of commands allowed in flight before
+                            waiting for replies
+
+        May raise:
+          - SessionRefusedError: if clamd does not accept IDSESSION
+          - ConnectionError: in case of communication problem
+        """
+        assert isinstance(max_pending, int) and max_pending > 0, (
+            "Wrong value for [max_pending], should be a positive int [was {0}]".format(
+                max_pending
+            )
+        )
+
+        self.clamd = clamd
+        self.max_pending = max_pending
+        # request id -> tag of the pipelined streams waiting for a reply
+        self.pending = {}
+        self._next_id = 1
+        # (tag, reply) of the pipelined streams, not yet handed out
+        self._done = []
+        # request id -> reply of the commands waited for, None until received
+        self._replies = {}
+
+        self.clamd_socket = clamd._connect()
+        self._reader = _ReplyReader(self.clamd_socket)
+        try:
+            self._send_command("IDSESSION")
+            result = self._command("PING")
+        except (socket.error, ConnectionError):
+            self._close_socket()
+            raise SessionRefusedError("clamd refused the IDSESSION command")
+
+        if result != "PONG":
+            self._close_socket()
+            raise SessionRefusedError(
+                "clamd refused the IDSESSION command [{0}]".format(result)
+            )
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def ping(self):
+        """
+        Send a PING inside the session
+
+        return: True if the server replies to PING
+
+        May raise:
+          - ConnectionError: if the server do not reply by PONG
+        """
+        try:
+            result = self._command("PING")
+        except socket.error:
+            raise ConnectionError("Could not ping clamd server")
+
+        if result == "PONG":
+            return True
+        raise ConnectionError("Could not ping clamd server [{0}]".format(result))
+
+    def version(self):
+        """
+        Get Clamscan version inside the session
+
+        return: (string) clamscan version
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        try:
+            return self._command("VERSION")
+        except socket.error:
+            raise ConnectionError("Could not get version information from server")
+
+    def scan_stream(self, stream, chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=False):
+        """
+        Scan a buffer or file-like object and wait for its result
+
+        return either:
+          - (dict): {"stream": ("FOUND", "virusname")}
+          - None: if no virus found
+
+        May raise :
+          - BufferTooLongError: if the buffer size exceeds clamd limits
+          - ConnectionError: in case of communication problem
+        """
+        request_id = self._send_stream(stream, chunk_size, use_mmap)
+        result = self._wait_for(request_id)
+        if result == "INSTREAM size limit exceeded. ERROR":
+            raise BufferTooLongError(result)
+        return self._stream_result(result)
+
+    def scan_fd(self, fd):
+        """
+        Scan an open file descriptor with FILDES and wait for its result,
+        only available on unix sockets
+
+        return either:
+          - (dict): {"fd[N]": ("FOUND", "virusname")}
+          - None: if no virus found
+
+        May raise :
+          - ConnectionError: in case of communication problem
+        """
+        return self._stream_result(self._wait_for(self._send_fd(fd)))
+
+    def send_fd(self, fd, tag=None):
+        """
+        Send an open file descriptor to scan with FILDES without waiting for
+        its result, only available on unix sockets. The descriptor can be
+        closed as soon as this returns.
+
+        tag : returned along the result to identify the scanned file
+
+        return: (list) [(tag, result), ...] for the scans completed so far
+
+        May raise :
+          - ConnectionError: in case of communication problem
+        """
+        while len(self.pending) >= self.max_pending:
+            self._read_replies(block=True)
+
+        self._send_fd(fd, tag=tag, wait=False)
+        return self._pop_done()
+
+    def send_stream(
+        self, stream, tag=None, chunk_size=DEFAULT_CHUNK_SIZE, use_mmap=False
+    ):
+        """
+        Send a buffer or file-like object to scan without waiting for its
+        result
+
+        tag : returned along the result to identify the scanned stream
+
+        return: (list) [(tag, result), ...] for the streams whose scan
+                completed so far, result being the same as scan_stream
+
+        May raise :
+          - ConnectionError: in case of communication problem
+        """
+        while len(self.pending) >= self.max_pending:
+            self._read_replies(block=True)
+
+        self._send_stream(stream, chunk_size, use_mmap, tag=tag, wait=False)
+        return self._pop_done()
+
+    def drain(self):
+        """
+        Wait for the result of every stream sent
+
+        return: (list) [(tag, result), ...]
+
+        May raise :
+          - ConnectionError: in case of communication problem
+        """
+        while self.pending:
+            self._read_replies(block=True)
+        return self._pop_done()
+
+    def completed(self):
+        """
+        Hand out the results received so far without waiting for the
+        others, e.g. to keep the verdicts clamd sent before the connection
+        was lost. The replies already in the socket buffer are read first.
+
+        return: (list) [(tag, result), ...]
+        """
+        try:
+            while self.pending and self.clamd_socket is not None:
+                readable, _, _ = select.select([self.clamd_socket], [], [], 0)
+                if not readable:
+                    break
+                self._read_replies(block=True)
+        except ConnectionError:
+            pass
+        return self._pop_done()
+
+    def iter_scan(self, command, files):
+        """
+        Send a path command (SCAN, CONTSCAN or ALLMATCHSCAN) for each file
+        without waiting for the replies, and yield the reply lines as they
+        come in.
+
+        clamd may send several lines for one command with nothing marking
+        the last one, so the session is ended once every command is sent
+        and read until clamd closes it: it cannot be used afterwards.
+
+        command (string) : the path command
+        files (iterable) : filenames (MUST BE ABSOLUTE PATHS !)
+
+        yield: (filename, status, reason) for each line of the replies,
+               status being 'OK', 'FOUND' or 'ERROR'
+
+        May raise:
+          - ConnectionError: in case of communication problem
+        """
+        try:
+            for file in files:
+                while len(self.pending) >= self.max_pending:
+                    if not self._receive(block=True):
+                        raise ConnectionError("clamd closed the session")
+                    yield from self._scan_lines()
+                self.pending[self._next_request_id()] = file
+                self._send_command("{0} {1}".format(command, file))
+                if not self._receive(block=False):
+                    raise ConnectionError("clamd closed the session")
+                yield from self._scan_lines()
+
+            self._send_command("END")
+            while self._receive(block=True):
+                yield from self._scan_lines()
+        except socket.error:
+            raise ConnectionError("Connection to clamd lost during session")
+        finally:
+            if self.clamd_socket is not None:
+                self._close_socket()
+
+        if self.pending:
+            raise ConnectionError("clamd closed the session")
+
+    def close(self):
+        """
+        End the session and close the connection
+        """
+        if self.clamd_socket is None:
+            return
+        try:
+            self._send_command("END")
+        except socket.error:
+            pass
+        self._close_socket()
+
+    def _send_command(self, cmd):
+        """
+        internal use only
+        """
+        self.clamd_socket.sendall("n{0}\n".format(cmd).encode(errors="surrogateescape"))
+
+    def _command(self, cmd):
+        """
+        send a command and wait for its reply
+        """
+        request_id = self._next_request_id()
+        self._replies[request_id] = None
+        self._send_command(cmd)
+        return self._wait_for(request_id)
+
+    def _send_stream(self, stream, chunk_size, use_mmap, tag=None, wait=True):
+        """
+        send an INSTREAM command, reading replies as they come in so clamd
+        never blocks on writing them
+        """
+        request_id = self._next_request_id()
+        if wait:
+            self._replies[request_id] = None
         else:
-            result = ": ".join(left)
+            self.pending[request_id] = tag
+        try:
+            self._send_command("INSTREAM")
+            _send_instream(
+                self.clamd_socket,
+                stream,
+                chunk_size,
+                use_mmap,
+                pump=lambda: self._read_replies(block=False),
+            )
+        except socket.error:
+            raise ConnectionError("Unable to scan stream")
+        if self.clamd.on_sent is not None:
+            self.clamd.on_sent()
+        return request_id
 
-        if result != "OK":
-            parts = result.split()
-            reason = " ".join(parts[:-1])
-            status = parts[-1]
+    def _send_fd(self, fd, tag=None, wait=True):
+        """
+        send a FILDES command and the file descriptor
+        """
+        assert self.clamd_socket.family == socket.AF_UNIX, (
+            "FILDES is only available on unix sockets"
+        )
+        request_id = self._next_request_id()
+        if wait:
+            self._replies[request_id] = None
         else:
-            reason, status = "", "OK"
+            self.pending[request_id] = tag
+        try:
+            self._send_command("FILDES")
+            _send_fd(self.clamd_socket, fd)
+        except socket.error:
+            raise ConnectionError("Unable to scan fd {0}".format(fd))
+        if self.clamd.on_sent is not None:
+            self.clamd.on_sent()
+        return request_id
+
+    def _next_request_id(self):
+        """
+        allocate the id clamd will use in its reply
+        """
+        request_id = self._next_id
+        self._next_id += 1
+        return request_id
+
+    def _wait_for(self, request_id):
+        """
+        read replies until the one of request_id comes in
+        """
+        while self._replies[request_id] is None:
+            self._read_replies(block=True)
+        return self._replies.pop(request_id)
+
+    def _read_replies(self, block):
+        """
+        read available replies from the socket and move them to the done list
+        """
+        if not block:
+            readable, _, _ = select.select([self.clamd_socket], [], [], 0)
+            if not readable:
+                return
+
+        try:
+            if not self._reader.fill():
+                raise ConnectionError("clamd closed the session")
+        except ConnectionError:
+            raise
+        except socket.error:
+            raise ConnectionError("Connection to clamd lost during session")
+
+        while (line := self._reader.next_reply()) is not None:
+            rid, _, result = line.partition(": ")
+            try:
+                rid = int(rid)
+            except ValueError:
+                # clamd answers without an id when it rejects the session
+                raise ConnectionError(line)
+            if rid in self.pending:
+                self._done.append((self.pending.pop(rid), result))
+            elif rid in self._replies:
+                self._replies[rid] = result
+
+    def _receive(self, block):
+        """
+        read what clamd sent, if anything unless block
 
-        return filename, reason, status
+        return: False once clamd closed the connection
+        """
+        if not block:
+            readable, _, _ = select.select([self.clamd_socket], [], [], 0)
+            if not readable:
+                return True
+        try:
+            return self._reader.fill()
+        except socket.error:
+            raise ConnectionError("Connection to clamd lost during session")
+
+    def _scan_lines(self):
+        """
+        yield the complete reply lines of the path commands read so far
+        """
+        while (line := self._reader.next_reply()) is not None:
+            rid, _, result = line.partition(": ")
+            try:
+                rid = int(rid)
+            except ValueError:
+                # clamd answers without an id when it rejects the command
+                raise ConnectionError(line)
+            # several lines may come for one command, the first one is
+            # enough to know clamd is done reading it
+            self.pending.pop(rid, None)
+            filename, reason, status = self.clamd._parse_response(result)
+            yield filename, status, reason
+
+    def _pop_done(self):
+        """
+        hand out the results of the pipelined streams received so far
+        """
+        done = []
+        for tag, result in self._done:
+            if result == "INSTREAM size limit exceeded. ERROR":
+                result = "stream: INSTREAM size limit exceeded. ERROR"
+            done.append((tag, self._stream_result(result)))
+        self._done = []
+        return done
+
+    def _stream_result(self, result):
+        """
+        convert an INSTREAM reply to the scan_stream return value
+        """
+        filename, reason, status = self.clamd._parse_response(result)
+        if status in ("ERROR", "FOUND"):
+            return {filename: (status, "{0}".format(reason))}
+        return None
+
+    def _close_socket(self):
+        """
+        close clamd socket
+        """
+        self.clamd_socket.close()
+        self.clamd_socket = None
 
 
 ############################################################################
 
 
+def find_unix_socket():
+    """
+    Get the clamd unix socket filename from /etc/clamav/clamd.conf or /etc/clamd.conf
+
+    return: (string) unix socket filename
+
+    May raise:
+      - ConnectionError: if no clamd.conf or LocalSocket setting is found
+    """
+    for clamdpath in [
+        "/etc/clamav/clamd.conf",
+        "/etc/clamd.conf",
+        "/opt/homebrew/etc/clamav/clamd.conf",
+    ]:
+        if os.path.isfile(clamdpath):
+            break
+    else:
+        raise ConnectionError(
+            "Could not find clamd unix socket from /etc/clamav/clamd.conf or /etc/clamd.conf"
+        )
+
+    with open(clamdpath, "r") as conffile:
+        for line in conffile.readlines():
+            try:
+                if line.strip().split()[0] == "LocalSocket":
+                    return line.strip().split()[1]
+            except IndexError:
+                pass
+
+    raise ConnectionError(
+        "Could not find clamd unix socket from /etc/clamav/clamd.conf or /etc/clamd.conf"
+    )
+
+
 class ClamdUnixSocket(_ClamdGeneric):
     """
     Class for using clamd with an unix socket
     """
 
+    family = socket.AF_UNIX
+
     def __init__(self, filename=None, timeout=None):
         """
         Unix Socket Class initialisation
@@ -683,31 +1371,7 @@ class ClamdUnixSocket(_ClamdGeneric):
 
         # try to get unix socket from clamd.conf
         if filename is None:
-            for clamdpath in [
-                "/etc/clamav/clamd.conf",
-                "/etc/clamd.conf",
-                "/opt/homebrew/etc/clamav/clamd.conf",
-            ]:
-                if os.path.isfile(clamdpath):
-                    break
-            else:
-                raise ConnectionError(
-                    "Could not find clamd unix socket from /etc/clamav/clamd.conf or /etc/clamd.conf"
-                )
-
-            with open(clamdpath, "r") as conffile:
-                for line in conffile.readlines():
-                    try:
-                        if line.strip().split()[0] == "LocalSocket":
-                            filename = line.strip().split()[1]
-                            break
-                    except IndexError:
-                        pass
-
-                else:
-                    raise ConnectionError(
-                        "Could not find clamd unix socket from /etc/clamav/clamd.conf or /etc/clamd.conf"
-                    )
+            filename = find_unix_socket()
 
         assert isstr(filename), (
             "Wrong type for [file], should be a string [was {0}]".format(type(filename))
@@ -729,23 +1393,55 @@ class ClamdUnixSocket(_ClamdGeneric):
 
         return
 
-    def _init_socket(self):
+    def _connect(self):
         """
         internal use only
+
+        return: a new socket connected to clamd
         """
-        self.clamd_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        clamd_socket = socket.socket(self.family, socket.SOCK_STREAM)
         if self.timeout:
-            self.clamd_socket.settimeout(self.timeout)
+            clamd_socket.settimeout(self.timeout)
 
         try:
-            self.clamd_socket.connect(self.unix_socket)
+            clamd_socket.connect(self.unix_socket)
         except socket.error:
+            clamd_socket.close()
             raise ConnectionError(
                 "Could not reach clamd using unix socket ({0})".format(
                     (self.unix_socket)
                 )
             )
-        return
+        return clamd_socket
+
+    def scan_fd(self, fd):
+        """
+        Scan an open file descriptor with FILDES: the descriptor is passed to
+        clamd over the unix socket and clamd reads the file itself.
+
+        fd (int) : file descriptor, opened for reading
+
+        return either :
+          - (dict): {"fd[N]": ("FOUND", "virusname")}
+          - None: if no virus found
+
+        May raise :
+          - ConnectionError: in case of communication problem
+        """
+        assert isinstance(fd, int), (
+            "Wrong type for [fd], should be an int [was {0}]".format(type(fd))
+        )
+
+        try:
+            self._init_socket()
+            self._send_command("FILDES")
+            _send_fd(self.clamd_socket, fd)
+        except socket.error:
+            raise ConnectionError("Unable to scan fd {0}".format(fd))
+        if self.on_sent is not None:
+            self.on_sent()
+
+        return self._recv_verdict("Unable to scan fd {0}".format(fd))
 
 
 ############################################################################
@@ -756,6 +1452,8 @@ class ClamdNetworkSocket(_ClamdGeneric):
     Class for using clamd with a network socket
     """
 
+    family = socket.AF_INET
+
     def __init__(self, host="127.0.0.1", port=3310, timeout=None):
         """
         Network Class initialisation
@@ -788,23 +1486,30 @@ class ClamdNetworkSocket(_ClamdGeneric):
 
         return
 
-    def _init_socket(self):
+    def _connect(self):
         """
         internal use only
+
+        return: a new socket connected to clamd
         """
-        self.clamd_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        clamd_socket = socket.socket(self.family, socket.SOCK_STREAM)
         if self.timeout:
-            self.clamd_socket.settimeout(self.timeout)
+            clamd_socket.settimeout(self.timeout)
         try:
-            self.clamd_socket.connect((self.host, self.port))
+            clamd_socket.connect((self.host, self.port))
         except socket.error:
+            clamd_socket.close()
             raise ConnectionError(
                 "Could not reach clamd using network ({0}, {1})".format(
                     self.host, self.port
                 )
             )
 
-        return
+        # the command, the INSTREAM chunks and the terminator are small
+        # writes: with Nagle each session request would wait for the
+        # delayed ACK of the previous one
+        clamd_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return clamd_socket
 
 
 ############################################################################
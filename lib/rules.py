@@ -0,0 +1,181 @@
+import re
+import fnmatch
+import threading
+
+# prefix of the exclude patterns that are regular expressions, not globs
+REGEX_PREFIX = "re:"
+
+
+class WalkRules:
+    """
+    Rules pruning folders and files during the walk, compiled once and
+    checked against the `os.DirEntry` data, with a count of the entries
+    and bytes each rule skipped.
+
+    Exclude patterns are globs, or regular expressions when prefixed with
+    "re:". Globs without "/" match the entry name (".git", "*.iso"), other
+    globs match the full path and regular expressions are searched in it.
+    An excluded folder is pruned without being listed.
+
+    Example:
+        >>> rules = WalkRules(exclude=[".git", "re:^/var/www/.*/cache/"], max_file_size=100)
+        >>> rules.prune_folder(".git", "/var/www/.git")
+        True
+        >>> rules.stats()
+        {'exclude': {'entries': 1, 'bytes': 0}}
+    """
+
+    def __init__(
+        self,
+        exclude=(),
+        max_file_size=None,
+        min_file_size=0,
+        include_extensions=(),
+        exclude_extensions=(),
+    ):
+        """
+        Initialize the WalkRules class.
+
+        Args:
+            exclude (list): Globs or "re:" regular expressions of the folders
+                and files to skip.
+            max_file_size (int): Files larger than this many bytes are
+                skipped, None for no limit.
+            min_file_size (int): Files smaller than this many bytes are skipped.
+            include_extensions (list): Only scan files with these extensions,
+                empty to scan every extension.
+            exclude_extensions (list): Skip files with these extensions.
+        """
+        names, paths, regexes = [], [], []
+        for pattern in exclude:
+            if pattern.startswith(REGEX_PREFIX):
+                regexes.append(pattern[len(REGEX_PREFIX) :])
+            elif "/" in pattern:
+                paths.append(fnmatch.translate(pattern))
+            else:
+                names.append(fnmatch.translate(pattern))
+        # one alternation per kind, so each entry costs at most three matches
+        self._names = self._compile(names)
+        self._paths = self._compile(paths)
+        self._regexes = self._compile(regexes)
+        self.max_file_size = max_file_size
+        self.min_file_size = min_file_size
+        self.include_extensions = frozenset(map(self._extension, include_extensions))
+        self.exclude_extensions = frozenset(map(self._extension, exclude_extensions))
+        self._skipped = {}
+        # folders can be walked from several threads at once
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """
+        bool: True if any rule is set.
+        """
+        return bool(
+            self._names
+            or self._paths
+            or self._regexes
+            or self.max_file_size is not None
+            or self.min_file_size
+            or self.include_extensions
+            or self.exclude_extensions
+        )
+
+    def prune_folder(self, name, path):
+        """
+        Tell whether a folder is skipped with its whole subtree.
+
+        Args:
+            name (str): The folder name.
+            path (str): The folder path.
+
+        Returns:
+            bool: True if the folder is excluded.
+        """
+        if self._excluded(name, path):
+            self.skip("exclude")
+            return True
+        return False
+
+    def skip_name(self, name, path):
+        """
+        Tell whether a file is skipped by its name, before it is stat'ed.
+
+        Args:
+            name (str): The file name.
+            path (str): The file path.
+
+        Returns:
+            bool: True if the file is excluded.
+        """
+        rule = None
+        if self._excluded(name, path):
+            rule = "exclude"
+        elif self.include_extensions or self.exclude_extensions:
+            ext = self._extension(name.rpartition(".")[2] if "." in name else "")
+            if self.include_extensions and ext not in self.include_extensions:
+                rule = "include_extensions"
+            elif ext in self.exclude_extensions:
+                rule = "exclude_extensions"
+        if rule is None:
+            return False
+        self.skip(rule)
+        return True
+
+    def skip_size(self, size):
+        """
+        Tell whether a file is skipped by its size.
+
+        Args:
+            size (int): The file size in bytes.
+
+        Returns:
+            bool: True if the file is too large or too small.
+        """
+        if self.max_file_size is not None and size > self.max_file_size:
+            self.skip("max_file_size", size)
+            return True
+        if size < self.min_file_size:
+            self.skip("min_file_size", size)
+            return True
+        return False
+
+    def skip(self, rule, size=0):
+        """
+        Count an entry skipped by a rule.
+
+        Args:
+            rule (str): The rule.
+            size (int): The entry size in bytes, 0 if it was not stat'ed.
+        """
+        with self._lock:
+            skipped = self._skipped.setdefault(rule, {"entries": 0, "bytes": 0})
+            skipped["entries"] += 1
+            skipped["bytes"] += size
+
+    def stats(self):
+        """
+        Get the skip counters.
+
+        Returns:
+            dict: The entries and bytes skipped by each rule.
+        """
+        with self._lock:
+            return {rule: dict(skipped) for rule, skipped in self._skipped.items()}
+
+    def _excluded(self, name, path):
+        return bool(
+            (self._names is not None and self._names.match(name))
+            or (self._paths is not None and self._paths.match(path))
+            or (self._regexes is not None and self._regexes.search(path))
+        )
+
+    @staticmethod
+    def _compile(patterns):
+        if not patterns:
+            return None
+        return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+
+    @staticmethod
+    def _extension(ext):
+        return ext.lower().lstrip(".")
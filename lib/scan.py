@@ -1,7 +1,30 @@
 import os
+import copy
+import stat
+import time
+import socket
+import threading
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from pathlib import Path
 from . import pyclamd
 from . import utils
+from . import dedup
+from . import batch
+from .adaptive import AdaptiveLimiter
+from .balancer import ClamdBalancer
+from .clamdstats import parse_stats
+from .cache import DEFAULT_CACHE_MAX_ENTRIES, ScanCache
+from .metrics import DEFAULT_METRICS_INTERVAL, ScanMetrics
+from .timing import DEFAULT_SLOWEST, PhaseTimer, TimedReader
+from .pipeline import DEFAULT_WALK_QUEUE_DEPTH, WalkPipeline
+from .pool import ClamdPool
+
+
+# metrics label of the verdict statuses
+VERDICTS = {"OK": "clean", "FOUND": "infected", "ERROR": "error"}
 
 
 class Scan:
@@ -9,40 +32,254 @@ class Scan:
     A class to scan files using ClamAV.
     """
 
-    def __init__(self, modified_since, logger):
+    def __init__(
+        self,
+        modified_since,
+        logger,
+        session=True,
+        workers=1,
+        fildes=True,
+        multiscan=False,
+        cache_file=None,
+        cache_max_entries=DEFAULT_CACHE_MAX_ENTRIES,
+        dedup_workers=0,
+        batch_max_files=0,
+        batch_file_size=batch.DEFAULT_BATCH_FILE_SIZE,
+        batch_max_bytes=batch.DEFAULT_BATCH_MAX_BYTES,
+        rules=None,
+        allowlist=None,
+        symlinks=utils.SYMLINKS_FILES,
+        folder_symlinks=None,
+        one_file_system=False,
+        walk_queue_depth=DEFAULT_WALK_QUEUE_DEPTH,
+        endpoints=None,
+        adaptive=False,
+        metrics_file=None,
+        metrics_interval=DEFAULT_METRICS_INTERVAL,
+        timings=False,
+        timings_file=None,
+        timings_slowest=DEFAULT_SLOWEST,
+        cd=None,
+    ):
         """
         Initialize the Scan class.
 
         Args:
             modified_since (datetime): The file to scan that have been modified since.
             logger (logging.Logger): The logger to use for logging scan results.
+            session (bool): Scan folders through one persistent clamd session
+                instead of one connection per file.
+            workers (int): Number of files scanned in parallel.
+            fildes (bool): Pass file descriptors to clamd with FILDES instead
+                of streaming the file content, when connected by unix socket.
+            multiscan (bool): Let clamd walk the folders with MULTISCAN when
+                all files are scanned (no `modified_since` nor pruning rules).
+            cache_file (str): SQLite file caching the verdicts between runs,
+                None to disable the cache.
+            cache_max_entries (int): Number of verdicts kept in the cache.
+            dedup_workers (int): Number of threads hashing file contents so
+                identical files are sent to clamd once, 0 to disable.
+            batch_max_files (int): Number of small files sent to clamd in one
+                tar archive, 0 to send every file on its own.
+            batch_file_size (int): Files up to this many bytes are batched.
+            batch_max_bytes (int): Size of the archive of a batch, to keep
+                under the clamd StreamMaxLength and MaxScanSize.
+            rules (rules.WalkRules): Rules pruning the folders and files
+                walked, None to scan everything.
+            allowlist (allowlist.PackageAllowlist): Files installed by the
+                package managers, not scanned while unchanged. None to scan
+                every file.
+            symlinks (str): Symlink policy of the walk, see `utils.iterate_folder`.
+            folder_symlinks (dict): Symlink policy of some folders, overriding
+                `symlinks`.
+            one_file_system (bool): Do not walk into other filesystems than
+                the one of the scanned folder.
+            walk_queue_depth (int): Number of walked files queued by the walker
+                thread ahead of the scan, 0 to walk in the scanning thread.
+            endpoints (list): clamd daemons to spread the scans over, see
+                `balancer.parse_endpoint`. None to connect to the local clamd
+                by unix socket or else by network socket.
+            adaptive (bool): Adjust the number of scans in flight, up to
+                `workers`, to the clamd load read from STATS.
+            metrics_file (str): Prometheus textfile collector file the run
+                metrics are written to, None to disable the metrics.
+            metrics_interval (float): Seconds between two writes of
+                `metrics_file` during the run.
+            timings (bool): Time the phases of each file scan and log a
+                report when the scanner is closed.
+            timings_file (str): JSON file the timing report is written to,
+                None to only log it.
+            timings_slowest (int): Number of slowest files in the report.
+            cd (pyclamd._ClamdGeneric): The clamd client to use, None to
+                connect to `endpoints` or the local clamd.
 
         Raises:
             ValueError: If unable to connect to the ClamAV daemon.
         """
         self.logger = logger
         self.modified_since = modified_since
-        try:
-            self.cd = pyclamd.ClamdUnixSocket()
-            self.cd.ping()
-        except pyclamd.ConnectionError:
+        self.session = session
+        self.workers = workers
+        self.multiscan = multiscan
+        self.rules = rules
+        self.allowlist = allowlist
+        self.symlinks = symlinks
+        self.folder_symlinks = {
+            os.path.abspath(folder): policy
+            for folder, policy in (folder_symlinks or {}).items()
+        }
+        self.one_file_system = one_file_system
+        # inodes of the hardlinked files walked, so each is scanned once
+        self._inodes = set()
+        self.walk_queue_depth = walk_queue_depth
+        # folders that could not be listed, the scanned one included
+        self.walk_errors = 0
+        self.root_unreadable = False
+        self._root = None
+        # pipeline counters of each folder walk
+        self._pipelines = []
+        self._local = threading.local()
+        if cd is not None:
+            self.cd = cd
+        elif endpoints:
+            self.cd = ClamdBalancer(endpoints)
             try:
-                self.cd = pyclamd.ClamdNetworkSocket()
+                self.cd.ping()
+            except pyclamd.ConnectionError as e:
+                raise ValueError(f"could not connect to clamd server: {e}")
+        else:
+            try:
+                self.cd = pyclamd.ClamdUnixSocket()
                 self.cd.ping()
             except pyclamd.ConnectionError:
-                raise ValueError(
-                    "could not connect to clamd server either by unix or network socket"
-                )
+                try:
+                    self.cd = pyclamd.ClamdNetworkSocket()
+                    self.cd.ping()
+                except pyclamd.ConnectionError:
+                    raise ValueError(
+                        "could not connect to clamd server either by unix or network socket"
+                    )
+        self.fildes = fildes and getattr(self.cd, "family", None) == socket.AF_UNIX
 
-    def scan_file(self, file):
+        self.limiter = None
+        if adaptive:
+            self.limiter = AdaptiveLimiter(
+                self._daemon_stats, maximum=workers, initial=max(1, workers // 2)
+            )
+
+        self.cache = None
+        # cache keys of the files being scanned, taken before the scan
+        self._keys = {}
+        if cache_file:
+            self.cache = ScanCache(cache_file, self.cd.version(), cache_max_entries)
+
+        self.dedup = None
+        if dedup_workers:
+            self.dedup = dedup.Dedup(workers=dedup_workers, cache=self.cache)
+
+        self.batcher = None
+        if batch_max_files:
+            self.batcher = batch.Batcher(
+                batch_file_size, batch_max_files, batch_max_bytes
+            )
+
+        self.metrics = None
+        if metrics_file:
+            self.metrics = ScanMetrics(
+                metrics_file, metrics_interval, collect=self._metric_samples
+            )
+
+        self.timer = None
+        self.timings_file = timings_file
+        if timings:
+            self.timer = PhaseTimer(timings_slowest)
+            self.cd.on_sent = self.timer.sent
+
+    def close(self):
         """
-        Scan a file.
+        Release the resources of the scanner and log the cache statistics.
+        """
+        if self.limiter is not None:
+            self.logger.info("Adaptive concurrency", extra=self.limiter.stats())
+        if isinstance(self.cd, ClamdBalancer):
+            self.logger.info("clamd endpoints", extra={"endpoints": self.cd.stats()})
+        if self._pipelines:
+            self.logger.info("Walk pipeline", extra=self.pipeline_stats())
+        if self.rules is not None:
+            self.logger.info("Walk pruning", extra={"skipped": self.rules.stats()})
+        if self.allowlist is not None:
+            self.logger.info("Package allowlist", extra=self.allowlist.stats())
+        if self.dedup is not None:
+            self.logger.info("Scan deduplication", extra=self.dedup.stats())
+        if self.batcher is not None:
+            self.logger.info("Scan batches", extra=self.batcher.stats())
+        if self.metrics is not None:
+            self.metrics.write()
+        if self.timer is not None:
+            report = self.timer.report()
+            self.logger.info("Scan timings", extra=report)
+            if self.timings_file:
+                self.timer.write(self.timings_file)
+        if self.cache is not None:
+            self.logger.info("Scan cache", extra=self.cache.stats())
+            self.cache.close()
+            self.cache = None
+
+    def for_folder(self, modified_since, workers):
+        """
+        Get a scanner for one folder, so that several folders are scanned
+        at once from different threads.
+
+        The folder scanner has its own clamd client and settings, and shares
+        the cache, the deduplication, the batch counters, the pruning rules,
+        the package allowlist and the statistics
+        with this scanner, which closes them.
+
+        Args:
+            modified_since (datetime): The files to scan in the folder have
+                been modified since.
+            workers (int): Number of files of the folder scanned in parallel.
+
+        Returns:
+            Scan: The folder scanner.
+        """
+        scanner = copy.copy(self)
+        scanner.cd = copy.copy(self.cd)
+        scanner._local = threading.local()
+        scanner.modified_since = modified_since
+        scanner.workers = workers
+        scanner.walk_errors = 0
+        scanner.root_unreadable = False
+        return scanner
+
+    def pipeline_stats(self):
+        """
+        Add up the walk pipeline counters of the folders scanned, the mean
+        depth being weighted by the files of each folder.
+
+        Returns:
+            dict: The `pipeline.WalkPipeline.stats` totals.
+        """
+        pipelines = list(self._pipelines)
+        files = sum(stats["files"] for stats in pipelines)
+        depth = sum(stats["mean_depth"] * stats["files"] for stats in pipelines)
+        return {
+            "files": files,
+            "walk_wait": round(sum(stats["walk_wait"] for stats in pipelines), 3),
+            "scan_wait": round(sum(stats["scan_wait"] for stats in pipelines), 3),
+            "max_depth": max((stats["max_depth"] for stats in pipelines), default=0),
+            "mean_depth": round(depth / files, 1) if files else 0,
+        }
+
+    def should_scan(self, file):
+        """
+        Check whether a file has to be scanned.
 
         Args:
             file (pathlib.PosixPath): The file.
 
         Returns:
-            bool: True if the file is infected, False otherwise.
+            bool: True if the file exists and was modified since `modified_since`.
         """
         filepath = str(file)
         self.logger.debug("Scanning file", extra={"file": filepath})
@@ -58,16 +295,26 @@ class Scan:
             )
             return False
 
-        with open(filepath, "rb") as f:
-            result = self.cd.scan_stream(f)
+        return True
 
-        if not result:
-            return False
+    def handle_result(self, file, result):
+        """
+        Log the result of a stream or file descriptor scan.
+
+        Args:
+            file (pathlib.PosixPath): The scanned file.
+            result (dict): The value returned by `scan_stream` or `scan_fd`.
 
-        if "stream" not in result:
+        Returns:
+            bool: True if the file is infected, False otherwise.
+        """
+        filepath = str(file)
+        if self.metrics is not None:
+            self._record_verdict(result)
+        if not result:
             return False
 
-        result, message = result["stream"]
+        result, message = next(iter(result.values()))
         if result == "ERROR":
             if "permission denied" in message.lower():
                 message = "Permission denied"
@@ -78,14 +325,193 @@ class Scan:
             )
             return True
         else:
-            self.logger.info(result, message)
+            self.logger.info(message, extra={"filepath": filepath, "status": result})
 
         return False
 
+    def scan_file(self, file):
+        """
+        Scan a file.
+
+        Args:
+            file (pathlib.PosixPath): The file.
+
+        Returns:
+            bool: True if the file is infected, False otherwise.
+        """
+        started = time.perf_counter()
+        if not self.should_scan(file):
+            return False
+
+        hit, infected = self._cached(file)
+        if hit:
+            return infected
+        if self.allowlist is not None and self._allowed(file, file.stat()):
+            return False
+
+        if self.timer is not None:
+            self.timer.add(file, "stat", time.perf_counter() - started)
+        return bool(self._finish(file, self._scan_with(self.cd, file)))
+
     def scan_folder(self, folder):
         """
         Scan all files in a directory recursively.
 
+        Args:
+            folder (str): The path to the directory.
+
+        Returns:
+            list: A list of scan results.
+        """
+        self._root = folder
+        if self.timer is None:
+            return self._scan_folder(folder)
+        with self.timer.folder(folder):
+            return self._scan_folder(folder)
+
+    def _scan_folder(self, folder):
+        # clamd walks the folder by itself, without the pruning rules nor
+        # the package allowlist
+        pruned = self.allowlist is not None or (
+            self.rules is not None and self.rules.enabled
+        )
+        if self.multiscan and not self.modified_since and not pruned:
+            results = self.scan_folder_multiscan(folder)
+            if results is not None:
+                return results
+
+        if self.workers > 1:
+            return self.scan_folder_concurrent(folder)
+
+        if self.session:
+            try:
+                return self.scan_folder_session(folder)
+            except pyclamd.SessionRefusedError:
+                self.logger.debug(
+                    "clamd refused IDSESSION, using one connection per file"
+                )
+                self.session = False
+
+        results = []
+        for filepath in self._candidates(folder, results):
+            results.extend(self._finish(filepath, self._scan_with(self.cd, filepath)))
+        return results
+
+    def scan_folder_session(self, folder):
+        """
+        Scan all files in a directory recursively, pipelining the files
+        through one clamd session.
+
+        Args:
+            folder (str): The path to the directory.
+
+        Returns:
+            list: A list of scan results.
+
+        Raises:
+            pyclamd.SessionRefusedError: If clamd does not accept sessions.
+        """
+        results = []
+        session = self.cd.session()
+        try:
+            for filepath in self._candidates(folder, results):
+                try:
+                    done = self._send_with(session, filepath)
+                except pyclamd.ConnectionError:
+                    done = self._recover_session(session, filepath)
+                    session = self.cd.session()
+                results.extend(self._collect(done))
+
+            try:
+                done = session.drain()
+            except pyclamd.ConnectionError:
+                done = self._recover_session(session)
+            results.extend(self._collect(done))
+        finally:
+            session.close()
+        return results
+
+    def scan_folder_multiscan(self, folder):
+        """
+        Scan all files in a directory recursively by letting clamd walk it
+        with MULTISCAN, logging the results as clamd sends them.
+
+        Files and folders clamd is not allowed to read are walked and
+        streamed to it instead.
+
+        Args:
+            folder (str): The path to the directory.
+
+        Returns:
+            list: A list of scan results, or None if clamd cannot see the
+                folder and it has to be streamed.
+        """
+        root = os.path.abspath(folder)
+        results = []
+        denied = []
+        for filename, status, reason in self.cd.iter_multiscan(root):
+            if status == "ERROR" and filename == root:
+                self.logger.debug(
+                    "clamd cannot access the folder, streaming its files",
+                    extra={"folder": folder, "reason": reason},
+                )
+                return None
+            if status == "OK":
+                continue
+            if status == "ERROR" and not self._clamd_readable(reason):
+                denied.append(Path(filename))
+                continue
+            if self.handle_result(filename, {filename: (status, reason)}):
+                results.append(Path(filename))
+
+        for path in denied:
+            results.extend(self._scan_denied(path))
+        return results
+
+    def _scan_denied(self, path):
+        """
+        Scan a file or folder clamd could not open during a MULTISCAN,
+        walking the folders and streaming their files to clamd.
+
+        Returns:
+            list: The infected files.
+        """
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            self.logger.warning(
+                "Cannot scan denied entry",
+                extra={"filepath": str(path), "reason": e.strerror},
+            )
+            return []
+
+        if stat.S_ISDIR(st.st_mode):
+            results = []
+            for filepath in self._candidates(str(path), results):
+                results.extend(
+                    self._finish(filepath, self._scan_with(self.cd, filepath))
+                )
+            return results
+        if stat.S_ISREG(st.st_mode):
+            return [path] if self.scan_file(path) else []
+        self.logger.debug("Skipping special file", extra={"filepath": str(path)})
+        return []
+
+    def _clamd_readable(self, reason):
+        """
+        Tell whether a MULTISCAN error is about the file content rather
+        than clamd not being able to open the file.
+        """
+        reason = reason.lower()
+        return "access denied" not in reason and "permission denied" not in reason
+
+    def scan_folder_concurrent(self, folder):
+        """
+        Scan all files in a directory recursively, `workers` files at a time.
+
+        Files are handed to the workers in walk order and their results are
+        logged in that same order.
+
         Args:
             folder (str): The path to the directory.
 
@@ -93,7 +519,453 @@ class Scan:
             list: A list of scan results.
         """
         results = []
-        for filepath in utils.iterate_folder(folder):
-            if self.scan_file(filepath):
-                results.append(filepath)
+        pool = ClamdPool(self.cd, size=self.workers)
+        if self.session:
+            try:
+                pool.release(pool.acquire())
+            except pyclamd.SessionRefusedError:
+                self.logger.debug(
+                    "clamd refused IDSESSION, using one connection per file"
+                )
+                self.session = False
+
+        in_flight = deque()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for filepath in self._candidates(folder, results):
+                    future = executor.submit(self._scan_pooled, filepath, pool)
+                    in_flight.append((filepath, future))
+                    # bound the queued files so huge trees keep a flat memory
+                    if len(in_flight) > 2 * self.workers:
+                        results.extend(self._collect_next(in_flight))
+
+                while in_flight:
+                    results.extend(self._collect_next(in_flight))
+        finally:
+            pool.close()
         return results
+
+    def _scan_pooled(self, file, pool):
+        """
+        Scan a file from a worker thread, once the adaptive limiter lets it.
+        """
+        if self.limiter is None:
+            return self._scan_in_pool(file, pool)
+        with self.limiter:
+            return self._scan_in_pool(file, pool)
+
+    def _scan_in_pool(self, file, pool):
+        """
+        Scan a file through a pooled session when clamd accepts them or a
+        per-thread client otherwise.
+        """
+        if not self.session:
+            if not hasattr(self._local, "cd"):
+                self._local.cd = copy.copy(self.cd)
+            return self._scan_with(self._local.cd, file)
+
+        try:
+            with pool.connection() as session:
+                return self._scan_with(session, file)
+        except pyclamd.ConnectionError:
+            # the session was discarded, retry once on a fresh one
+            with pool.connection() as session:
+                return self._scan_with(session, file)
+
+    def _daemon_stats(self):
+        """
+        Read the load of the clamd daemons for the adaptive limiter.
+        """
+        if isinstance(self.cd, ClamdBalancer):
+            return self.cd.daemon_stats()
+        return parse_stats(copy.copy(self.cd).stats())
+
+    def _scan_with(self, client, file):
+        """
+        Scan a file with a clamd client or session and wait for its result.
+        A file over the clamd StreamMaxLength gets an error result, as it
+        does in a pipelined session.
+        """
+        try:
+            f = self._open(file)
+        except OSError as e:
+            return self._open_error(file, e)
+        with f:
+            started = time.monotonic()
+            try:
+                with self._request(file):
+                    if self.fildes:
+                        result = client.scan_fd(f.fileno())
+                    else:
+                        result = client.scan_stream(self._reader(f, file))
+            except pyclamd.BufferTooLongError as e:
+                return self._too_long_error(e)
+            if self.metrics is not None:
+                self._record_request(f)
+                self.metrics.observe(
+                    "pyclamav_clamd_request_seconds",
+                    time.monotonic() - started,
+                    command=self._command,
+                )
+            return result
+
+    def _send_with(self, session, file):
+        """
+        Send a file to scan on a session without waiting for its result.
+        """
+        try:
+            f = self._open(file)
+        except OSError as e:
+            return [(file, self._open_error(file, e))]
+        with f:
+            if self.metrics is not None:
+                self._record_request(f)
+                self.metrics.sent(file)
+            with self._request(file, pipelined=True):
+                if self.fildes:
+                    return session.send_fd(f.fileno(), tag=file)
+                return session.send_stream(self._reader(f, file), tag=file)
+
+    def _open(self, file):
+        """
+        Open a file to scan, timing it when timings are on.
+        """
+        if self.timer is None:
+            return open(str(file), "rb")
+        started = time.perf_counter()
+        f = open(str(file), "rb")
+        self.timer.add(file, "open", time.perf_counter() - started)
+        self.timer.add(file, "size", os.fstat(f.fileno()).st_size)
+        return f
+
+    def _reader(self, f, file):
+        """
+        Get the stream to send, timing its reads when timings are on.
+        """
+        if self.timer is None:
+            return f
+        return TimedReader(f, file, self.timer)
+
+    def _request(self, file, pipelined=False):
+        """
+        Time a clamd request when timings are on.
+        """
+        if self.timer is None:
+            return contextlib.nullcontext()
+        return self.timer.request(file, pipelined)
+
+    def _too_long_error(self, error):
+        """
+        Get the error result of a stream over the clamd StreamMaxLength.
+        """
+        if self.metrics is not None:
+            self.metrics.inc("pyclamav_errors_total", type="stream_too_long")
+        _, reason, status = pyclamd.parse_response(f"stream: {error}")
+        return {"stream": (status, reason)}
+
+    def _open_error(self, file, error):
+        """
+        Get the error result of a file that cannot be opened, e.g. deleted
+        while it was queued, which is logged at debug level and not cached.
+        """
+        if self.metrics is not None:
+            self.metrics.inc("pyclamav_errors_total", type="open")
+        return {str(file): ("ERROR", error.strerror or str(error))}
+
+    def _collect_next(self, in_flight):
+        """
+        Wait for the oldest file in flight and log its result.
+        """
+        filepath, future = in_flight.popleft()
+        return self._finish(filepath, future.result())
+
+    def _recover_session(self, session, filepath=None):
+        """
+        Rescan, one connection per file, the files lost with a broken session.
+        """
+        # verdicts read before the failure, not handed out yet
+        done = session.completed()
+        received = {file for file, _ in done}
+        lost = list(session.pending.values())
+        if filepath is not None and filepath not in lost and filepath not in received:
+            lost.append(filepath)
+        session.close()
+        self.logger.debug(
+            "clamd session lost, rescanning pending files",
+            extra={"count": len(lost)},
+        )
+        if self.metrics is not None:
+            self.metrics.inc("pyclamav_errors_total", type="session_lost")
+            for file in lost:
+                self.metrics.forget(file)
+
+        for file in lost:
+            done.append((file, self._scan_with(self.cd, file)))
+        return done
+
+    def _collect(self, done):
+        """
+        Log the results of pipelined scans and return the infected files.
+        """
+        results = []
+        for file, result in done:
+            if self.metrics is not None:
+                self.metrics.received(file, self._command)
+            if self.timer is not None:
+                self.timer.received(file)
+            results.extend(self._finish(file, result))
+        return results
+
+    def _candidates(self, folder, results):
+        """
+        Walk a folder and yield the files to send to clamd. Files found in
+        the cache, duplicating a content already scanned or batched with
+        other small files are logged right away and added to results if
+        infected.
+        """
+        candidates = self._uncached(folder, results)
+        if self.dedup is not None:
+            candidates = self._deduplicated(candidates, results)
+        if self.batcher is None:
+            yield from candidates
+            return
+
+        for files in self.batcher.group(candidates):
+            if len(files) == 1:
+                yield files[0]
+            else:
+                results.extend(self._scan_batch(files))
+
+    def _deduplicated(self, candidates, results):
+        for filepath, digest in self.dedup.hashed(candidates):
+            state, result = self.dedup.claim(filepath, digest, owner=self)
+            if state == dedup.SCAN:
+                yield filepath
+            elif state == dedup.KNOWN:
+                results.extend(self._finish(filepath, result))
+            # WAITING files are logged along with the first copy
+
+    def _scan_batch(self, files):
+        """
+        Scan small files as one tar archive. Every file of a clean archive
+        is clean, the others are split in halves scanned again until the
+        infected files are scanned on their own.
+
+        Returns:
+            list: The infected files.
+        """
+        if len(files) == 1:
+            return self._finish(files[0], self._scan_with(self.cd, files[0]))
+
+        archive = batch.TarStream(files)
+        started = time.monotonic()
+        try:
+            result = self.cd.scan_stream(archive)
+        except pyclamd.BufferTooLongError as e:
+            result = self._too_long_error(e)
+        if self.metrics is not None:
+            self.metrics.inc("pyclamav_files_scanned_total", len(archive.scanned))
+            self.metrics.inc("pyclamav_bytes_scanned_total", archive.bytes)
+            self.metrics.observe(
+                "pyclamav_clamd_request_seconds",
+                time.monotonic() - started,
+                command="INSTREAM",
+            )
+        self.batcher.scanned(archive, split=result is not None)
+
+        infected = []
+        # the files that could not be read whole get their own error
+        for file in archive.failed:
+            infected.extend(self._finish(file, self._scan_with(self.cd, file)))
+        if result is None:
+            for file in archive.scanned:
+                infected.extend(self._finish(file, None))
+            return infected
+
+        half = len(archive.scanned) // 2
+        for part in (archive.scanned[:half], archive.scanned[half:]):
+            if part:
+                infected.extend(self._scan_batch(part))
+        return infected
+
+    def _uncached(self, folder, results):
+        cutoff = utils.mtime_cutoff_ns(self.modified_since)
+        walk = utils.iterate_folder(
+            folder,
+            cutoff,
+            self.rules,
+            symlinks=self.folder_symlinks.get(os.path.abspath(folder), self.symlinks),
+            one_file_system=self.one_file_system,
+            seen=self._inodes,
+            onerror=self._walk_error,
+        )
+        if not self.walk_queue_depth:
+            yield from self._lookup(walk, results)
+            return
+
+        pipeline = WalkPipeline([walk], self.walk_queue_depth)
+        try:
+            yield from self._lookup(pipeline, results)
+        finally:
+            pipeline.close()
+            self._pipelines.append(pipeline.stats())
+
+    def _walk_error(self, error):
+        """
+        Count and log a folder the walk could not list.
+        """
+        self.walk_errors += 1
+        if error.filename == self._root:
+            self.root_unreadable = True
+        if self.metrics is not None:
+            self.metrics.inc("pyclamav_errors_total", type="walk")
+        self.logger.warning(
+            "Cannot read folder",
+            extra={"folder": error.filename, "reason": error.strerror},
+        )
+
+    def _lookup(self, walk, results):
+        started = time.perf_counter()
+        for filepath, st in walk:
+            walked = time.perf_counter() - started
+            self.logger.debug("Scanning file", extra={"file": str(filepath)})
+            if self.metrics is not None:
+                self.metrics.inc("pyclamav_files_walked_total")
+            hit, infected = self._cached(filepath, st)
+            if hit:
+                if infected:
+                    results.append(filepath)
+            elif not self._allowed(filepath, st):
+                if self.timer is not None:
+                    self.timer.add(filepath, "walk", walked)
+                yield filepath
+            started = time.perf_counter()
+
+    def _allowed(self, file, st):
+        """
+        Check a file against the package allowlist, caching the files
+        unchanged since their package was installed as clean.
+        """
+        if self.allowlist is None or not self.allowlist.allows(file, st):
+            return False
+
+        self.logger.debug("Known package file", extra={"filepath": str(file)})
+        key = self._keys.pop(file, None)
+        if key is not None:
+            self.cache.put(key, None)
+        return True
+
+    def _cached(self, file, st=None):
+        """
+        Look up a file in the cache and log its cached result.
+
+        Returns:
+            tuple: (hit, infected)
+        """
+        if self.cache is None:
+            return False, False
+
+        key = ScanCache.key(st or file.stat())
+        hit, result = self.cache.get(key)
+        if hit:
+            return True, self.handle_result(file, result)
+        self._keys[file] = key
+        return False, False
+
+    @property
+    def _command(self):
+        return "FILDES" if self.fildes else "INSTREAM"
+
+    def _record_request(self, f):
+        """
+        Count a file sent to clamd and its bytes.
+        """
+        self.metrics.inc("pyclamav_files_scanned_total")
+        self.metrics.inc("pyclamav_bytes_scanned_total", os.fstat(f.fileno()).st_size)
+
+    def _record_verdict(self, result):
+        """
+        Count a verdict and write the metrics file when it is due.
+        """
+        status = next(iter(result.values()))[0] if result else "OK"
+        self.metrics.inc("pyclamav_verdicts_total", result=VERDICTS.get(status, status))
+        self.metrics.maybe_write()
+
+    def _metric_samples(self):
+        """
+        Read the counters kept by the rules, the cache, the deduplication
+        and the clamd daemons, for the metrics file.
+        """
+        samples = []
+        if self.rules is not None:
+            for rule, skipped in self.rules.stats().items():
+                labels = {"rule": rule}
+                samples.append(
+                    ("pyclamav_files_skipped_total", labels, skipped["entries"])
+                )
+                samples.append(
+                    ("pyclamav_bytes_skipped_total", labels, skipped["bytes"])
+                )
+        if self.allowlist is not None:
+            stats = self.allowlist.stats()
+            labels = {"rule": "package_allowlist"}
+            samples.append(("pyclamav_files_skipped_total", labels, stats["files"]))
+            samples.append(("pyclamav_bytes_skipped_total", labels, stats["bytes"]))
+        if self.cache is not None:
+            stats = self.cache.stats()
+            samples.append(("pyclamav_cache_hits_total", {}, stats["hits"]))
+            samples.append(("pyclamav_cache_misses_total", {}, stats["misses"]))
+        if self.dedup is not None:
+            duplicates = self.dedup.stats()["duplicates"]
+            samples.append(("pyclamav_dedup_duplicates_total", {}, duplicates))
+        if self.batcher is not None:
+            stats = self.batcher.stats()
+            samples.append(("pyclamav_batches_total", {}, stats["batches"]))
+            samples.append(("pyclamav_batch_splits_total", {}, stats["splits"]))
+
+        try:
+            stats = self._daemon_stats()
+        except pyclamd.ConnectionError:
+            return samples
+        samples.append(("pyclamav_clamd_queue_length", {}, stats.queue_length))
+        for state, threads in (
+            ("idle", stats.threads_idle),
+            ("busy", stats.threads_busy),
+            ("max", stats.threads_max),
+        ):
+            samples.append(("pyclamav_clamd_threads", {"state": state}, threads))
+        if stats.memory is not None:
+            for kind, value in stats.memory.model_dump().items():
+                if value is not None and kind != "pools":
+                    samples.append(
+                        ("pyclamav_clamd_memory_megabytes", {"kind": kind}, value)
+                    )
+        return samples
+
+    def _finish(self, file, result):
+        """
+        Record the result of a scan in the cache and log it, along with the
+        duplicates of the file waiting for it.
+
+        Returns:
+            list: The infected files.
+        """
+        files = [file]
+        infected = []
+        if self.dedup is not None:
+            duplicates, rescan = self.dedup.resolve(file, result)
+            files.extend(duplicates)
+            for duplicate in rescan:
+                infected.extend(
+                    self._finish(duplicate, self._scan_with(self.cd, duplicate))
+                )
+
+        for f in files:
+            if self.timer is not None:
+                self.timer.finish(f)
+            key = self._keys.pop(f, None)
+            if key is not None:
+                self.cache.put(key, result)
+            if self.handle_result(f, result):
+                infected.append(f)
+        return infected
@@ -0,0 +1,101 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from . import utils
+
+DEFAULT_STATE_FILENAME = "state.json"
+# seconds subtracted from the checkpoints, for clock skew and files
+# written while the previous run was walking past them
+DEFAULT_INCREMENTAL_MARGIN = 3600
+
+
+class ScanState:
+    """
+    Checkpoints of the last successful scan of each folder, kept in a JSON
+    file so that incremental runs scan the files modified since then.
+
+    A checkpoint is the time the folder scan started, so files modified
+    during the scan are scanned again by the next run.
+
+    Example:
+        >>> state = ScanState("/var/lib/pyclamav/state.json")
+        >>> started = state.start()
+        >>> state.checkpoint("/var/www", started)
+        >>> state.since("/var/www", margin=3600)
+        datetime.datetime(2023, 10, 1, 1, 0)
+    """
+
+    def __init__(self, path):
+        """
+        Initialize the ScanState class.
+
+        Args:
+            path (str): The JSON state file, created on the first checkpoint.
+        """
+        self.path = path
+        try:
+            with open(path, "r") as file:
+                self.checkpoints = json.load(file).get("checkpoints", {})
+        except FileNotFoundError:
+            self.checkpoints = {}
+        # folders scanned at once checkpoint from several threads
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def start():
+        """
+        Get the time to record as checkpoint when the folder scan succeeds.
+
+        Returns:
+            float: The current epoch time.
+        """
+        return time.time()
+
+    def since(self, folder, margin=DEFAULT_INCREMENTAL_MARGIN):
+        """
+        Get the modification cutoff of a folder.
+
+        Args:
+            folder (str): The folder.
+            margin (int): Seconds subtracted from the checkpoint.
+
+        Returns:
+            datetime: The checkpoint minus the margin, or None if the folder
+                never finished a scan.
+        """
+        checkpoint = self.checkpoints.get(os.path.abspath(folder))
+        if checkpoint is None:
+            return None
+        return datetime.fromtimestamp(checkpoint - margin)
+
+    def checkpoint(self, folder, started):
+        """
+        Record that a folder scan succeeded and save the state file.
+
+        Checkpoints only move forward.
+
+        Args:
+            folder (str): The folder.
+            started (float): The `start` value taken before the folder scan.
+        """
+        folder = os.path.abspath(folder)
+        with self._lock:
+            self.checkpoints[folder] = max(
+                started, self.checkpoints.get(folder, started)
+            )
+            self.save()
+
+    def save(self):
+        """
+        Write the state file atomically, so an interrupted run never leaves
+        it truncated.
+        """
+        utils.create_file_folder(self.path)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as file:
+            json.dump({"checkpoints": self.checkpoints}, file, indent=4)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, self.path)
@@ -0,0 +1,281 @@
+import os
+import json
+import time
+import heapq
+import random
+import threading
+from contextlib import contextmanager
+from . import utils
+
+# the phases of a file scan, in order
+PHASES = ("walk", "stat", "open", "read", "send", "verdict")
+DEFAULT_SLOWEST = 10
+# durations kept per phase for the percentiles, sampled once there are more
+RESERVOIR_SIZE = 10000
+
+
+class _Phase:
+    def __init__(self, rng):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = []
+        self._rng = rng
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        if len(self.samples) < RESERVOIR_SIZE:
+            self.samples.append(seconds)
+        else:
+            # reservoir sampling, every duration has the same chance to be kept
+            n = self._rng.randrange(self.count)
+            if n < RESERVOIR_SIZE:
+                self.samples[n] = seconds
+
+    def summary(self):
+        samples = sorted(self.samples)
+        return {
+            "count": self.count,
+            "total": round(self.total, 6),
+            "p50": _percentile(samples, 50),
+            "p95": _percentile(samples, 95),
+            "p99": _percentile(samples, 99),
+            "max": round(self.max, 6),
+        }
+
+
+class PhaseTimer:
+    """
+    Time the phases of each file scan: waiting for the walk, stat, open,
+    reading the file, sending it to clamd and waiting for the verdict.
+
+    Totals are exact, percentiles come from a uniform sample of
+    `RESERVOIR_SIZE` durations per phase so memory stays bounded on huge
+    trees.
+
+    Example:
+        >>> timer = PhaseTimer(slowest=5)
+        >>> timer.add(file, "open", 0.0001)
+        >>> timer.finish(file)
+        >>> timer.report()["phases"]["open"]
+        {'count': 1, 'total': 0.0001, 'p50': 0.0001, 'p95': 0.0001, 'p99': 0.0001, 'max': 0.0001}
+    """
+
+    def __init__(self, slowest=DEFAULT_SLOWEST):
+        """
+        Initialize the PhaseTimer class.
+
+        Args:
+            slowest (int): Number of slowest files kept for the report.
+        """
+        self.slowest = slowest
+        self.started = time.monotonic()
+        rng = random.Random(0)
+        self._phases = {phase: _Phase(rng) for phase in PHASES}
+        # file -> {phase: seconds} of the files being scanned
+        self._files = {}
+        # file -> perf_counter time its pipelined request was sent
+        self._sent_at = {}
+        # (seconds, order, record) of the slowest files, fastest first
+        self._slowest = []
+        self._order = 0
+        # folder -> [files, bytes, started] of the folders being scanned
+        self._folders = {}
+        self._done_folders = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add(self, file, phase, seconds):
+        """
+        Add time spent on a phase of a file scan.
+
+        Args:
+            file (pathlib.PosixPath): The file.
+            phase (str): One of `PHASES`, or "size" to record the file size.
+            seconds (float): The duration, or the size in bytes.
+        """
+        with self._lock:
+            record = self._files.setdefault(file, {})
+            record[phase] = record.get(phase, 0) + seconds
+
+    def sent(self):
+        """
+        Mark the end of the send phase of the current thread, given as
+        `on_sent` hook to the clamd clients.
+        """
+        self._local.sent = time.perf_counter()
+
+    @contextmanager
+    def request(self, file, pipelined=False):
+        """
+        Time a clamd request from the current thread, split into send and
+        verdict at the `sent` mark.
+
+        Args:
+            file (pathlib.PosixPath): The file scanned.
+            pipelined (bool): The request returns once sent, its verdict
+                is timed by `received`.
+        """
+        self._local.sent = None
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            ended = time.perf_counter()
+            sent = self._local.sent or ended
+            with self._lock:
+                record = self._files.setdefault(file, {})
+                # the reads happen while sending the stream
+                send = sent - started - record.get("read", 0)
+                record["send"] = record.get("send", 0) + max(send, 0.0)
+                if pipelined:
+                    self._sent_at[file] = sent
+                else:
+                    record["verdict"] = record.get("verdict", 0) + ended - sent
+
+    def received(self, file):
+        """
+        Time the wait for the verdict of a pipelined request.
+
+        Args:
+            file (pathlib.PosixPath): The file scanned.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            sent = self._sent_at.pop(file, None)
+            if sent is not None:
+                record = self._files.setdefault(file, {})
+                record["verdict"] = record.get("verdict", 0) + now - sent
+
+    def finish(self, file):
+        """
+        Record the phases of a file whose verdict is known.
+
+        Args:
+            file (pathlib.PosixPath): The file.
+        """
+        with self._lock:
+            self._sent_at.pop(file, None)
+            record = self._files.pop(file, None)
+            if record is None:
+                return
+            size = record.pop("size", 0)
+            for phase, seconds in record.items():
+                self._phases[phase].add(seconds)
+
+            total = sum(record.values())
+            self._order += 1
+            entry = (total, self._order, str(file), size, record)
+            if len(self._slowest) < self.slowest:
+                heapq.heappush(self._slowest, entry)
+            elif self._slowest and total > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, entry)
+
+            path = str(file)
+            for folder, counts in self._folders.items():
+                if path.startswith(folder):
+                    counts[0] += 1
+                    counts[1] += size
+
+    @contextmanager
+    def folder(self, folder):
+        """
+        Time the scan of a folder and count its files and bytes.
+
+        Args:
+            folder (str): The folder.
+        """
+        prefix = os.path.join(os.path.abspath(folder), "")
+        with self._lock:
+            self._folders[prefix] = [0, 0, time.monotonic()]
+        try:
+            yield
+        finally:
+            with self._lock:
+                files, size, started = self._folders.pop(prefix)
+                seconds = time.monotonic() - started
+                self._done_folders.append(
+                    {
+                        "folder": folder,
+                        "files": files,
+                        "bytes": size,
+                        "seconds": round(seconds, 3),
+                        "files_per_second": round(files / seconds, 1) if seconds else 0,
+                        "bytes_per_second": round(size / seconds) if seconds else 0,
+                    }
+                )
+
+    def report(self):
+        """
+        Get the timing report.
+
+        Returns:
+            dict: The run duration, the totals and percentiles of each
+                phase, the slowest files and the throughput of each folder.
+        """
+        with self._lock:
+            slowest = sorted(self._slowest, reverse=True)
+            return {
+                "seconds": round(time.monotonic() - self.started, 3),
+                "phases": {
+                    phase: stats.summary()
+                    for phase, stats in self._phases.items()
+                    if stats.count
+                },
+                "slowest": [
+                    {
+                        "file": path,
+                        "size": size,
+                        "seconds": round(total, 6),
+                        "phases": {k: round(v, 6) for k, v in record.items()},
+                    }
+                    for total, _, path, size, record in slowest
+                ],
+                "folders": list(self._done_folders),
+            }
+
+    def write(self, path):
+        """
+        Write the timing report as a JSON file.
+
+        Args:
+            path (str): The report file.
+        """
+        utils.create_file_folder(path)
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=4)
+
+
+class TimedReader:
+    """
+    A file wrapper adding the time spent reading it to the "read" phase.
+    """
+
+    def __init__(self, file, path, timer):
+        self._file = file
+        self._path = path
+        self._timer = timer
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def readinto(self, buf):
+        started = time.perf_counter()
+        size = self._file.readinto(buf)
+        self._timer.add(self._path, "read", time.perf_counter() - started)
+        return size
+
+    def read(self, size=-1):
+        started = time.perf_counter()
+        data = self._file.read(size)
+        self._timer.add(self._path, "read", time.perf_counter() - started)
+        return data
+
+
+def _percentile(samples, percent):
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(len(samples) * percent / 100))
+    return round(samples[index], 6)
@@ -1,5 +1,11 @@
+import os
 from pathlib import Path
 
+# symlink policies of iterate_folder
+SYMLINKS_SKIP = "skip"
+SYMLINKS_FILES = "files"
+SYMLINKS_FOLLOW = "follow"
+
 
 def create_file_folder(filepath):
     """
@@ -17,9 +23,138 @@ def create_file_folder(filepath):
     path.parent.mkdir(parents=True, exist_ok=True)
 
 
-def iterate_folder(folder):
-    path = Path(folder)
-    for file in path.rglob("*"):
-        if not file.is_file():
+def mtime_cutoff_ns(modified_since):
+    """
+    Convert a modification datetime to the `st_mtime_ns` value to compare with.
+
+    Args:
+        modified_since (datetime): The datetime, None for no cutoff.
+
+    Returns:
+        int: The epoch time in nanoseconds, 0 if modified_since is None.
+
+    Example:
+        >>> mtime_cutoff_ns(datetime(2023, 10, 1, tzinfo=timezone.utc))
+        1696118400000000000
+    """
+    if modified_since is None:
+        return 0
+    return round(modified_since.timestamp() * 1_000_000) * 1000
+
+
+def iterate_folder(
+    folder,
+    min_mtime_ns=0,
+    rules=None,
+    symlinks=SYMLINKS_FILES,
+    one_file_system=False,
+    seen=None,
+    onerror=None,
+):
+    """
+    Walk a folder recursively and yield its files modified since a cutoff.
+
+    The walk uses `os.scandir` with an explicit stack: the entry types come
+    from the directory listing and each file is stat'ed once, so files out
+    of the cutoff cost no more than that stat. Unreadable folders, the
+    walked one included, are reported to `onerror` and skipped; files
+    removed during the walk are skipped.
+
+    Args:
+        folder (str): The folder.
+        min_mtime_ns (int): Files with an older `st_mtime_ns` are skipped,
+            see `mtime_cutoff_ns`.
+        rules (rules.WalkRules): Rules pruning folders and files, checked
+            by name before listing or stat'ing them and counting what they skip.
+        symlinks (str): SYMLINKS_SKIP to ignore symlinks, SYMLINKS_FILES to
+            follow symlinks to files only, SYMLINKS_FOLLOW to follow symlinks
+            to folders too, each folder being walked once.
+        one_file_system (bool): Do not walk into other filesystems than
+            the one of `folder`.
+        seen (set): Inodes already yielded, shared between walks so that
+            hardlinked files are yielded once. Only files with several
+            links or reached by a symlink are recorded. None to yield every
+            link.
+        onerror (callable): Called with the OSError of each folder that
+            cannot be stat'ed or listed, None to ignore them.
+
+    Yields:
+        tuple: (pathlib.PosixPath, os.stat_result) of each file.
+    """
+    root = os.fspath(folder)
+    root_dev = None
+    # identity of the folders walked, when symlinks can lead back to them
+    walked = None
+    if one_file_system or symlinks == SYMLINKS_FOLLOW:
+        try:
+            root_st = os.stat(root)
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
+            return
+        if one_file_system:
+            root_dev = root_st.st_dev
+        if symlinks == SYMLINKS_FOLLOW:
+            walked = {_inode(root_st)}
+
+    stack = [root]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError as e:
+            if onerror is not None:
+                onerror(e)
             continue
-        yield file
+        with entries:
+            for entry in entries:
+                try:
+                    link = entry.is_symlink()
+                    if link and symlinks == SYMLINKS_SKIP:
+                        continue
+                    if entry.is_dir(follow_symlinks=symlinks == SYMLINKS_FOLLOW):
+                        if rules is not None and rules.prune_folder(
+                            entry.name, entry.path
+                        ):
+                            continue
+                        if root_dev is not None or walked is not None:
+                            dir_st = entry.stat()
+                            if root_dev is not None and dir_st.st_dev != root_dev:
+                                _skip(rules, "one_file_system")
+                                continue
+                            if walked is not None:
+                                if _inode(dir_st) in walked:
+                                    continue
+                                walked.add(_inode(dir_st))
+                        stack.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if rules is not None and rules.skip_name(entry.name, entry.path):
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if st.st_mtime_ns < min_mtime_ns:
+                    continue
+                if root_dev is not None and st.st_dev != root_dev:
+                    _skip(rules, "one_file_system", st.st_size)
+                    continue
+                if rules is not None and rules.skip_size(st.st_size):
+                    continue
+                if seen is not None and (link or st.st_nlink > 1):
+                    inode = _inode(st)
+                    if inode in seen:
+                        _skip(rules, "hardlink", st.st_size)
+                        continue
+                    seen.add(inode)
+                yield Path(entry.path), st
+
+
+def _inode(st):
+    # one int per inode keeps the seen sets compact
+    return st.st_dev << 64 | st.st_ino
+
+
+def _skip(rules, rule, size=0):
+    if rules is not None:
+        rules.skip(rule, size)
@@ -1,23 +1,162 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from lib.config import load_config
 from lib.log import get_logger
 
+from lib import pyclamd
+from lib.allowlist import PackageAllowlist
+from lib.rules import WalkRules
 from lib.scan import Scan
+from lib.state import ScanState
 
 
 def main():
     config = load_config()
     logger = get_logger(config.log_folder, config.verbose)
-    scanner = Scan(config.modified_file_datetime, logger)
+    scanner = Scan(
+        config.modified_file_datetime,
+        logger,
+        workers=config.workers,
+        multiscan=config.multiscan,
+        cache_file=config.cache_file,
+        cache_max_entries=config.cache_max_entries,
+        dedup_workers=config.dedup_workers if config.dedup else 0,
+        batch_max_files=config.batch_max_files if config.batch else 0,
+        batch_file_size=config.batch_file_size,
+        batch_max_bytes=config.batch_max_bytes,
+        rules=WalkRules(
+            exclude=config.exclude,
+            max_file_size=config.max_file_size,
+            min_file_size=config.min_file_size,
+            include_extensions=config.include_extensions,
+            exclude_extensions=config.exclude_extensions,
+        ),
+        allowlist=(
+            PackageAllowlist(config.package_manifests, rpm=config.package_rpm)
+            if config.package_manifests or config.package_rpm
+            else None
+        ),
+        symlinks=config.symlinks,
+        folder_symlinks=config.folder_symlinks,
+        one_file_system=config.one_file_system,
+        walk_queue_depth=config.walk_queue_depth,
+        endpoints=config.endpoints,
+        adaptive=config.adaptive_workers,
+        metrics_file=config.metrics_file,
+        metrics_interval=config.metrics_interval,
+        timings=config.timings,
+        timings_file=config.timings_file,
+        timings_slowest=config.timings_slowest,
+    )
 
     logger.info(
         f"Scanning {len(config.folders)} folders with files changed during the last {config.modified_file_since}"
     )
-    for folder in config.folders:
-        logger.info(
-            "Scanning folder",
-            extra={"folder": folder},
+    state = ScanState(config.state_file) if config.incremental else None
+
+    def scan_folders(folders):
+        # folders sharing a device are scanned one after the other
+        return all([scan_folder(scanner, folder, config, state) for folder in folders])
+
+    groups = group_folders(config.folders, by_device=not config.parallel_folders)
+    try:
+        with ThreadPoolExecutor(
+            max_workers=config.parallel_folders or max(len(groups), 1)
+        ) as executor:
+            succeeded = all(list(executor.map(scan_folders, groups)))
+    finally:
+        scanner.close()
+    if not succeeded:
+        sys.exit(1)
+
+
+def group_folders(folders, by_device):
+    """
+    Group the folders scanned one after the other.
+
+    Args:
+        folders (list): The configured folders.
+        by_device (bool): Group the folders by device, so each device is
+            busy with one folder at a time. Otherwise each folder is its own group.
+
+    Returns:
+        list: The lists of folders.
+    """
+    if not by_device:
+        return [[folder] for folder in folders]
+
+    groups = {}
+    for folder in folders:
+        try:
+            device = os.stat(folder).st_dev
+        except OSError:
+            device = folder
+        groups.setdefault(device, []).append(folder)
+    return list(groups.values())
+
+
+def scan_folder(scanner, folder, config, state):
+    """
+    Scan a folder, log its summary and move its checkpoint forward.
+
+    Args:
+        scanner (Scan): The scanner shared by the folders.
+        folder (str): The folder.
+        config (Config): The configuration.
+        state (ScanState): The incremental checkpoints, None if not incremental.
+
+    Returns:
+        bool: False if the scan failed or the folder could not be read.
+    """
+    modified_since = config.modified_file_datetime
+    if state is not None:
+        # folders never scanned yet fall back to modified_file_since
+        modified_since = (
+            state.since(folder, config.incremental_margin) or modified_since
+        )
+        started = state.start()
+    folder_scanner = scanner.for_folder(
+        modified_since, config.folder_workers.get(folder, config.workers)
+    )
+
+    scanner.logger.info(
+        "Scanning folder",
+        extra={"folder": folder, "modified_since": str(modified_since)},
+    )
+    start = time.monotonic()
+    try:
+        results = folder_scanner.scan_folder(folder)
+    except pyclamd.ConnectionError as e:
+        # keep the checkpoint so the next run rescans what was missed
+        scanner.logger.error("Scan failed", extra={"folder": folder, "error": str(e)})
+        return False
+    except Exception as e:
+        # the other folders go on, the run still exits with an error
+        scanner.logger.exception(
+            "Scan failed", extra={"folder": folder, "error": str(e)}
+        )
+        return False
+    scanner.logger.info(
+        "Folder scanned",
+        extra={
+            "folder": folder,
+            "infected": len(results),
+            "duration": round(time.monotonic() - start, 3),
+        },
+    )
+    if folder_scanner.walk_errors:
+        # keep the checkpoint so the next run scans what could not be read
+        scanner.logger.warning(
+            "Folder not fully read",
+            extra={"folder": folder, "unreadable_folders": folder_scanner.walk_errors},
         )
-        scanner.scan_folder(folder)
+        return not folder_scanner.root_unreadable
+    if state is not None:
+        state.checkpoint(folder, started)
+    return True
 
 
 if __name__ == "__main__":
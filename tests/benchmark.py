@@ -0,0 +1,334 @@
+"""
+Benchmark the scan of synthetic trees against the clamd stand-in of
+`tests.fakeclamd`, so the throughput of two versions can be compared
+without a real clamd nor real data.
+
+Usage:
+    python -m tests.benchmark --output benchmark.json
+    python -m tests.benchmark --trees tiny,duplicates --dedup --baseline benchmark.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import resource
+import subprocess
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+from tests.fakeclamd import FakeClamd, SIGNATURE
+
+# name -> (folders, files per folder, file sizes, distinct contents, nested)
+# of the generated trees, distinct contents being None for random files
+TREES = {
+    "tiny": (100, 200, (0, 512), None, False),
+    "huge": (1, 8, (20 << 20, 20 << 20), None, False),
+    "deep": (200, 10, (1024, 4096), None, True),
+    "duplicates": (50, 100, (16 << 10, 16 << 10), 50, False),
+}
+DEFAULT_LATENCY = 0.001
+
+
+def make_tree(root, name, scale=1.0, seed=0):
+    """
+    Generate a synthetic tree, the same for a given name, scale and seed.
+
+    Args:
+        root (str): The folder the tree is created in.
+        name (str): One of `TREES`.
+        scale (float): Multiplies the number of files of each folder.
+        seed (int): The random seed.
+
+    Returns:
+        tuple: (files, bytes, infected) of the tree.
+    """
+    folders, per_folder, (smallest, largest), distinct, nested = TREES[name]
+    per_folder = max(1, round(per_folder * scale))
+    rng = random.Random(seed)
+    contents = None
+    if distinct:
+        contents = [
+            rng.randbytes(rng.randint(smallest, largest)) for _ in range(distinct)
+        ]
+
+    files = size = 0
+    folder = Path(root)
+    for n in range(folders):
+        # nested trees go one level deeper for each folder
+        folder = folder / f"d{n}" if nested else Path(root, f"d{n}")
+        folder.mkdir(parents=True)
+        for m in range(per_folder):
+            if contents:
+                data = rng.choice(contents)
+            else:
+                data = rng.randbytes(rng.randint(smallest, largest))
+            (folder / f"f{m}").write_bytes(data)
+            files += 1
+            size += len(data)
+
+    # one infected file, so the FOUND replies are exercised too
+    (Path(root) / "infected").write_bytes(SIGNATURE)
+    return files + 1, size + len(SIGNATURE), 1
+
+
+def benchmark(
+    trees=tuple(TREES),
+    scale=1.0,
+    latency=DEFAULT_LATENCY,
+    workers=1,
+    session=True,
+    dedup=False,
+    batch=False,
+    unix=False,
+    folder=None,
+):
+    """
+    Generate the trees and scan each of them in a new process, against a
+    clamd stand-in answering every scan after `latency` seconds.
+
+    Args:
+        trees (list): Names of the `TREES` to scan.
+        scale (float): Multiplies the number of files of the trees.
+        latency (float): Seconds each verdict takes.
+        workers (int): Number of files scanned in parallel.
+        session (bool): Scan through IDSESSION instead of one connection per file.
+        dedup (bool): Send the identical files once.
+        batch (bool): Send the small files as tar archives of many files.
+        unix (bool): Connect by unix socket and pass the file descriptors
+            with FILDES instead of streaming the files over TCP.
+        folder (str): Folder the trees are generated in, a temporary one
+            removed afterwards by default.
+
+    Returns:
+        dict: The options, the environment and the result of each tree.
+    """
+    options = {
+        "scale": scale,
+        "latency": latency,
+        "workers": workers,
+        "session": session,
+        "dedup": dedup,
+        "batch": batch,
+        "unix": unix,
+    }
+    report = {"environment": _environment(), "options": options, "results": []}
+    root = folder or tempfile.mkdtemp(prefix="pyclamav-benchmark-")
+    try:
+        with FakeClamd(latency=latency, max_threads=max(workers, 10)) as clamd:
+            for name in trees:
+                tree = os.path.join(root, name)
+                if os.path.exists(tree):
+                    shutil.rmtree(tree)
+                files, size, infected = make_tree(tree, name, scale)
+                # a new process for each tree, so the peak RSS is its own
+                context = multiprocessing.get_context("spawn")
+                with ProcessPoolExecutor(1, mp_context=context) as executor:
+                    seconds, found, rss = executor.submit(
+                        _scan, tree, clamd.path if unix else clamd.address, options
+                    ).result()
+                report["results"].append(
+                    {
+                        "tree": name,
+                        "files": files,
+                        "bytes": size,
+                        "infected": found,
+                        "expected_infected": infected,
+                        "seconds": round(seconds, 3),
+                        "files_per_second": round(files / seconds, 1),
+                        "mb_per_second": round(size / seconds / (1 << 20), 2),
+                        "peak_rss_mb": round(rss / (1 << 20), 1),
+                    }
+                )
+    finally:
+        if folder is None:
+            shutil.rmtree(root, ignore_errors=True)
+    return report
+
+
+def compare(report, baseline):
+    """
+    Compare the throughput and memory of a run with a previous one.
+
+    Args:
+        report (dict): The `benchmark` report.
+        baseline (dict): A previous report.
+
+    Returns:
+        list: The lines of the comparison, one per tree of both reports.
+    """
+    previous = {result["tree"]: result for result in baseline["results"]}
+    lines = []
+    for result in report["results"]:
+        before = previous.get(result["tree"])
+        if before is None:
+            continue
+        changes = ", ".join(
+            f"{key} {before[key]} -> {result[key]} ({_change(before[key], result[key])})"
+            for key in ("files_per_second", "mb_per_second", "peak_rss_mb")
+        )
+        lines.append(f"{result['tree']}: {changes}")
+    return lines
+
+
+def _scan(tree, address, options):
+    # runs in the benchmark process, imported late so its memory counts
+    from lib import pyclamd
+    from lib.scan import Scan
+    from lib.batch import DEFAULT_BATCH_MAX_FILES
+
+    logger = logging.getLogger("pyclamav.benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    scanner = Scan(
+        modified_since=None,
+        logger=logger,
+        session=options["session"],
+        workers=options["workers"],
+        dedup_workers=4 if options["dedup"] else 0,
+        batch_max_files=DEFAULT_BATCH_MAX_FILES if options["batch"] else 0,
+        cd=(
+            pyclamd.ClamdUnixSocket(address)
+            if options["unix"]
+            else pyclamd.ClamdNetworkSocket(*address)
+        ),
+    )
+    started = time.perf_counter()
+    infected = scanner.scan_folder(tree)
+    seconds = time.perf_counter() - started
+    scanner.close()
+
+    return seconds, len(infected), _peak_rss()
+
+
+def _peak_rss():
+    # ru_maxrss keeps the peak of the process image replaced by exec on
+    # Linux, so the one of the parent, while VmHWM starts over
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def _change(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before:+.1%}"
+
+
+def parse_arg():
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.benchmark",
+        description="Benchmark pyclamav against a clamd stand-in",
+    )
+    parser.add_argument(
+        "--trees",
+        type=lambda value: value.split(","),
+        default=list(TREES),
+        help=f"Comma-separated trees to scan, among {', '.join(TREES)}",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multiplies the number of files"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=DEFAULT_LATENCY,
+        help="Seconds each verdict takes",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1, help="Files scanned in parallel"
+    )
+    parser.add_argument(
+        "--no-session",
+        dest="session",
+        action="store_false",
+        help="One connection per file instead of IDSESSION",
+    )
+    parser.add_argument(
+        "--dedup", action="store_true", help="Send identical files once"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Send the small files as tar archives of many files",
+    )
+    parser.add_argument(
+        "--unix",
+        action="store_true",
+        help="Pass the files to clamd with FILDES over a unix socket",
+    )
+    parser.add_argument("--folder", type=str, help="Folder the trees are generated in")
+    parser.add_argument("-o", "--output", type=str, help="JSON file of the results")
+    parser.add_argument(
+        "--baseline", type=str, help="JSON results of a previous run to compare to"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arg()
+    unknown = set(args.trees) - set(TREES)
+    if unknown:
+        sys.exit(f"unknown trees: {', '.join(sorted(unknown))}")
+
+    report = benchmark(
+        trees=args.trees,
+        scale=args.scale,
+        latency=args.latency,
+        workers=args.workers,
+        session=args.session,
+        dedup=args.dedup,
+        batch=args.batch,
+        unix=args.unix,
+        folder=args.folder,
+    )
+    for result in report["results"]:
+        print(
+            f"{result['tree']}: {result['files']} files, {result['bytes']} bytes "
+            f"in {result['seconds']}s, {result['files_per_second']} files/s, "
+            f"{result['mb_per_second']} MB/s, peak RSS {result['peak_rss_mb']} MB"
+        )
+    if args.baseline:
+        with open(args.baseline) as file:
+            for line in compare(report, json.load(file)):
+                print(line)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,449 @@
+import os
+import time
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import socketserver
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+VERSION = "ClamAV 1.4.1/27490/Fri Dec 13 09:37:02 2024"
+DEFAULT_MAX_THREADS = 10
+# content flagged as infected, so the tests and benchmarks need no real virus
+SIGNATURE = b"EICAR"
+SIGNATURE_NAME = "Eicar-Test-Signature"
+SIZE_LIMIT_REPLY = "INSTREAM size limit exceeded. ERROR"
+# commands whose reply comes from a scan, run in their own thread in a session
+SCAN_COMMANDS = ("INSTREAM", "FILDES", "SCAN", "CONTSCAN", "MULTISCAN", "ALLMATCHSCAN")
+
+
+class FakeClamd:
+    """
+    A clamd emulator listening on a local TCP port and a unix socket, to
+    test the clients end-to-end without a real clamd.
+
+    It answers PING, VERSION, STATS, RELOAD, INSTREAM, FILDES (unix socket
+    only), SCAN, CONTSCAN, MULTISCAN and ALLMATCHSCAN, one command per
+    connection or many inside IDSESSION, with numbered replies sent as the
+    scans end. Content holding one of `signatures` is reported FOUND.
+
+    Every scan takes `latency` seconds on one of `max_threads` threads, so
+    the scans queue up like on a busy clamd and STATS reports it. Faults
+    are injected with `partial`, `stream_max_length`, `close_after`,
+    `refuse_session` and the `release` event.
+
+    Example:
+        >>> with FakeClamd(latency=0.001) as clamd:
+        ...     cd = pyclamd.ClamdUnixSocket(clamd.path)
+        ...     cd.scan_stream(b"EICAR")
+        {'stream': ('FOUND', 'Eicar-Test-Signature')}
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        max_threads=DEFAULT_MAX_THREADS,
+        signatures=None,
+        stream_max_length=None,
+        partial=0,
+        close_after=None,
+        refuse_session=False,
+    ):
+        """
+        Initialize the FakeClamd class.
+
+        Args:
+            latency (float): Seconds each scan takes.
+            max_threads (int): Number of scans run at once.
+            signatures (dict): Content -> name of the signatures, the
+                `SIGNATURE` by default.
+            stream_max_length (int): Bytes above which INSTREAM is refused
+                and the connection closed, like StreamMaxLength.
+            partial (int): Send the replies in pieces of this many bytes,
+                so the clients get them over several reads.
+            close_after (int): Close each connection after this many
+                replies, without ending the session.
+            refuse_session (bool): Reply UNKNOWN COMMAND to IDSESSION.
+        """
+        self.latency = latency
+        self.max_threads = max_threads
+        self.signatures = signatures or {SIGNATURE: SIGNATURE_NAME}
+        self.stream_max_length = stream_max_length
+        self.partial = partial
+        self.close_after = close_after
+        self.refuse_session = refuse_session
+        # the scan replies are held back until set
+        self.release = threading.Event()
+        self.release.set()
+        # command -> number of times it was received
+        self.commands = Counter()
+        self.address = None
+        self.path = None
+        self._servers = []
+        self._folder = None
+        self._busy = 0
+        self._queued = 0
+        self._slots = threading.Semaphore(max_threads)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        """
+        Listen on a free port of 127.0.0.1 and on a unix socket in a new
+        temporary folder, serving from daemon threads.
+
+        Returns:
+            FakeClamd: self, `address` being the (host, port) and `path`
+                the unix socket listened on.
+        """
+        self._folder = tempfile.mkdtemp(prefix="fakeclamd-")
+        self.path = os.path.join(self._folder, "clamd.ctl")
+        self._servers = [
+            _TCPServer(("127.0.0.1", 0), _Handler),
+            _UnixServer(self.path, _Handler),
+        ]
+        self.address = self._servers[0].server_address
+        for server in self._servers:
+            server.clamd = self
+            threading.Thread(
+                target=server.serve_forever, args=(0.05,), daemon=True
+            ).start()
+        return self
+
+    def close(self):
+        """
+        Stop listening and remove the unix socket.
+        """
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        if self._folder is not None:
+            shutil.rmtree(self._folder, ignore_errors=True)
+            self._folder = None
+
+    def match(self, data):
+        """
+        Scan some content, waiting for a free thread first.
+
+        Args:
+            data (bytes): The content.
+
+        Returns:
+            list: The names of the signatures found.
+        """
+        with self._lock:
+            self._queued += 1
+        with self._slots:
+            with self._lock:
+                self._queued -= 1
+                self._busy += 1
+            try:
+                if self.latency:
+                    time.sleep(self.latency)
+                return [
+                    name for content, name in self.signatures.items() if content in data
+                ]
+            finally:
+                with self._lock:
+                    self._busy -= 1
+
+    def scan_path(self, command, path):
+        """
+        Scan a file or a folder, recursively, the way clamd does for the
+        SCAN, CONTSCAN, MULTISCAN and ALLMATCHSCAN commands.
+
+        Args:
+            command (str): The command.
+            path (str): The file or folder.
+
+        Returns:
+            list: The reply lines.
+        """
+        if not os.path.lexists(path):
+            return [
+                f"{path}: File path check failure: No such file or directory. ERROR"
+            ]
+
+        files = [path]
+        if os.path.isdir(path):
+            files = [
+                os.path.join(folder, name)
+                for folder, _, names in sorted(os.walk(path))
+                for name in sorted(names)
+            ]
+
+        lines = []
+        if command == "MULTISCAN":
+            with ThreadPoolExecutor(self.max_threads) as executor:
+                for file_lines in executor.map(self._scan_file, files):
+                    lines.extend(file_lines)
+        else:
+            for file in files:
+                file_lines = self._scan_file(
+                    file, all_matches=command == "ALLMATCHSCAN"
+                )
+                lines.extend(file_lines)
+                # SCAN stops at the first virus or error
+                if command == "SCAN" and file_lines:
+                    break
+        return lines or [f"{path}: OK"]
+
+    def stats(self):
+        """
+        Get the STATS reply, with the threads in use and the queued scans.
+
+        Returns:
+            str: The multiline reply.
+        """
+        with self._lock:
+            busy, queued = self._busy, self._queued
+        return (
+            "POOLS: 1\n\nSTATE: VALID PRIMARY\n"
+            f"THREADS: live {self.max_threads} idle {self.max_threads - busy} "
+            f"max {self.max_threads} idle-timeout 30\n"
+            f"QUEUE: {queued} items\n"
+            "MEMSTATS: heap N/A mmap N/A used N/A free N/A releasable N/A "
+            "pools 1 pools_used 1306.837M pools_total 1306.883M\nEND"
+        )
+
+    def _scan_file(self, file, all_matches=False):
+        try:
+            with open(file, "rb") as f:
+                data = f.read()
+        except OSError:
+            return [f"{file}: Access denied. ERROR"]
+        names = self.match(data)
+        if not all_matches:
+            names = names[:1]
+        return [f"{file}: {name} FOUND" for name in names]
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.clamd = self.server.clamd
+        self.unix = self.request.family == socket.AF_UNIX
+        self.buffer = bytearray()
+        # descriptors received with SCM_RIGHTS, for FILDES
+        self.fds = deque()
+        self.replies = 0
+        self.closed = False
+        self.write_lock = threading.Lock()
+
+    def finish(self):
+        while self.fds:
+            os.close(self.fds.popleft())
+
+    def handle(self):
+        command, delimiter = self.read_command()
+        if command != "IDSESSION":
+            if command:
+                self.reply(None, self.request_for(command)(), delimiter)
+            return
+
+        self.clamd.commands[command] += 1
+        if self.clamd.refuse_session:
+            self.reply(None, ["UNKNOWN COMMAND"], delimiter)
+            return
+        self.session()
+
+    def session(self):
+        # replies are numbered in the order the commands came in, and sent
+        # as soon as they are ready
+        request_id = 0
+        threads = []
+        while not self.closed:
+            command, delimiter = self.read_command()
+            if not command or command == "END":
+                break
+            request_id += 1
+            run = self.request_for(command)
+            if command.partition(" ")[0] not in SCAN_COMMANDS:
+                self.reply(request_id, run(), delimiter)
+                continue
+            thread = threading.Thread(
+                target=lambda rid, run, delimiter: self.reply(rid, run(), delimiter),
+                args=(request_id, run, delimiter),
+            )
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def request_for(self, command):
+        """
+        Read what the client sends after the command, and get the function
+        computing the reply lines.
+        """
+        name, _, argument = command.partition(" ")
+        self.clamd.commands[name] += 1
+        if name == "PING":
+            return lambda: ["PONG"]
+        if name == "VERSION":
+            return lambda: [VERSION]
+        if name == "STATS":
+            return lambda: [self.clamd.stats()]
+        if name == "RELOAD":
+            return lambda: ["RELOADING"]
+        if name == "INSTREAM":
+            data = self.read_stream()
+            if data is None:
+                self.closed = True
+                return lambda: [SIZE_LIMIT_REPLY]
+            return self.scan(lambda: self.verdict("stream", data))
+        if name == "FILDES":
+            fd = self.read_fd()
+            if fd is None:
+                self.closed = True
+                return lambda: ["FILDES: didn't receive file descriptor. ERROR"]
+            return self.scan(lambda: self.verdict(f"fd[{fd}]", _read_fd(fd)))
+        if name in SCAN_COMMANDS:
+            return self.scan(lambda: self.clamd.scan_path(name, argument))
+        return lambda: ["UNKNOWN COMMAND"]
+
+    def scan(self, run):
+        def held():
+            lines = run()
+            self.clamd.release.wait(5)
+            return lines
+
+        return held
+
+    def verdict(self, name, data):
+        names = self.clamd.match(data)
+        if names:
+            return [f"{name}: {names[0]} FOUND"]
+        return [f"{name}: OK"]
+
+    def reply(self, request_id, lines, delimiter):
+        with self.write_lock:
+            if self.replies == self.clamd.close_after:
+                return
+            for line in lines:
+                if request_id is not None:
+                    line = f"{request_id}: {line}"
+                self.write(line.encode(errors="surrogateescape") + delimiter)
+            self.replies += 1
+            if self.replies == self.clamd.close_after or self.closed:
+                self.close()
+
+    def write(self, data):
+        step = self.clamd.partial or len(data)
+        try:
+            for n in range(0, len(data), step):
+                self.request.sendall(data[n : n + step])
+                if self.clamd.partial:
+                    time.sleep(0.001)
+        except OSError:
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def recv(self):
+        try:
+            if not self.unix:
+                return self.request.recv(65536)
+            # any read may carry the descriptor of a FILDES
+            data, ancdata, _, _ = self.request.recvmsg(
+                65536, socket.CMSG_SPACE(struct.calcsize("i") * 4)
+            )
+        except OSError:
+            return b""
+        for level, kind, payload in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                count = len(payload) // struct.calcsize("i")
+                self.fds.extend(struct.unpack(f"{count}i", payload[: count * 4]))
+        return data
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            data = self.recv()
+            if not data:
+                break
+            self.buffer += data
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_until(self, delimiter):
+        start = 0
+        while (end := self.buffer.find(delimiter, start)) < 0:
+            start = len(self.buffer)
+            data = self.recv()
+            if not data:
+                return None
+            self.buffer += data
+        data = bytes(self.buffer[:end])
+        del self.buffer[: end + 1]
+        return data
+
+    def read_command(self):
+        # "nCOMMAND\n" or "zCOMMAND\0", the reply ending the same way
+        prefix = self.read(1)
+        if prefix not in (b"n", b"z"):
+            return None, b"\n"
+        delimiter = b"\n" if prefix == b"n" else b"\0"
+        command = self.read_until(delimiter)
+        if command is None:
+            return None, delimiter
+        return command.decode(errors="surrogateescape").strip(), delimiter
+
+    def read_stream(self):
+        # the chunks up to the zero length one, None past stream_max_length
+        data = bytearray()
+        limit = self.clamd.stream_max_length
+        while True:
+            header = self.read(4)
+            if len(header) < 4:
+                break
+            size = struct.unpack("!I", header)[0]
+            if not size:
+                break
+            if limit is not None and len(data) + size > limit:
+                return None
+            data += self.read(size)
+        return bytes(data)
+
+    def read_fd(self):
+        # the descriptor comes with a one byte message
+        if not self.unix or not self.read(1):
+            return None
+        while not self.fds:
+            data = self.recv()
+            if not data:
+                return None
+            self.buffer += data
+        return self.fds.popleft()
+
+
+def _read_fd(fd):
+    try:
+        chunks = []
+        offset = 0
+        while chunk := os.pread(fd, 1 << 20, offset):
+            chunks.append(chunk)
+            offset += len(chunk)
+        return b"".join(chunks)
+    finally:
+        os.close(fd)
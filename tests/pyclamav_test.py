@@ -1,15 +1,70 @@
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
+import asyncio
+import io
+import json
+import socket
+import struct
+import hashlib
+import tarfile
 import datetime
 import argparse
 from lib.config import parse_arg, Config, load_config
-from lib.utils import create_file_folder
+from lib.utils import create_file_folder, iterate_folder, mtime_cutoff_ns
+import os
 import logging
 from pathlib import Path
 from lib import pyclamd
 from lib.scan import Scan
+from lib.pool import ClamdPool
+from lib.cache import ScanCache
+from lib.state import ScanState
+from lib.rules import WalkRules
+from lib.pipeline import WalkPipeline
+from lib.dedup import Dedup, SCAN, WAITING
+from lib.batch import TarStream
+from lib.allowlist import PackageAllowlist
+from lib.balancer import ClamdBalancer
+from lib.clamdstats import parse_stats
+from lib.adaptive import AdaptiveLimiter
+from pyclamav import group_folders, scan_folder
+import time
+from lib.aioclamd import AsyncClamd, AsyncClamdNetworkSocket
+from lib.aioscan import AsyncScan
+from tests.benchmark import benchmark, compare
+from tests.fakeclamd import FakeClamd, SIGNATURE_NAME, VERSION
 import tempfile
 import shutil
+import threading
+
+
+async def fake_clamd(reader, writer):
+    command = (await reader.readline()).strip()
+    if command == b"nPING":
+        writer.write(b"PONG\n")
+    elif command == b"nINSTREAM":
+        data = b""
+        while size := struct.unpack("!I", await reader.readexactly(4))[0]:
+            data += await reader.readexactly(size)
+        if b"EICAR" in data:
+            writer.write(b"stream: Eicar-Test-Signature FOUND\n")
+        else:
+            writer.write(b"stream: OK\n")
+    await writer.drain()
+    writer.close()
+
+
+CLAMD_STATS = """POOLS: 1
+
+STATE: VALID PRIMARY
+THREADS: live 3  idle 0 max 4 idle-timeout 30
+QUEUE: {queue} items
+\tSTATS 0.000394
+\tSCAN 1.250000 /var/www/shell.php
+
+MEMSTATS: heap N/A mmap N/A used N/A free N/A releasable N/A pools 1 pools_used 1306.837M pools_total 1306.883M
+END
+"""
 
 
 class TestPyclamav(unittest.TestCase):
@@ -53,7 +108,13 @@ class TestPyclamav(unittest.TestCase):
     @patch(
         "argparse.ArgumentParser.parse_args",
         return_value=argparse.Namespace(
-            config="test_config.json", modified_since="24h", verbose=False, process=5
+            config="test_config.json",
+            modified_since="24h",
+            verbose=False,
+            process=5,
+            workers=None,
+            incremental=False,
+            timings=False,
         ),
     )
     def test_load_config(self, mock_args, mock_file):
@@ -63,6 +124,34 @@ class TestPyclamav(unittest.TestCase):
         self.assertEqual(config.modified_file_since, "24h")
         self.assertIsInstance(config.modified_file_datetime, datetime.datetime)
         self.assertEqual(config.verbose, False)
+        self.assertEqual(config.workers, 1)
+
+    def test_config_model_full_scan(self):
+        config = Config(modified_file_since=None, multiscan=True)
+        self.assertIsNone(config.modified_file_datetime)
+        self.assertTrue(config.multiscan)
+
+    @patch(
+        "builtins.open",
+        new_callable=mock_open,
+        read_data='{"folders": [], "workers": 2}',
+    )
+    @patch(
+        "argparse.ArgumentParser.parse_args",
+        return_value=argparse.Namespace(
+            config="test_config.json",
+            modified_since=None,
+            verbose=False,
+            workers=8,
+            incremental=True,
+            timings=False,
+        ),
+    )
+    def test_load_config_workers(self, mock_args, mock_file):
+        config = load_config()
+        self.assertEqual(config.workers, 8)
+        self.assertTrue(config.incremental)
+        self.assertTrue(config.state_file.endswith("state.json"))
 
     def test_create_file_folder(self):
         filepath = Path(self.test_dir) / "subdir" / "file.txt"
@@ -87,6 +176,163 @@ class TestPyclamav(unittest.TestCase):
 
         self.assertTrue(filepath.parent.exists())
 
+    def test_group_folders(self):
+        folders = [self.test_dir, "./tests/data", "/nonexistent"]
+        self.assertEqual(
+            group_folders(folders, by_device=False), [[folder] for folder in folders]
+        )
+        groups = group_folders(folders, by_device=True)
+        self.assertEqual(sorted(sum(groups, [])), sorted(folders))
+        self.assertIn(["/nonexistent"], groups)
+
+    def test_scan_folder_failure(self):
+        scanner = MagicMock()
+        scanner.for_folder.return_value.scan_folder.side_effect = RuntimeError("bug")
+        state = MagicMock()
+
+        self.assertFalse(scan_folder(scanner, self.test_dir, MagicMock(), state))
+        scanner.logger.exception.assert_called_once()
+        state.checkpoint.assert_not_called()
+
+    def test_scan_folder_unreadable(self):
+        _, cd = self._fake_clamd()
+        root = Path(self.test_dir)
+        (root / "locked").mkdir()
+        (root / "locked" / "file").write_bytes(b"EICAR")
+        (root / "file").write_bytes(b"clean")
+        scanner = Scan(modified_since=None, logger=MagicMock(), cd=cd)
+        config = Config(modified_file_since=None)
+        state = MagicMock()
+        state.since.return_value = None
+
+        # an unmounted or missing folder fails, without a checkpoint
+        self.assertFalse(scan_folder(scanner, "/nonexistent", config, state))
+        state.checkpoint.assert_not_called()
+
+        # an unreadable subfolder keeps the checkpoint too
+        scandir = os.scandir
+
+        def denied(path):
+            if str(path).endswith("locked"):
+                raise PermissionError(13, "Permission denied", str(path))
+            return scandir(path)
+
+        with patch("lib.utils.os.scandir", side_effect=denied):
+            self.assertTrue(scan_folder(scanner, str(root), config, state))
+        state.checkpoint.assert_not_called()
+        scanner.logger.warning.assert_any_call(
+            "Cannot read folder",
+            extra={"folder": str(root / "locked"), "reason": "Permission denied"},
+        )
+
+        self.assertTrue(scan_folder(scanner, str(root), config, state))
+        state.checkpoint.assert_called_once_with(str(root), state.start.return_value)
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_for_folder(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        scan = Scan(modified_since=None, logger=logging.getLogger(), dedup_workers=1)
+
+        since = datetime.datetime.now()
+        folder_scan = scan.for_folder(since, workers=4)
+
+        self.assertEqual((folder_scan.modified_since, folder_scan.workers), (since, 4))
+        self.assertEqual((scan.modified_since, scan.workers), (None, 1))
+        self.assertIsNot(folder_scan.cd, scan.cd)
+        self.assertIs(folder_scan.dedup, scan.dedup)
+
+    def test_iterate_folder(self):
+        root = Path(self.test_dir)
+        (root / "a" / "b").mkdir(parents=True)
+        (root / "new").write_bytes(b"new")
+        (root / "a" / "b" / "new").write_bytes(b"new")
+        (root / "a" / "old").write_bytes(b"old")
+        os.utime(root / "a" / "old", (0, 0))
+        (root / "link").symlink_to(root / "a")
+
+        files = sorted(path for path, st in iterate_folder(root))
+        self.assertEqual(
+            files, [root / "a" / "b" / "new", root / "a" / "old", root / "new"]
+        )
+
+        cutoff = mtime_cutoff_ns(datetime.datetime.now() - datetime.timedelta(days=1))
+        files = sorted(path for path, st in iterate_folder(self.test_dir, cutoff))
+        self.assertEqual(files, [root / "a" / "b" / "new", root / "new"])
+
+    def test_iterate_folder_rules(self):
+        root = Path(self.test_dir)
+        (root / ".git").mkdir()
+        (root / ".git" / "HEAD").write_bytes(b"ref")
+        (root / "cache").mkdir()
+        (root / "cache" / "page.php").write_bytes(b"<?php")
+        (root / "index.php").write_bytes(b"<?php")
+        (root / "big.php").write_bytes(b"x" * 100)
+        (root / "empty.php").write_bytes(b"")
+        (root / "logo.PNG").write_bytes(b"png")
+        (root / "disk.iso").write_bytes(b"iso")
+
+        rules = WalkRules(
+            exclude=[".git", "*.iso", f"re:^{root}/cache/"],
+            max_file_size=50,
+            min_file_size=1,
+            include_extensions=["php", ".png"],
+            exclude_extensions=["PNG"],
+        )
+        files = [path.name for path, st in iterate_folder(root, rules=rules)]
+
+        self.assertEqual(files, ["index.php"])
+        self.assertEqual(
+            rules.stats(),
+            {
+                "exclude": {"entries": 3, "bytes": 0},
+                "exclude_extensions": {"entries": 1, "bytes": 0},
+                "max_file_size": {"entries": 1, "bytes": 100},
+                "min_file_size": {"entries": 1, "bytes": 0},
+            },
+        )
+
+    def test_iterate_folder_links(self):
+        root = Path(self.test_dir)
+        (root / "a").mkdir()
+        (root / "a" / "file").write_bytes(b"data")
+        (root / "hardlink").hardlink_to(root / "a" / "file")
+        (root / "a" / "loop").symlink_to(root)
+        (root / "symlink").symlink_to(root / "a" / "file")
+
+        rules = WalkRules()
+        seen = set()
+        files = list(iterate_folder(root, rules=rules, symlinks="follow", seen=seen))
+        self.assertEqual(len(files), 1)
+        self.assertEqual(rules.stats(), {"hardlink": {"entries": 2, "bytes": 8}})
+        self.assertEqual(list(iterate_folder(root, seen=seen)), [])
+
+        files = [path.name for path, st in iterate_folder(root, symlinks="skip")]
+        self.assertEqual(sorted(files), ["file", "hardlink"])
+
+        files = list(iterate_folder(root, one_file_system=True))
+        self.assertEqual(len(files), 3)
+
+    def test_walk_pipeline(self):
+        pipeline = WalkPipeline([iter(range(100))], depth=4)
+        items = []
+        for item in pipeline:
+            time.sleep(0.001)
+            items.append(item)
+
+        self.assertEqual(items, list(range(100)))
+        stats = pipeline.stats()
+        self.assertEqual(stats["files"], 100)
+        self.assertLessEqual(stats["max_depth"], 4)
+        self.assertGreater(stats["scan_wait"], 0)
+
+        def failing_walk():
+            yield 1
+            raise OSError("walk failed")
+
+        with self.assertRaises(OSError):
+            list(WalkPipeline([failing_walk()]))
+
     @patch("lib.pyclamd.ClamdUnixSocket")
     @patch("lib.pyclamd.ClamdNetworkSocket")
     def test_init(self, mock_network_socket, mock_unix_socket):
@@ -124,6 +370,61 @@ class TestPyclamav(unittest.TestCase):
         file = Path("./tests/data/EICAR")
         self.assertTrue(scan.scan_file(file))
 
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_file_too_long(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        mock_unix_socket.return_value.scan_stream.side_effect = (
+            pyclamd.BufferTooLongError("INSTREAM size limit exceeded. ERROR")
+        )
+
+        logger = MagicMock()
+        scan = Scan(modified_since=None, logger=logger)
+
+        self.assertFalse(scan.scan_file(Path("./tests/data/EICAR")))
+        logger.debug.assert_called_with(
+            "INSTREAM size limit exceeded.", extra={"filepath": "tests/data/EICAR"}
+        )
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_folder_session_file_deleted(
+        self, mock_network_socket, mock_unix_socket
+    ):
+        mock_unix_socket.return_value.ping.return_value = None
+        session = mock_unix_socket.return_value.session.return_value
+        session.send_stream.return_value = []
+        session.drain.return_value = []
+        deleted = Path(self.test_dir) / "deleted"
+
+        logger = MagicMock()
+        scan = Scan(modified_since=None, logger=logger)
+        # the file is removed between the walk and the scan
+        with patch.object(scan, "_candidates", return_value=iter([deleted])):
+            results = scan.scan_folder_session(self.test_dir)
+
+        self.assertEqual(results, [])
+        session.send_stream.assert_not_called()
+        logger.debug.assert_any_call(
+            "No such file or directory", extra={"filepath": str(deleted)}
+        )
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_file_fildes(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        mock_unix_socket.return_value.family = socket.AF_UNIX
+        mock_unix_socket.return_value.scan_fd.return_value = {
+            "fd[3]": ("FOUND", "EICAR")
+        }
+
+        logger = logging.getLogger()
+        scan = Scan(modified_since=None, logger=logger)
+
+        self.assertTrue(scan.fildes)
+        self.assertTrue(scan.scan_file(Path("./tests/data/EICAR")))
+        mock_unix_socket.return_value.scan_stream.assert_not_called()
+
     @patch("lib.pyclamd.ClamdUnixSocket")
     @patch("lib.pyclamd.ClamdNetworkSocket")
     @patch("pathlib.Path.stat")
@@ -153,12 +454,972 @@ class TestPyclamav(unittest.TestCase):
             "stream": ("FOUND", "EICAR")
         }
 
+        mock_unix_socket.return_value.session.side_effect = pyclamd.SessionRefusedError
+
         logger = logging.getLogger()
         scan = Scan(modified_since=None, logger=logger)
 
         results = scan.scan_folder("./tests/data/")
 
         self.assertEqual(len(results), 1)
+        self.assertFalse(scan.session)
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_folder_session(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        session = mock_unix_socket.return_value.session.return_value
+        session.send_stream.return_value = []
+        session.drain.return_value = [
+            (Path("tests/data/EICAR"), {"stream": ("FOUND", "EICAR")})
+        ]
+
+        logger = logging.getLogger()
+        scan = Scan(modified_since=None, logger=logger)
+
+        results = scan.scan_folder("./tests/data/")
+
+        self.assertEqual(results, [Path("tests/data/EICAR")])
+        session.send_stream.assert_called_once()
+        mock_unix_socket.return_value.scan_stream.assert_not_called()
+        session.close.assert_called_once()
+
+    def _fake_clamd(self, **kwargs):
+        clamd = FakeClamd(**kwargs).start()
+        self.addCleanup(clamd.close)
+        return clamd, pyclamd.ClamdUnixSocket(clamd.path, timeout=5)
+
+    def test_session_demuxes_numbered_replies(self):
+        server, cd = self._fake_clamd()
+        # hold the replies back: the third stream must wait for the window
+        server.release.clear()
+        session = cd.session(max_pending=2)
+        self.assertEqual(session.send_stream(b"EICAR", tag="a"), [])
+        self.assertEqual(session.send_stream(b"clean", tag="b"), [])
+
+        sent = []
+        third = threading.Thread(
+            target=lambda: sent.extend(session.send_stream(b"EICAR", tag="c"))
+        )
+        third.start()
+        third.join(0.2)
+        self.assertTrue(third.is_alive())
+        self.assertEqual(len(session.pending), 2)
+
+        server.release.set()
+        third.join(5)
+        results = sent + session.drain()
+        session.close()
+
+        # the replies come in any order, each one for its own request
+        self.assertEqual(sorted(tag for tag, _ in results), ["a", "b", "c"])
+        self.assertEqual(
+            dict(results),
+            {
+                "a": {"stream": ("FOUND", SIGNATURE_NAME)},
+                "b": None,
+                "c": {"stream": ("FOUND", SIGNATURE_NAME)},
+            },
+        )
+
+    def test_session_refused(self):
+        _, cd = self._fake_clamd(refuse_session=True)
+        with self.assertRaises(pyclamd.SessionRefusedError):
+            cd.session()
+
+    def test_recover_session_keeps_received_verdicts(self):
+        # PING is request 1, the connection drops after the first stream
+        _, cd = self._fake_clamd(close_after=2)
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        infected, clean = Path(folder, "infected"), Path(folder, "clean")
+        infected.write_bytes(b"EICAR")
+        clean.write_bytes(b"clean")
+
+        scan = Scan(
+            modified_since=None, logger=logging.getLogger(), fildes=False, cd=cd
+        )
+        session = cd.session()
+        with self.assertRaises(pyclamd.ConnectionError):
+            scan._send_with(session, infected)
+            scan._send_with(session, clean)
+            session.drain()
+
+        with patch.object(cd, "scan_stream", wraps=cd.scan_stream) as scan_stream:
+            done = scan._recover_session(session)
+
+        self.assertEqual(
+            done, [(infected, {"stream": ("FOUND", SIGNATURE_NAME)}), (clean, None)]
+        )
+        # only the file lost with the session is scanned again
+        scan_stream.assert_called_once()
+
+    def test_emulator_commands(self):
+        clamd, cd = self._fake_clamd()
+        folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, folder)
+        (folder / "sub").mkdir()
+        infected, clean = folder / "sub" / "infected", folder / "clean"
+        infected.write_bytes(b"X5O EICAR TEST EVIL")
+        clean.write_bytes(b"clean")
+        found = ("FOUND", SIGNATURE_NAME)
+
+        self.assertTrue(cd.ping())
+        self.assertEqual(cd.version(), VERSION)
+        stats = parse_stats(cd.stats())
+        self.assertEqual(
+            (stats.threads_max, stats.threads_idle, stats.threads_busy), (10, 10, 0)
+        )
+        self.assertEqual(cd.reload(), "RELOADING")
+        self.assertEqual(cd.scan_file(str(folder)), {str(infected): found})
+        self.assertIsNone(cd.scan_file(str(clean)))
+        self.assertEqual(cd.contscan_file(str(folder)), {str(infected): found})
+        self.assertEqual(cd.multiscan_file(str(folder)), {str(infected): found})
+        self.assertEqual(list(cd.iter_multiscan(str(clean))), [(str(clean), "OK", "")])
+        self.assertEqual(
+            cd.scan_file(str(folder / "missing")),
+            {
+                str(folder / "missing"): (
+                    "ERROR",
+                    "File path check failure: No such file or directory.",
+                )
+            },
+        )
+        with open(infected, "rb") as f:
+            (status,) = cd.scan_fd(f.fileno()).values()
+        self.assertEqual(status, found)
+        self.assertEqual(cd.scan_stream(b"clean"), None)
+
+        clamd.signatures[b"EVIL"] = "Evil-Test-Signature"
+        self.assertEqual(
+            cd.allmatchscan(str(infected)),
+            {str(infected): [found, ("FOUND", "Evil-Test-Signature")]},
+        )
+
+        # the same commands over TCP, numbered inside a session
+        network = pyclamd.ClamdNetworkSocket(*clamd.address, timeout=5)
+        self.assertEqual(network.scan_stream(b"EICAR"), {"stream": found})
+        with network.session() as session:
+            self.assertTrue(session.ping())
+            self.assertEqual(session.version(), VERSION)
+            self.assertIsNone(session.scan_stream(b"clean"))
+        self.assertEqual(clamd.commands["IDSESSION"], 1)
+
+    def test_streaming_scans(self):
+        clamd, cd = self._fake_clamd()
+        clamd.signatures[b"EVIL"] = "Evil-Test-Signature"
+        folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, folder)
+        (folder / "sub").mkdir()
+        for n in range(5):
+            (folder / "sub" / f"clean{n}").write_bytes(b"clean")
+        both, evil = folder / "both", folder / "sub" / "evil"
+        both.write_bytes(b"EICAR EVIL")
+        evil.write_bytes(b"EVIL")
+        found, evil_found = ("FOUND", SIGNATURE_NAME), ("FOUND", "Evil-Test-Signature")
+
+        # every file of the folder through one session, every match reported
+        results = list(cd.iter_allmatchscan(str(folder), max_pending=2))
+        self.assertEqual(len(results), 8)
+        self.assertEqual(
+            sorted(r for r in results if r[1] == "FOUND"),
+            [
+                (str(both), *found),
+                (str(both), *evil_found),
+                (str(evil), *evil_found),
+            ],
+        )
+        self.assertEqual(clamd.commands["IDSESSION"], 1)
+        self.assertEqual(clamd.commands["ALLMATCHSCAN"], 7)
+        self.assertEqual(
+            cd.allmatchscan(str(folder)),
+            {str(both): [found, evil_found], str(evil): [evil_found]},
+        )
+
+        # the results come before the end of the scan
+        scan = cd.iter_contscan(str(folder))
+        self.assertEqual(len(next(scan)), 3)
+        scan.close()
+        self.assertEqual(
+            cd.contscan_file(str(folder)),
+            {str(both): found, str(evil): evil_found},
+        )
+
+        # one connection per file when clamd refuses the session
+        clamd, cd = self._fake_clamd(refuse_session=True)
+        self.assertEqual(len(list(cd.iter_allmatchscan(str(folder)))), 7)
+        self.assertEqual(clamd.commands["ALLMATCHSCAN"], 7)
+
+        # a session lost before every reply came in
+        clamd, cd = self._fake_clamd(close_after=3)
+        with self.assertRaises(pyclamd.ConnectionError):
+            list(cd.iter_allmatchscan(str(folder)))
+
+    def test_emulator_faults(self):
+        # replies split over several reads
+        _, cd = self._fake_clamd(partial=3)
+        found = {"stream": ("FOUND", SIGNATURE_NAME)}
+        with cd.session() as session:
+            self.assertEqual(session.scan_stream(b"EICAR"), found)
+        self.assertEqual(list(cd.iter_multiscan("/nonexistent"))[0][1], "ERROR")
+        self.assertEqual(cd.scan_stream(b"EICAR"), found)
+        self.assertEqual(cd.version(), VERSION)
+        self.assertEqual(parse_stats(cd.stats()).threads_max, 10)
+        self.assertEqual(
+            cd.contscan_file("/nonexistent"),
+            {
+                "/nonexistent": (
+                    "ERROR",
+                    "File path check failure: No such file or directory.",
+                )
+            },
+        )
+
+        _, cd = self._fake_clamd(stream_max_length=1024)
+        self.assertIsNone(cd.scan_stream(b"x" * 1024))
+        with self.assertRaises(pyclamd.BufferTooLongError):
+            cd.scan_stream(b"x" * (4 << 20))
+
+        # the connection drops right after the PING opening the session
+        _, cd = self._fake_clamd(close_after=1)
+        session = cd.session()
+        with self.assertRaises(pyclamd.ConnectionError):
+            session.scan_stream(b"clean")
+        session.close()
+
+    def test_reply_reader(self):
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        reader = pyclamd._ReplyReader(client)
+        replies = [f"/srv/file {n}: Eicar-Test-Signature FOUND" for n in range(5000)]
+        data = "\n".join(replies).encode() + b"\n\n/srv/last: OK"
+
+        def send():
+            # cut the replies at odd places
+            for n in range(0, len(data), 997):
+                server.sendall(data[n : n + 997])
+            server.close()
+
+        sender = threading.Thread(target=send)
+        sender.start()
+        lines = list(reader)
+        sender.join()
+
+        self.assertEqual(lines, replies + ["/srv/last: OK"])
+        self.assertEqual(reader.readline(), "")
+        self.assertEqual(
+            pyclamd.parse_response(lines[1]),
+            ("/srv/file 1", "Eicar-Test-Signature", "FOUND"),
+        )
+
+        client, server = socket.socketpair()
+        self.addCleanup(client.close)
+        server.sendall(b"1: PONG\x002: stream: OK\x00")
+        server.close()
+        reader = pyclamd._ReplyReader(client, delimiter=b"\0")
+        self.assertEqual(list(reader), ["1: PONG", "2: stream: OK"])
+
+    def test_non_utf8_filenames(self):
+        clamd, cd = self._fake_clamd()
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        infected = os.path.join(os.fsencode(folder), b"\xff.bin")
+        with open(infected, "wb") as f:
+            f.write(b"EICAR")
+        # the name is escaped, and the same path is found again
+        name = os.fsdecode(infected)
+        found = (name, "FOUND", SIGNATURE_NAME)
+
+        self.assertIn(found, list(cd.iter_multiscan(folder)))
+        self.assertIn(found, list(cd.iter_allmatchscan(folder)))
+        self.assertEqual(cd.contscan_file(name), {name: ("FOUND", SIGNATURE_NAME)})
+        self.assertTrue(Path(name).exists())
+        scan = Scan(
+            modified_since=None, logger=logging.getLogger(), cd=cd, multiscan=True
+        )
+        self.assertEqual(scan.scan_folder(folder), [Path(name)])
+        scan.close()
+
+    def test_scan_end_to_end(self):
+        clamd, cd = self._fake_clamd(latency=0.001)
+        folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, folder)
+        for n in range(20):
+            (folder / f"file_{n}").write_bytes(b"EICAR" if n % 5 == 0 else b"clean")
+        expected = sorted(folder / f"file_{n}" for n in range(0, 20, 5))
+
+        for kwargs in [
+            {},
+            {"fildes": False},
+            {"session": False},
+            {"workers": 4},
+            {"workers": 4, "fildes": False, "session": False},
+        ]:
+            with self.subTest(**kwargs):
+                scan = Scan(
+                    modified_since=None, logger=logging.getLogger(), cd=cd, **kwargs
+                )
+                self.assertEqual(sorted(scan.scan_folder(str(folder))), expected)
+                scan.close()
+        self.assertEqual(clamd.commands["FILDES"], 60)
+        self.assertEqual(clamd.commands["INSTREAM"], 40)
+
+    def test_scan_folder_batch(self):
+        clamd, cd = self._fake_clamd()
+        folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, folder)
+        for n in range(32):
+            (folder / f"file_{n}").write_bytes(b"EICAR" if n in (3, 20) else b"clean")
+        (folder / "large").write_bytes(b"x" * 100)
+        expected = [folder / "file_20", folder / "file_3"]
+
+        # the archive is a valid tar, files that cannot be read are left out
+        archive = TarStream([folder / "file_3", folder / "missing", folder / "large"])
+        with tarfile.open(fileobj=io.BytesIO(archive.read())) as tar:
+            self.assertEqual(tar.getnames(), ["0", "2"])
+            self.assertEqual(tar.extractfile("2").read(), b"x" * 100)
+        self.assertEqual(archive.scanned, [folder / "file_3", folder / "large"])
+        self.assertEqual(archive.failed, [folder / "missing"])
+        self.assertEqual(archive.bytes, 105)
+
+        scan = Scan(
+            modified_since=None,
+            logger=logging.getLogger(),
+            cd=cd,
+            batch_max_files=16,
+            batch_file_size=10,
+        )
+        self.assertEqual(sorted(scan.scan_folder(str(folder))), expected)
+        stats = scan.batcher.stats()
+        scan.close()
+        # two batches of 16 files, split down to the infected files
+        self.assertEqual(clamd.commands["INSTREAM"], stats["batches"])
+        self.assertLessEqual(stats["batches"], 14)
+        self.assertGreater(stats["splits"], 0)
+        # the large file, and the infected files and their neighbours alone
+        self.assertLessEqual(clamd.commands["FILDES"], 5)
+
+    def test_scan_folder_allowlist(self):
+        clamd, cd = self._fake_clamd()
+        folder = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, folder)
+        packaged = {"ls": b"clean", "sh": b"EICAR", "conf": b"default"}
+        for name, data in packaged.items():
+            (folder / name).write_bytes(data)
+        (folder / "local").write_bytes(b"clean")
+        manifest = folder.parent / f"{folder.name}.md5sums"
+        self.addCleanup(manifest.unlink)
+        manifest.write_text(
+            "".join(
+                f"{hashlib.md5(data).hexdigest()}  {str(folder / name)[1:]}\n"
+                for name, data in packaged.items()
+            )
+            + "d41d8cd98f00b204e9800998ecf8427e  \nnot a digest\n"
+        )
+        # edited since the package was installed
+        (folder / "conf").write_bytes(b"EICAR edited")
+
+        allowlist = PackageAllowlist([str(manifest)])
+        self.assertEqual(len(allowlist), 3)
+        scan = Scan(
+            modified_since=None, logger=logging.getLogger(), cd=cd, allowlist=allowlist
+        )
+        self.assertEqual(scan.scan_folder(str(folder)), [folder / "conf"])
+        scan.close()
+        self.assertEqual(
+            allowlist.stats(), {"entries": 3, "files": 2, "bytes": 10, "mismatches": 1}
+        )
+        self.assertEqual(clamd.commands["FILDES"], 2)
+
+        # rpm gives the sizes, a different size is not even hashed
+        dump = [
+            f"{folder / 'ls'} 5 0 {hashlib.sha256(b'clean').hexdigest()} 0100755 root root 0 0 0 X\n",
+            f"{folder / 'sh'} 4 0 {hashlib.sha256(b'EICAR').hexdigest()} 0100755 root root 0 0 0 X\n",
+            f"{folder} 4096 0 {'0' * 64} 040755 root root 0 0 0 X\n",
+        ]
+        with patch("lib.allowlist.subprocess.Popen") as popen:
+            popen.return_value.__enter__.return_value.stdout = [
+                line.encode() for line in dump
+            ]
+            allowlist = PackageAllowlist(rpm=True)
+        self.assertEqual(len(allowlist), 2)
+        self.assertTrue(allowlist.allows(folder / "ls", (folder / "ls").stat()))
+        with patch("lib.allowlist.file_digest") as digest:
+            self.assertFalse(allowlist.allows(folder / "sh", (folder / "sh").stat()))
+        digest.assert_not_called()
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_folder_concurrent(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        session = mock_unix_socket.return_value.session.return_value
+        session.scan_stream.side_effect = lambda f: (
+            {"stream": ("FOUND", "EICAR")} if "infected" in f.name else None
+        )
+        for n in range(10):
+            name = f"infected_{n}" if n % 3 == 0 else f"clean_{n}"
+            (Path(self.test_dir) / name).write_bytes(b"data")
+
+        logger = logging.getLogger()
+        scan = Scan(modified_since=None, logger=logger, workers=4)
+
+        with self.assertLogs(logger, level="INFO") as logs:
+            results = scan.scan_folder(self.test_dir)
+
+        expected = [
+            path
+            for path in Path(self.test_dir).rglob("*")
+            if path.name.startswith("infected")
+        ]
+        self.assertEqual(results, expected)
+        self.assertEqual(
+            [record.file for record in logs.records],
+            [str(path) for path in expected],
+        )
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_folder_concurrent_without_session(
+        self, mock_network_socket, mock_unix_socket
+    ):
+        mock_unix_socket.return_value.ping.return_value = None
+        mock_unix_socket.return_value.session.side_effect = pyclamd.SessionRefusedError
+        mock_unix_socket.return_value.scan_stream.return_value = {
+            "stream": ("FOUND", "EICAR")
+        }
+
+        logger = logging.getLogger()
+        scan = Scan(modified_since=None, logger=logger, workers=2)
+
+        results = scan.scan_folder("./tests/data/")
+
+        self.assertEqual(len(results), 1)
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_folder_multiscan(self, mock_network_socket, mock_unix_socket):
+        root = str(Path(self.test_dir).resolve())
+        denied = Path(root) / "denied"
+        denied.write_bytes(b"data")
+        mock_unix_socket.return_value.ping.return_value = None
+        mock_unix_socket.return_value.iter_multiscan.return_value = iter(
+            [
+                (f"{root}/clean", "OK", ""),
+                (f"{root}/infected", "FOUND", "Eicar-Test-Signature"),
+                (str(denied), "ERROR", "lstat() failed: Permission denied."),
+            ]
+        )
+        mock_unix_socket.return_value.scan_stream.return_value = {
+            "stream": ("FOUND", "EICAR")
+        }
+
+        logger = MagicMock()
+        scan = Scan(modified_since=None, logger=logger, multiscan=True)
+
+        results = scan.scan_folder(root)
+
+        self.assertEqual(results, [Path(f"{root}/infected"), denied])
+        # clean files are not logged, only the matches
+        self.assertEqual(
+            [c.args[0] for c in logger.info.call_args_list], ["File match"] * 2
+        )
+        mock_unix_socket.return_value.iter_multiscan.assert_called_once_with(root)
+        mock_unix_socket.return_value.session.assert_not_called()
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_folder_multiscan_fallback(
+        self, mock_network_socket, mock_unix_socket
+    ):
+        root = str(Path("./tests/data").resolve())
+        mock_unix_socket.return_value.ping.return_value = None
+        mock_unix_socket.return_value.iter_multiscan.return_value = iter(
+            [(root, "ERROR", "lstat() failed: No such file or directory.")]
+        )
+        mock_unix_socket.return_value.session.side_effect = pyclamd.SessionRefusedError
+        mock_unix_socket.return_value.scan_stream.return_value = {
+            "stream": ("FOUND", "EICAR")
+        }
+
+        logger = logging.getLogger()
+        scan = Scan(modified_since=None, logger=logger, multiscan=True)
+
+        self.assertEqual(len(scan.scan_folder("./tests/data")), 1)
+
+    def test_scan_folder_multiscan_denied_folder(self):
+        clamd, cd = self._fake_clamd()
+        root = Path(self.test_dir).resolve()
+        (root / "locked" / "sub").mkdir(parents=True)
+        (root / "locked" / "sub" / "infected").write_bytes(b"EICAR")
+        (root / "locked" / "clean").write_bytes(b"clean")
+        (root / "file").write_bytes(b"EICAR")
+        fifo = root / "fifo"
+        os.mkfifo(fifo)
+        replies = [
+            (str(root / "locked"), "ERROR", "opendir() failed: Permission denied."),
+            (str(root / "file"), "ERROR", "Access denied."),
+            (str(fifo), "ERROR", "Access denied."),
+            (str(root / "gone"), "ERROR", "Access denied."),
+        ]
+
+        logger = MagicMock()
+        scan = Scan(modified_since=None, logger=logger, cd=cd, multiscan=True)
+        with patch.object(cd, "iter_multiscan", return_value=iter(replies)):
+            results = scan.scan_folder(str(root))
+
+        # the denied folder is walked and its files sent to clamd
+        self.assertEqual(
+            sorted(results), [root / "file", root / "locked" / "sub" / "infected"]
+        )
+        self.assertEqual(clamd.commands["FILDES"], 3)
+        logger.warning.assert_called_once()
+        self.assertEqual(
+            logger.warning.call_args.kwargs["extra"]["filepath"], str(root / "gone")
+        )
+
+    def test_scan_cache(self):
+        path = Path(self.test_dir) / "cache.db"
+        file = Path(self.test_dir) / "file"
+        file.write_bytes(b"data")
+        key = ScanCache.key(file.stat())
+
+        cache = ScanCache(str(path), "ClamAV 1.0.0/27000", max_entries=1)
+        self.assertEqual(cache.get(key), (False, None))
+        cache.put(key, {"stream": ("FOUND", "EICAR")})
+        self.assertEqual(cache.get(key), (True, {"stream": ("FOUND", "EICAR")}))
+        cache.put((0, 1, 2, 3, 4), None)
+        self.assertEqual(cache.get((0, 1, 2, 3, 4)), (True, None))
+        cache.put((0, 2, 2, 3, 4), {"stream": ("ERROR", "Access denied.")})
+        self.assertEqual(cache.get((0, 2, 2, 3, 4)), (False, None))
+        self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "entries": 2})
+        cache.close()
+
+        cache = ScanCache(str(path), "ClamAV 1.0.0/27000")
+        self.assertEqual(cache.stats()["entries"], 1)
+        cache.close()
+
+        cache = ScanCache(str(path), "ClamAV 1.0.0/27001")
+        self.assertEqual(cache.get(key), (False, None))
+        self.assertEqual(cache.stats()["entries"], 0)
+        cache.close()
+
+    def test_scan_state(self):
+        path = str(Path(self.test_dir) / "state" / "state.json")
+        state = ScanState(path)
+        self.assertIsNone(state.since("/var/www"))
+
+        state.checkpoint("/var/www", 1_700_000_000)
+        state.checkpoint("/var/www/", 1_600_000_000)
+
+        state = ScanState(path)
+        self.assertEqual(
+            state.since("/var/www", margin=60),
+            datetime.datetime.fromtimestamp(1_700_000_000 - 60),
+        )
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_folder_cache(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        mock_unix_socket.return_value.version.return_value = "ClamAV 1.0.0/27000"
+        mock_unix_socket.return_value.session.side_effect = pyclamd.SessionRefusedError
+        mock_unix_socket.return_value.scan_stream.return_value = {
+            "stream": ("FOUND", "EICAR")
+        }
+        cache_file = str(Path(self.test_dir) / "cache.db")
+
+        logger = logging.getLogger()
+        for run in range(2):
+            scan = Scan(modified_since=None, logger=logger, cache_file=cache_file)
+            self.assertEqual(len(scan.scan_folder("./tests/data/")), 1)
+            scan.close()
+
+        mock_unix_socket.return_value.scan_stream.assert_called_once()
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_metrics(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        mock_unix_socket.return_value.session.side_effect = pyclamd.SessionRefusedError
+        mock_unix_socket.return_value.scan_stream.side_effect = lambda f: (
+            {"stream": ("FOUND", "EICAR")} if "infected" in f.name else None
+        )
+        folder = Path(self.test_dir) / "files"
+        folder.mkdir()
+        (folder / "infected").write_bytes(b"EICAR")
+        (folder / "clean").write_bytes(b"clean")
+        (folder / "skipped.iso").write_bytes(b"iso")
+        metrics_file = Path(self.test_dir) / "pyclamav.prom"
+
+        scan = Scan(
+            modified_since=None,
+            logger=logging.getLogger(),
+            rules=WalkRules(exclude_extensions=["iso"]),
+            metrics_file=str(metrics_file),
+        )
+        scan._daemon_stats = lambda: parse_stats(CLAMD_STATS.format(queue=2))
+        scan.scan_folder(str(folder))
+        scan.close()
+
+        lines = metrics_file.read_text().splitlines()
+        for line in [
+            "# TYPE pyclamav_clamd_request_seconds histogram",
+            "pyclamav_files_walked_total 2",
+            "pyclamav_files_scanned_total 2",
+            "pyclamav_bytes_scanned_total 10",
+            'pyclamav_verdicts_total{result="clean"} 1',
+            'pyclamav_verdicts_total{result="infected"} 1',
+            'pyclamav_files_skipped_total{rule="exclude_extensions"} 1',
+            'pyclamav_clamd_request_seconds_count{command="INSTREAM"} 2',
+            'pyclamav_clamd_request_seconds_bucket{command="INSTREAM",le="+Inf"} 2',
+            "pyclamav_clamd_queue_length 2",
+        ]:
+            self.assertIn(line, lines)
+        self.assertEqual(list(Path(self.test_dir).glob("*.tmp")), [])
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_timings(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        mock_unix_socket.return_value.session.side_effect = pyclamd.SessionRefusedError
+
+        def scan_stream(f):
+            data = f.read()
+            mock_unix_socket.return_value.on_sent()
+            return {"stream": ("FOUND", "EICAR")} if data == b"EICAR" else None
+
+        mock_unix_socket.return_value.scan_stream.side_effect = scan_stream
+        folder = Path(self.test_dir) / "files"
+        folder.mkdir()
+        for n in range(3):
+            (folder / f"file_{n}").write_bytes(b"clean" * (n + 1))
+        (folder / "infected").write_bytes(b"EICAR")
+        timings_file = Path(self.test_dir) / "timings.json"
+
+        scan = Scan(
+            modified_since=None,
+            logger=logging.getLogger(),
+            timings=True,
+            timings_file=str(timings_file),
+            timings_slowest=2,
+        )
+        self.assertEqual(len(scan.scan_folder(str(folder))), 1)
+        scan.close()
+
+        report = json.loads(timings_file.read_text())
+        self.assertEqual(
+            sorted(report["phases"]), ["open", "read", "send", "verdict", "walk"]
+        )
+        for phase in report["phases"].values():
+            self.assertEqual(phase["count"], 4)
+            self.assertLessEqual(phase["p50"], phase["p99"])
+            self.assertLessEqual(phase["p99"], phase["max"])
+        self.assertEqual(len(report["slowest"]), 2)
+        self.assertEqual(len(report["folders"]), 1)
+        self.assertEqual(report["folders"][0]["files"], 4)
+        self.assertEqual(report["folders"][0]["bytes"], 35)
+
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    def test_scan_folder_dedup(self, mock_network_socket, mock_unix_socket):
+        mock_unix_socket.return_value.ping.return_value = None
+        session = mock_unix_socket.return_value.session.return_value
+        sent = []
+        session.send_stream.side_effect = lambda f, tag: sent.append(tag) or []
+        session.drain.side_effect = lambda: [
+            (tag, {"stream": ("FOUND", "EICAR")} if "infected" in tag.name else None)
+            for tag in sent
+        ]
+        for n in range(4):
+            (Path(self.test_dir) / f"infected_{n}").write_bytes(b"EICAR")
+            (Path(self.test_dir) / f"clean_{n}").write_bytes(b"clean")
+
+        logger = logging.getLogger()
+        scan = Scan(modified_since=None, logger=logger, dedup_workers=2)
+
+        with self.assertLogs(logger, level="INFO") as logs:
+            results = scan.scan_folder(self.test_dir)
+
+        self.assertEqual(len(sent), 2)
+        self.assertEqual(
+            sorted(path.name for path in results),
+            [f"infected_{n}" for n in range(4)],
+        )
+        self.assertEqual(len(logs.records), 4)
+        self.assertEqual(scan.dedup.stats(), {"hashed": 8, "duplicates": 6})
+
+    def test_dedup_owners(self):
+        dedup = Dedup()
+        first, same, other = Path("a/1"), Path("a/2"), Path("b/1")
+        self.assertEqual(dedup.claim(first, b"digest", owner="a"), (SCAN, None))
+        self.assertEqual(dedup.claim(same, b"digest", owner="a"), (WAITING, None))
+        # a folder scanned at the same time does not wait for another one
+        self.assertEqual(dedup.claim(other, b"digest", owner="b"), (SCAN, None))
+
+        self.assertEqual(dedup.resolve(first, None), ([same], []))
+        self.assertEqual(dedup.resolve(other, None), ([], []))
+
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    def test_balancer(self, mock_unix_socket, mock_network_socket):
+        clients = {
+            "/run/clamd1.ctl": MagicMock(),
+            "/run/clamd2.ctl": MagicMock(),
+        }
+        mock_unix_socket.side_effect = lambda path, timeout: clients[path]
+        for path, client in clients.items():
+            client.scan_stream.return_value = {"stream": ("FOUND", path)}
+
+        cd = ClamdBalancer(list(clients), retry_interval=0.05)
+        self.assertEqual(cd.family, socket.AF_UNIX)
+        cd.ping()
+        results = [cd.scan_stream(b"data") for _ in range(4)]
+        self.assertEqual(
+            sorted(result["stream"][1] for result in results),
+            ["/run/clamd1.ctl"] * 2 + ["/run/clamd2.ctl"] * 2,
+        )
+
+        clients["/run/clamd1.ctl"].scan_stream.side_effect = pyclamd.ConnectionError
+        clients["/run/clamd1.ctl"].ping.side_effect = pyclamd.ConnectionError
+        for _ in range(3):
+            self.assertEqual(
+                cd.scan_stream(b"data"), {"stream": ("FOUND", "/run/clamd2.ctl")}
+            )
+        self.assertEqual([endpoint["up"] for endpoint in cd.stats()], [False, True])
+
+        clients["/run/clamd1.ctl"].ping.side_effect = None
+        clients["/run/clamd1.ctl"].scan_stream.side_effect = None
+        time.sleep(0.06)
+        cd.scan_stream(b"data")
+        self.assertEqual([endpoint["up"] for endpoint in cd.stats()], [True, True])
+        self.assertEqual(cd.stats()[0]["failures"], 1)
+
+        with self.assertRaises(ValueError):
+            ClamdBalancer(["localhost"])
+        self.assertEqual(
+            ClamdBalancer(["/run/clamd1.ctl", "127.0.0.1:3310"]).family, socket.AF_INET
+        )
+
+    @patch("lib.pyclamd.ClamdNetworkSocket")
+    @patch("lib.pyclamd.ClamdUnixSocket")
+    def test_balancer_retries_stream_from_its_offset(
+        self, mock_unix_socket, mock_network_socket
+    ):
+        clients = {"/run/clamd1.ctl": MagicMock(), "/run/clamd2.ctl": MagicMock()}
+        mock_unix_socket.side_effect = lambda path, timeout: clients[path]
+
+        def broken(stream, chunk_size, use_mmap):
+            stream.read()
+            raise pyclamd.ConnectionError
+
+        received = []
+        clients["/run/clamd1.ctl"].scan_stream.side_effect = broken
+        clients["/run/clamd2.ctl"].scan_stream.side_effect = (
+            lambda stream, chunk_size, use_mmap: received.append(stream.read())
+        )
+
+        cd = ClamdBalancer(list(clients))
+        cd.ping()
+        stream = io.BytesIO(b"headerdata")
+        stream.seek(6)
+        cd.scan_stream(stream)
+
+        self.assertEqual(received, [b"data"])
+
+    def test_parse_stats(self):
+        stats = parse_stats(CLAMD_STATS.format(queue=2))
+
+        self.assertEqual(len(stats.pools), 1)
+        self.assertEqual(stats.pools[0].state, "VALID PRIMARY")
+        self.assertEqual(stats.pools[0].threads.idle_timeout, 30)
+        self.assertEqual(
+            (stats.queue_length, stats.threads_busy, stats.threads_max), (2, 3, 4)
+        )
+        self.assertEqual(stats.pools[0].queue[1].command, "SCAN")
+        self.assertEqual(stats.pools[0].queue[1].seconds, 1.25)
+        self.assertEqual(stats.pools[0].queue[1].detail, "/var/www/shell.php")
+        self.assertIsNone(stats.memory.heap)
+        self.assertEqual(stats.memory.pools_used, 1306.837)
+
+        # more idle than live threads is inconsistent, not negative busy threads
+        stats = parse_stats(
+            CLAMD_STATS.format(queue=0).replace("live 3  idle 0", "live 0 idle 20")
+        )
+        self.assertEqual(stats.threads_busy, 0)
+
+    def test_adaptive_limiter(self):
+        queue = [0]
+        limiter = AdaptiveLimiter(
+            lambda: parse_stats(CLAMD_STATS.format(queue=queue[0])),
+            maximum=8,
+            initial=2,
+        )
+        limiter.acquire()
+        limiter.acquire()
+        self.assertEqual(limiter.adjust(), 3)
+        # not grown while the limit is not reached
+        self.assertEqual(limiter.adjust(), 3)
+        limiter.acquire()
+        self.assertEqual(limiter.adjust(), 4)
+        limiter.acquire()
+        # capped by the clamd MaxThreads
+        self.assertEqual(limiter.adjust(), 4)
+        limiter.release()
+        with self.assertRaises(pyclamd.ConnectionError):
+            with limiter:
+                raise pyclamd.ConnectionError
+        self.assertEqual(limiter.stats()["limit"], 3)
+        queue[0] = 5
+        self.assertEqual(limiter.adjust(), 2)
+        self.assertEqual(limiter.stats()["in_flight"], 3)
+
+    def test_send_instream_handles_short_writes(self):
+        sock = MagicMock()
+        sock.sendmsg.return_value = 2
+        sent = []
+        sock.sendall.side_effect = lambda data: sent.append(bytes(data))
+
+        pyclamd._send_instream(sock, b"abcdefgh", chunk_size=5)
+
+        self.assertEqual(sock.sendmsg.call_count, 2)
+        self.assertEqual(
+            sent,
+            [
+                struct.pack("!I", 5)[2:],
+                b"abcde",
+                struct.pack("!I", 3)[2:],
+                b"fgh",
+                struct.pack("!I", 0),
+            ],
+        )
+
+    def test_pool_reuses_healthy_sessions(self):
+        clamd = MagicMock()
+        clamd.session.side_effect = lambda: MagicMock()
+        pool = ClamdPool(clamd, size=2)
+
+        with pool.connection() as first:
+            self.assertEqual(pool.stats()["checked_out"], 1)
+        with pool.connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        # a session reused right away is not PINGed
+        second.ping.assert_not_called()
+        self.assertEqual(pool.stats()["created"], 1)
+        self.assertEqual(pool.stats()["idle"], 1)
+
+    def test_pool_discards_broken_sessions(self):
+        clamd = MagicMock()
+        clamd.session.side_effect = lambda: MagicMock()
+        pool = ClamdPool(clamd, size=1, check_after=0)
+
+        with self.assertRaises(pyclamd.ConnectionError):
+            with pool.connection() as session:
+                raise pyclamd.ConnectionError("lost")
+        session.close.assert_called_once()
+
+        with pool.connection() as session:
+            pass
+        session.ping.side_effect = pyclamd.ConnectionError
+        with pool.connection() as replacement:
+            pass
+
+        self.assertIsNot(session, replacement)
+        self.assertEqual(pool.stats()["created"], 3)
+        self.assertEqual(pool.stats()["discarded"], 2)
+
+    def test_pool_bounds_sessions(self):
+        clamd = MagicMock()
+        clamd.session.side_effect = lambda: MagicMock()
+        pool = ClamdPool(clamd, size=1)
+
+        session = pool.acquire()
+        with self.assertRaises(pyclamd.ConnectionError):
+            pool.acquire(timeout=0.01)
+
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(pool.acquire()))
+        waiter.start()
+        while pool.stats()["waiting"] == 0:
+            pass
+        pool.release(session)
+        waiter.join()
+
+        self.assertEqual(acquired, [session])
+        self.assertEqual(pool.stats()["created"], 1)
+
+    def test_async_clamd(self):
+        async def run():
+            server = await asyncio.start_server(fake_clamd, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            cd = AsyncClamdNetworkSocket(port=port)
+            async with server:
+                return (
+                    await cd.ping(),
+                    await cd.scan_stream(pyclamd._ClamdGeneric().EICAR()),
+                    await cd.scan_stream(b"clean" * 10000),
+                )
+
+        ping, infected, clean = asyncio.run(run())
+        self.assertTrue(ping)
+        self.assertEqual(infected, {"stream": ("FOUND", "Eicar-Test-Signature")})
+        self.assertIsNone(clean)
+        with self.assertRaises(TypeError):
+            AsyncClamd()
+
+    def test_async_scan_folder(self):
+        for n in range(20):
+            (Path(self.test_dir) / f"file_{n}").write_bytes(
+                b"EICAR" if n % 5 == 0 else b"clean"
+            )
+
+        async def run():
+            server = await asyncio.start_server(fake_clamd, "127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+            scan = AsyncScan(
+                modified_since=None,
+                logger=logging.getLogger(),
+                cd=AsyncClamdNetworkSocket(port=port),
+                concurrency=3,
+            )
+            async with server:
+                results = await scan.scan_folder(self.test_dir)
+            scan.close()
+            return results
+
+        results = asyncio.run(run())
+        self.assertEqual(
+            sorted(path.name for path in results),
+            ["file_0", "file_10", "file_15", "file_5"],
+        )
+
+    def test_benchmark(self):
+        with FakeClamd() as clamd:
+            cd = pyclamd.ClamdNetworkSocket(*clamd.address)
+            self.assertEqual(
+                cd.scan_stream(b"EICAR"), {"stream": ("FOUND", SIGNATURE_NAME)}
+            )
+            session = cd.session()
+            self.assertIsNone(session.scan_stream(b"clean"))
+            # without it every session request waits for a delayed ACK
+            self.assertTrue(
+                session.clamd_socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+            )
+            session.close()
+            self.assertIn("QUEUE: 0 items", cd.stats())
+
+        report = benchmark(trees=["tiny", "duplicates"], scale=0.02, latency=0)
+        for result in report["results"]:
+            self.assertEqual(result["infected"], result["expected_infected"])
+            self.assertGreater(result["files_per_second"], 0)
+            self.assertGreater(result["peak_rss_mb"], 0)
+        self.assertEqual(report["results"][0]["files"], 401)
+        self.assertEqual(
+            compare(report, report)[0].split(", ")[0],
+            f"tiny: files_per_second {report['results'][0]['files_per_second']} -> "
+            f"{report['results'][0]['files_per_second']} (+0.0%)",
+        )
 
 
 if __name__ == "__main__":